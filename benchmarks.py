@@ -0,0 +1,424 @@
+import os
+import sys
+import json
+import time
+import platform
+import argparse
+import tempfile
+import tracemalloc
+import subprocess
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from custom_tools_main import filter_fastq
+from bio_files_processor import (OpenFasta, read_fasta_file, convert_multiline_fasta_to_oneline,
+                                 select_genes_from_gbk_to_list)
+
+try:
+    import resource
+except ImportError:  # resource is not available on Windows, peak memory is not reported there
+    resource = None
+
+
+_AMINO_ACIDS = np.frombuffer(b"ACDEFGHIKLMNPQRSTVWY", dtype=np.uint8)
+# Maximal number of nucleotides generated at once, longer sequences are written by pieces
+_GENERATOR_BASES = 2 ** 24
+
+
+def _lengths(rng: np.random.Generator, n: int, length) -> np.ndarray:
+    """
+    Draws n lengths: length if it is an int, uniformly from the (min, max) range (inclusive) if it is a tuple.
+    """
+    if isinstance(length, tuple):
+        return rng.integers(length[0], length[1] + 1, size=n)
+    return np.full(n, length)
+
+
+def _random_nucleotides(rng: np.random.Generator, size: int, gc_content=0.5) -> np.ndarray:
+    """
+    Draws size nucleotides as np.ndarray of uint8, G and C with the total probability gc_content.
+    """
+    gc_half, at_half = gc_content / 2, (1 - gc_content) / 2
+    return rng.choice(np.frombuffer(b"ACGT", dtype=np.uint8), size=size, p=[at_half, gc_half, gc_half, at_half])
+
+
+def _split(flat: np.ndarray, lengths: np.ndarray) -> list:
+    """
+    Splits a flat array of uint8 into bytes of the given lengths.
+    """
+    ends = np.cumsum(lengths).tolist()
+    data = flat.tobytes()
+    return [data[end - length:end] for end, length in zip(ends, lengths.tolist())]
+
+
+def generate_fastq(output_path: str, n_reads: int, read_length=150, seed=42, chunk_size=100_000,
+                   gc_content=0.5, quality_range=(2, 40)):
+    """
+    Writes a synthetic FASTQ file with random reads.
+    :param output_path: str, path of the FASTQ file to create.
+    :param n_reads: int, number of reads.
+    :param read_length: int, length of every read, or tuple (min, max), lengths are drawn uniformly
+    from this range. Default value is 150.
+    :param seed: int, seed of the random generator. Default value is 42.
+    :param chunk_size: int, number of reads generated at once. Default value is 100000.
+    :param gc_content: float, probability of G or C at every position. Default value is 0.5.
+    :param quality_range: tuple (min, max), Phred qualities are drawn uniformly from this range.
+    Default value is (2, 40).
+    """
+    rng = np.random.default_rng(seed)
+
+    with open(output_path, "wb") as fastq_file:
+        for chunk_start in range(0, n_reads, chunk_size):
+            lengths = _lengths(rng, min(chunk_size, n_reads - chunk_start), read_length)
+            seqs = _split(_random_nucleotides(rng, int(lengths.sum()), gc_content), lengths)
+            quals = _split(rng.integers(33 + quality_range[0], 33 + quality_range[1] + 1,
+                                        size=int(lengths.sum()), dtype=np.uint8), lengths)
+            fastq_file.write(b"".join(
+                b"@read%d\n%s\n+\n%s\n" % (chunk_start + i, seq, qual)
+                for i, (seq, qual) in enumerate(zip(seqs, quals))
+            ))
+
+
+def generate_fasta(output_path: str, n_records: int, seq_length=(100, 2000), seed=42, chunk_size=10_000,
+                   gc_content=0.5, line_width=60):
+    """
+    Writes a synthetic multiline FASTA file with random sequences.
+    :param output_path: str, path of the FASTA file to create.
+    :param n_records: int, number of records.
+    :param seq_length: int or tuple (min, max), length of the sequences, see generate_fastq.
+    Default value is (100, 2000).
+    :param seed: int, seed of the random generator. Default value is 42.
+    :param chunk_size: int, number of records generated at once. Default value is 10000.
+    :param gc_content: float, probability of G or C at every position. Default value is 0.5.
+    :param line_width: int, number of nucleotides per line. Default value is 60.
+    """
+    rng = np.random.default_rng(seed)
+
+    with open(output_path, "wb") as fasta_file:
+        for chunk_start in range(0, n_records, chunk_size):
+            lengths = _lengths(rng, min(chunk_size, n_records - chunk_start), seq_length)
+            if lengths.sum() > _GENERATOR_BASES:
+                for i, length in enumerate(lengths.tolist()):
+                    _write_long_record(fasta_file, rng, chunk_start + i, length, gc_content, line_width)
+                continue
+            seqs = _split(_random_nucleotides(rng, int(lengths.sum()), gc_content), lengths)
+            fasta_file.write(b"".join(
+                b">seq%d synthetic sequence %d\n%s\n" % (
+                    chunk_start + i, len(seq),
+                    b"\n".join(seq[start:start + line_width] for start in range(0, len(seq), line_width)))
+                for i, seq in enumerate(seqs)
+            ))
+
+
+def _write_long_record(fasta_file, rng: np.random.Generator, index: int, length: int, gc_content: float,
+                       line_width: int):
+    """
+    Writes a record of generate_fasta generating its sequence by pieces of about _GENERATOR_BASES nucleotides.
+    """
+    fasta_file.write(b">seq%d synthetic sequence %d\n" % (index, length))
+    piece_size = _GENERATOR_BASES // line_width * line_width
+    for piece_start in range(0, length, piece_size):
+        seq = _random_nucleotides(rng, min(piece_size, length - piece_start), gc_content).tobytes()
+        fasta_file.write(b"".join(seq[start:start + line_width] + b"\n" for start in range(0, len(seq), line_width)))
+
+
+def generate_gbk(output_path: str, n_genes: int, protein_length=(100, 600), seed=42):
+    """
+    Writes a synthetic GenBank file with CDS features of random proteins (the features only, without ORIGIN).
+    :param output_path: str, path of the GenBank file to create.
+    :param n_genes: int, number of CDS features.
+    :param protein_length: int or tuple (min, max), length of the translations. Default value is (100, 600).
+    :param seed: int, seed of the random generator. Default value is 42.
+    """
+    rng = np.random.default_rng(seed)
+    lengths = _lengths(rng, n_genes, protein_length)
+    proteins = _split(rng.choice(_AMINO_ACIDS, size=int(lengths.sum())), lengths)
+    indent = " " * 21
+
+    with open(output_path, "w") as gbk_file:
+        gbk_file.write("LOCUS       synthetic\nFEATURES             Location/Qualifiers\n")
+        position = 1
+        for i, protein in enumerate(proteins):
+            end = position + 3 * len(protein) + 2
+            translation = f'/translation="{protein.decode()}"'
+            lines = [translation[start:start + 58] for start in range(0, len(translation), 58)]
+            gbk_file.write(f"     CDS             {position}..{end}\n"
+                           f'{indent}/gene="gene{i}"\n'
+                           + "".join(f"{indent}{line}\n" for line in lines))
+            position = end + 1
+        gbk_file.write("//\n")
+
+
+def _peak_rss_mb():
+    """
+    Peak resident memory of the current process in MB, None if the resource module is not available.
+    """
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes elsewhere
+    return max_rss / 2 ** 20 if sys.platform == "darwin" else max_rss / 2 ** 10
+
+
+def _iterate_open_fasta(input_fasta: str) -> int:
+    """
+    Reads all records of a FASTA file with OpenFasta, returns their number.
+    """
+    with OpenFasta(input_fasta) as fasta:
+        return sum(1 for _ in fasta)
+
+
+def _records_memory(input_fasta: str, compact: bool) -> dict:
+    """
+    Loads all records of a FASTA file into a list with OpenFasta and measures the memory they take.
+    :return: dict with bytes_per_record (memory allocated for the list and the records divided by their number)
+    and n_records. Tracing slows the loading down, so it is not timed.
+    """
+    tracemalloc.start()
+    with OpenFasta(input_fasta, compact=compact) as fasta:
+        records = list(fasta)
+    allocated, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {"bytes_per_record": allocated / len(records), "n_records": len(records)}
+
+
+def _measure(function, args: tuple, kwargs: dict, input_path: str, n_records: int) -> dict:
+    """
+    Runs function(*args, **kwargs) once and measures its throughput on the input file.
+    :return: dict with seconds, mb_per_sec, records_per_sec, peak_rss_mb and baseline_rss_mb
+    (peak resident memory of the process before the call).
+    """
+    baseline_rss = _peak_rss_mb()
+    start_time = time.perf_counter()
+    function(*args, **kwargs)
+    seconds = time.perf_counter() - start_time
+    size_mb = os.path.getsize(input_path) / 2 ** 20
+    return {"seconds": seconds, "mb_per_sec": size_mb / seconds, "records_per_sec": n_records / seconds,
+            "peak_rss_mb": _peak_rss_mb(), "baseline_rss_mb": baseline_rss}
+
+
+def _call(function, *args, **kwargs):
+    """
+    Calls function(*args, **kwargs) in this process, the counterpart of _run_isolated.
+    """
+    return function(*args, **kwargs)
+
+
+def _run_isolated(function, *args, **kwargs):
+    """
+    Calls function(*args, **kwargs) in a new process and returns its result.
+    Forked processes inherit the peak memory of the parent, so the parent does no memory-heavy work itself.
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("fork" if "fork" in methods else "spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(function, *args, **kwargs).result()
+
+
+def measure(function, *args, input_path: str, n_records: int, isolate=True, **kwargs) -> dict:
+    """
+    Measures the throughput and peak memory of a call of function(*args, **kwargs).
+    :param function: module level function to benchmark.
+    :param input_path: str, path of the file processed by the call, its size gives mb_per_sec.
+    :param n_records: int, number of records in the file, gives records_per_sec.
+    :param isolate: bool, if True (default), the call runs in a new process, so that peak_rss_mb
+    is the peak memory of this call and not of the whole benchmark.
+    :return: dict with seconds, mb_per_sec, records_per_sec, peak_rss_mb and baseline_rss_mb.
+    """
+    if not isolate:
+        return _measure(function, args, kwargs, input_path, n_records)
+    return _run_isolated(_measure, function, args, kwargs, input_path, n_records)
+
+
+def benchmark_filter_fastq(n_reads=2_000_000, read_length=150, engines=("seqio", "raw", "numpy"), seed=42,
+                           isolate=True, **generator_options) -> dict:
+    """
+    Measures the throughput of filter_fastq engines on a synthetic FASTQ file.
+    :param n_reads: int, number of reads in the synthetic file. Default value is 2000000.
+    :param read_length: int or tuple (min, max), length of the reads. Default value is 150.
+    :param engines: tuple of str, filter_fastq engines to compare.
+    :param seed: int, seed of the random generator.
+    :param isolate: bool, if True (default), every engine runs in a new process, see measure.
+    :param generator_options: gc_content and quality_range of generate_fastq.
+    :return: dict, engine name -> {"seconds", "mb_per_sec", "records_per_sec", "peak_rss_mb", "baseline_rss_mb"}.
+    """
+    results = {}
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            generate = _run_isolated if isolate else _call
+            generate(generate_fastq, "synthetic.fastq", n_reads, read_length, seed, **generator_options)
+            for engine in engines:
+                results[engine] = measure(filter_fastq, "synthetic.fastq", input_path="synthetic.fastq",
+                                          n_records=n_reads, isolate=isolate,
+                                          gc_bounds=(0.4, 0.6), quality_threshold=20, engine=engine)
+        finally:
+            os.chdir(old_cwd)
+    return results
+
+
+def benchmark_fasta(n_records=200_000, seq_length=(100, 2000), n_genes=20_000, seed=42, isolate=True,
+                    gc_content=0.5) -> dict:
+    """
+    Measures the throughput of the FASTA and GenBank readers of bio_files_processor on synthetic files.
+    :param n_records: int, number of records in the synthetic FASTA file. Default value is 200000.
+    :param seq_length: int or tuple (min, max), length of the sequences. Default value is (100, 2000).
+    :param n_genes: int, number of CDS features in the synthetic GenBank file. Default value is 20000.
+    :param seed: int, seed of the random generator.
+    :param isolate: bool, if True (default), every function runs in a new process, see measure.
+    :param gc_content: float, GC content of the sequences. Default value is 0.5.
+    :return: dict, function name -> {"seconds", "mb_per_sec", "records_per_sec", "peak_rss_mb", "baseline_rss_mb"}.
+    """
+    results = {}
+    old_cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        os.chdir(tmp_dir)
+        try:
+            generate = _run_isolated if isolate else _call
+            generate(generate_fasta, "synthetic.fasta", n_records, seq_length, seed, gc_content=gc_content)
+            generate(generate_gbk, "synthetic.gbk", n_genes, seed=seed)
+            fasta_options = {"input_path": "synthetic.fasta", "n_records": n_records, "isolate": isolate}
+            results["read_fasta_file"] = measure(read_fasta_file, "synthetic.fasta", **fasta_options)
+            results["OpenFasta"] = measure(_iterate_open_fasta, "synthetic.fasta", **fasta_options)
+            results["convert_multiline_fasta_to_oneline"] = measure(
+                convert_multiline_fasta_to_oneline, "synthetic.fasta", "oneline", **fasta_options)
+            results["select_genes_from_gbk_to_list"] = measure(
+                select_genes_from_gbk_to_list, "synthetic.gbk", input_path="synthetic.gbk", n_records=n_genes,
+                isolate=isolate)
+        finally:
+            os.chdir(old_cwd)
+    return results
+
+
+def benchmark_single_record(sizes_mb=(25, 50, 100, 250), seed=42, isolate=True) -> dict:
+    """
+    Measures read_fasta_file and OpenFasta on FASTA files of a single sequence of growing length,
+    the MB/s of a reader with constant per-byte cost do not depend on the size.
+    :param sizes_mb: tuple of int, lengths of the sequence in millions of bases. Default value is (25, 50, 100, 250).
+    :param seed: int, seed of the random generator.
+    :param isolate: bool, if True (default), every function runs in a new process, see measure.
+    :return: dict, "<function>[<size> Mb]" -> {"seconds", "mb_per_sec", "records_per_sec", "peak_rss_mb",
+    "baseline_rss_mb"}.
+    """
+    results = {}
+    generate = _run_isolated if isolate else _call
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fasta_path = os.path.join(tmp_dir, "single_record.fasta")
+        for size in sizes_mb:
+            generate(generate_fasta, fasta_path, 1, size * 10 ** 6, seed)
+            fasta_options = {"input_path": fasta_path, "n_records": 1, "isolate": isolate}
+            results[f"read_fasta_file[{size} Mb]"] = measure(read_fasta_file, fasta_path, **fasta_options)
+            results[f"OpenFasta[{size} Mb]"] = measure(_iterate_open_fasta, fasta_path, **fasta_options)
+    return results
+
+
+def benchmark_record_memory(n_records=1_000_000, seq_length=(100, 300), seed=42, isolate=True) -> dict:
+    """
+    Compares the memory taken by FastaRecord and CompactFastaRecord objects holding the records
+    of a synthetic FASTA file of short (amplicon-like) sequences.
+    :param n_records: int, number of records. Default value is 1000000.
+    :param seq_length: int or tuple (min, max), length of the sequences. Default value is (100, 300).
+    :param seed: int, seed of the random generator.
+    :param isolate: bool, if True (default), every class is measured in a new process.
+    :return: dict, "memory[<class>]" -> {"bytes_per_record", "n_records"},
+    "memory[sequence data]" -> {"bytes_per_record"} is the mean size of a sequence.
+    """
+    generate = _run_isolated if isolate else _call
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        fasta_path = os.path.join(tmp_dir, "amplicons.fasta")
+        generate(generate_fasta, fasta_path, n_records, seq_length, seed)
+        results = {
+            "memory[FastaRecord]": generate(_records_memory, fasta_path, False),
+            "memory[CompactFastaRecord]": generate(_records_memory, fasta_path, True),
+        }
+    mean_length = np.mean(seq_length) if isinstance(seq_length, tuple) else seq_length
+    results["memory[sequence data]"] = {"bytes_per_record": float(mean_length)}
+    return results
+
+
+def _git_commit():
+    """
+    Commit of the benchmarked code, None outside of a git repository.
+    """
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], cwd=os.path.dirname(os.path.abspath(__file__)),
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(n_reads=2_000_000, read_length=150, engines=("seqio", "raw", "numpy"),
+                   n_records=200_000, seq_length=(100, 2000), n_genes=20_000, gc_content=0.5,
+                   quality_range=(2, 40), seed=42, isolate=True, single_record_mb=(), memory_records=0) -> dict:
+    """
+    Runs all benchmarks and collects the results with the parameters and the environment,
+    so that reports of different versions of the code can be compared.
+    Parameters are the same as in benchmark_filter_fastq and benchmark_fasta,
+    single_record_mb are sizes_mb of benchmark_single_record and memory_records is n_records
+    of benchmark_record_memory (both not run by default).
+    :return: dict with "environment", "parameters" and "results" (benchmark name -> measurements),
+    filter_fastq engines are named filter_fastq[<engine>].
+    """
+    parameters = {"n_reads": n_reads, "read_length": read_length, "engines": list(engines),
+                  "n_records": n_records, "seq_length": seq_length, "n_genes": n_genes,
+                  "gc_content": gc_content, "quality_range": quality_range, "seed": seed,
+                  "single_record_mb": list(single_record_mb), "memory_records": memory_records}
+    results = {}
+    fastq_results = benchmark_filter_fastq(n_reads, read_length, engines, seed, isolate,
+                                           gc_content=gc_content, quality_range=quality_range)
+    for engine, result in fastq_results.items():
+        results[f"filter_fastq[{engine}]"] = result
+    results.update(benchmark_fasta(n_records, seq_length, n_genes, seed, isolate, gc_content))
+    if single_record_mb:
+        results.update(benchmark_single_record(single_record_mb, seed, isolate))
+    if memory_records:
+        results.update(benchmark_record_memory(memory_records, seed=seed, isolate=isolate))
+
+    environment = {"commit": _git_commit(), "python": platform.python_version(), "numpy": np.__version__,
+                   "platform": platform.platform(), "cpu_count": os.cpu_count()}
+    return {"environment": environment, "parameters": parameters, "results": results}
+
+
+def _length_argument(value: str):
+    """
+    Parses a length argument of the command line: a number or a min-max range.
+    """
+    if "-" in value:
+        minimum, maximum = value.split("-")
+        return int(minimum), int(maximum)
+    return int(value)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Throughput benchmarks of filter_fastq and the FASTA readers "
+                                                 "on synthetic data, the report is printed as JSON.")
+    parser.add_argument("--reads", type=int, default=2_000_000, help="number of synthetic reads")
+    parser.add_argument("--length", type=_length_argument, default=150,
+                        help="length of synthetic reads, a number or a min-max range")
+    parser.add_argument("--engines", nargs="+", default=["seqio", "raw", "numpy"], help="engines to compare")
+    parser.add_argument("--records", type=int, default=200_000, help="number of synthetic FASTA records")
+    parser.add_argument("--seq-length", type=_length_argument, default=(100, 2000),
+                        help="length of synthetic FASTA sequences, a number or a min-max range")
+    parser.add_argument("--genes", type=int, default=20_000, help="number of CDS features of the GenBank file")
+    parser.add_argument("--gc", type=float, default=0.5, help="GC content of the synthetic sequences")
+    parser.add_argument("--quality", type=int, nargs=2, default=(2, 40), metavar=("MIN", "MAX"),
+                        help="range of the read qualities")
+    parser.add_argument("--single-record", type=int, nargs="*", default=[], metavar="MB",
+                        help="lengths (in millions of bases) of single-record FASTA files to read")
+    parser.add_argument("--memory-records", type=int, default=0,
+                        help="number of short records to compare the memory of FastaRecord and CompactFastaRecord")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the random generator")
+    parser.add_argument("--no-isolate", action="store_true",
+                        help="run everything in this process (peak memory is then the peak of the whole run)")
+    parser.add_argument("--output", help="file to write the JSON report to instead of printing it")
+    args = parser.parse_args()
+
+    report = run_benchmarks(args.reads, args.length, args.engines, args.records, args.seq_length, args.genes,
+                            args.gc, tuple(args.quality), args.seed, not args.no_isolate, args.single_record,
+                            args.memory_records)
+    if args.output is None:
+        print(json.dumps(report, indent=2))
+    else:
+        with open(args.output, "w") as report_file:
+            json.dump(report, report_file, indent=2)
@@ -1,29 +1,593 @@
+import io
 import os
+import glob
+import gzip
+import zlib
+import struct
+import numpy as np
+from collections import deque
+from collections.abc import Mapping
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Iterator, List
 
 
-def read_fasta_file(input_fasta: str) -> dict:
+_GZIP_MAGIC = b"\x1f\x8b"
+_COMPRESSED_EXTENSIONS = (".gz", ".bgz", ".bgzf")
+# Uncompressed size of a BGZF block, small enough for the deflated block to fit into 64 KiB
+_BGZF_BLOCK_SIZE = 65280
+# Size of the blocks read at once by the FASTA parser and the whitespace removed from sequences
+_FASTA_BLOCK_SIZE = 4 * 2 ** 20
+_SEQUENCE_WHITESPACE = b" \t\r\n"
+# Approximate size of the parts of uncompressed FASTA files read by one worker of read_fasta_files
+_FASTA_PART_SIZE = 64 * 2 ** 20
+_DUPLICATE_POLICIES = ("error", "first", "last", "rename")
+# Number of bases packed at once by PackedSequence (a multiple of 4), bounds the size of temporary arrays
+_PACKING_CHUNK = 2 ** 22
+# 2-bit codes of the packed bases, other letters are kept in a side list of runs
+_PACKED_LETTERS = np.frombuffer(b"ACGT", dtype=np.uint8)
+_PACKED_CODES = np.full(256, 255, dtype=np.uint8)
+_PACKED_CODES[_PACKED_LETTERS] = np.arange(4)
+_PACKED_TABLE = _PACKED_CODES.tobytes()
+# number of every 2-bit code in every byte value
+_CODE_COUNTS = np.array([[sum((byte >> shift) & 3 == code for shift in (6, 4, 2, 0)) for byte in range(256)]
+                         for code in range(4)], dtype=np.int64)
+# letters counted as GC and AT by gc_content, the same as in filter_fastq
+_GC_LETTERS = "CGS"
+_AT_LETTERS = "ATWU"
+# Maximal size of the whitespace after the last indexed sequence of a FASTA file whose index is not stale
+_INDEX_TAIL_SIZE = 4096
+_BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def is_gzip_file(filename: str) -> bool:
+    """
+    Checks by magic bytes whether the file is gzip (or BGZF) compressed.
+    :param filename: str, path to the file.
+    :return: bool
+    """
+    with open(filename, mode='rb') as file:
+        return file.read(2) == _GZIP_MAGIC
+
+
+def open_input_file(filename: str, mode: str = 'rb'):
+    """
+    Opens a file for reading, gzip and BGZF files are detected by magic bytes and decompressed on the fly.
+    :param filename: str, path to the file.
+    :param mode: str, 'rb' (default) or 'r' for text mode.
+    :return: file object
+    """
+    if is_gzip_file(filename):
+        return gzip.open(filename, mode if 'b' in mode else 'rt')
+    return open(filename, mode)
+
+
+def _compress_bgzf_block(data: bytes, compress_level: int) -> bytes:
+    """
+    Compresses data into a single BGZF block (gzip member with the 'BC' extra field).
+    :param data: bytes, at most _BGZF_BLOCK_SIZE bytes.
+    :param compress_level: int, zlib compression level.
+    :return: bytes, the block.
+    """
+    compressor = zlib.compressobj(compress_level, zlib.DEFLATED, -15)
+    deflated = compressor.compress(data) + compressor.flush()
+    header = struct.pack("<4BI2BH2BHH", 31, 139, 8, 4, 0, 0, 255, 6, 66, 67, 2, len(deflated) + 25)
+    return header + deflated + struct.pack("<II", zlib.crc32(data), len(data))
+
+
+class BgzfWriter(io.RawIOBase):
+    """
+    Writable file object producing BGZF output, blocks are compressed by a pool of threads.
+    The output is a valid gzip file and can be read by any gzip reader.
+    """
+    def __init__(self, filename: str, compress_level: int = 6, threads: int = None, mode: str = 'wb'):
+        """
+        Initializes a BgzfWriter instance.
+        Args:
+        -filename (str): The name of the output file.
+        -compress_level (int, optional): zlib compression level from 0 to 9, 6 by default.
+        -threads (int, optional): Number of compressing threads, os.cpu_count() by default.
+        -mode (str, optional): 'wb' (default) or 'ab' to add blocks to a file without the end-of-file marker.
+        """
+        super().__init__()
+        self.name = filename
+        self.compress_level = compress_level
+        self.threads = threads or os.cpu_count() or 1
+        self._file = open(filename, mode=mode)
+        self._executor = ThreadPoolExecutor(max_workers=self.threads)
+        self._pending = deque()
+        self._buffer = bytearray()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        """
+        Buffers data and sends every full block to the compressing threads.
+        Returns:
+        -int: Number of bytes written.
+        """
+        self._buffer += data
+        if len(self._buffer) >= _BGZF_BLOCK_SIZE:
+            n_full = len(self._buffer) // _BGZF_BLOCK_SIZE * _BGZF_BLOCK_SIZE
+            for start in range(0, n_full, _BGZF_BLOCK_SIZE):
+                self._submit(bytes(self._buffer[start:start + _BGZF_BLOCK_SIZE]))
+            del self._buffer[:n_full]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        """
+        Sends a block to compression, writes out finished blocks in order
+        so that at most 4 blocks per thread are kept in memory.
+        """
+        self._pending.append(self._executor.submit(_compress_bgzf_block, block, self.compress_level))
+        while len(self._pending) > 4 * self.threads:
+            self._file.write(self._pending.popleft().result())
+
+    def flush(self):
+        """
+        Compresses the buffered data as a (possibly short) block and writes out all the blocks,
+        so that the file ends on a block boundary and can be truncated there.
+        """
+        if self._file.closed:
+            return
+        if self._buffer:
+            self._submit(bytes(self._buffer))
+            self._buffer.clear()
+        while self._pending:
+            self._file.write(self._pending.popleft().result())
+        self._file.flush()
+
+    def close(self):
+        """
+        Compresses the rest of the data, writes the BGZF end-of-file marker and closes the file.
+        """
+        if self.closed:
+            return
+        try:
+            if self._buffer:
+                self._submit(bytes(self._buffer))
+                self._buffer.clear()
+            while self._pending:
+                self._file.write(self._pending.popleft().result())
+            self._file.write(_BGZF_EOF)
+        finally:
+            self._executor.shutdown()
+            self._file.close()
+            super().close()
+
+
+def open_output_file(filename: str, compress_level: int = 6, threads: int = None, mode: str = 'wb'):
+    """
+    Opens a binary file for writing, files with .gz, .bgz or .bgzf extension are BGZF compressed
+    by several threads.
+    :param filename: str, path to the file.
+    :param compress_level: int, compression level from 0 to 9. Default value is 6.
+    :param threads: int, number of compressing threads, os.cpu_count() by default.
+    :param mode: str, 'wb' (default) or 'ab' to continue a file.
+    :return: file object
+    """
+    if filename.endswith(_COMPRESSED_EXTENSIONS):
+        return BgzfWriter(filename, compress_level, threads, mode)
+    return open(filename, mode=mode)
+
+
+def _parse_fasta(fasta_file) -> Iterator[tuple]:
+    """
+    Parses FASTA records of a binary file read by blocks of about _FASTA_BLOCK_SIZE bytes completed
+    to the end of their last line, lines before the first header are skipped. Blocks are split into records
+    on b'\\n>', line breaks are removed from every piece of a sequence at once with bytes.translate
+    and the pieces of a record spanning several blocks are joined once, so the time is linear in the size of the file.
+    :param fasta_file: file object opened in 'rb' mode.
+    :return: iterator of tuples of bytes (header without '>', sequence without line breaks).
+    """
+    header = None  # header of the current record, None before the first one
+    sequence = []
+    while True:
+        block = fasta_file.read(_FASTA_BLOCK_SIZE)
+        if not block:
+            break
+        block += fasta_file.readline()
+        parts = block.split(b'\n>')
+        if block.startswith(b'>'):
+            parts[0] = parts[0][1:]
+        else:
+            if header is not None:
+                sequence.append(parts[0].translate(None, _SEQUENCE_WHITESPACE))
+            del parts[0]
+        for part in parts:
+            if header is not None:
+                yield _take_record(header, sequence)
+            header, _, part_sequence = part.partition(b'\n')
+            header = header.strip()
+            sequence = [part_sequence.translate(None, _SEQUENCE_WHITESPACE)]
+    if header is not None:
+        yield _take_record(header, sequence)
+
+
+def _take_record(header: bytes, sequence: list) -> tuple:
+    """
+    Joins the pieces of a sequence and empties their list, so that they are released
+    before the caller decodes the sequence.
+    """
+    record = (header, b''.join(sequence))
+    sequence.clear()
+    return record
+
+
+def _runs(mask: np.ndarray, values=None) -> tuple:
+    """
+    Finds runs of consecutive True values of a mask (and of equal values if given).
+    :return: tuple of np.ndarray (starts, ends), ends are exclusive.
+    """
+    positions = np.flatnonzero(mask)
+    if not len(positions):
+        return positions, positions
+    breaks = np.diff(positions) != 1
+    if values is not None:
+        breaks |= np.diff(values[positions]) != 0
+    starts = np.flatnonzero(np.r_[True, breaks])
+    ends = np.r_[starts[1:], len(positions)]
+    return positions[starts], positions[ends - 1] + 1
+
+
+def _merge_runs(starts: np.ndarray, ends: np.ndarray, values: np.ndarray) -> tuple:
+    """
+    Merges adjacent runs with equal values (split between the chunks of packing).
+    """
+    if not len(starts):
+        return starts, ends, values
+    keep = np.r_[True, (starts[1:] != ends[:-1]) | (values[1:] != values[:-1])]
+    run_ends = np.r_[ends[np.flatnonzero(keep)[1:] - 1], ends[-1]]
+    return starts[keep], run_ends, values[keep]
+
+
+class PackedSequence:
+    """
+    Nucleotide sequence packed into 2 bits per base (A, C, G, T) in a NumPy uint8 array.
+    Other letters (N and IUPAC codes) are kept in a side list of runs of the same letter and
+    lowercase (soft-masked) regions in a list of runs, so the sequence is decoded without changes.
+    Slicing decodes only the requested region, base counts are calculated on the packed data.
+    """
+    def __init__(self, sequence: bytes):
+        """
+        Packs a sequence.
+        Args:
+        -sequence (bytes or str): The sequence.
+        """
+        if isinstance(sequence, str):
+            sequence = sequence.encode()
+        self.length = len(sequence)
+        empty = np.zeros(0, dtype=np.int64)
+        if self.length <= _PACKING_CHUNK and not sequence.translate(None, b"ACGT"):
+            # short sequences of A, C, G and T only (most reads and amplicons) have no runs to look for
+            codes = np.frombuffer(sequence.translate(_PACKED_TABLE) + bytes(-self.length % 4), dtype=np.uint8)
+            self.packed = (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | codes[3::4]
+            self.run_starts = self.run_ends = self.mask_starts = self.mask_ends = empty
+            self.run_letters = empty.astype(np.uint8)
+            return
+        self.packed = np.zeros((self.length + 3) // 4, dtype=np.uint8)
+        run_parts, mask_parts = [(empty, empty, empty.astype(np.uint8))], [(empty, empty, empty)]
+        for chunk_start in range(0, self.length, _PACKING_CHUNK):
+            chunk = np.frombuffer(sequence, dtype=np.uint8, count=min(_PACKING_CHUNK, self.length - chunk_start),
+                                  offset=chunk_start)
+            lowercase = (chunk >= ord('a')) & (chunk <= ord('z'))
+            letters = chunk - lowercase.astype(np.uint8) * 32
+            codes = _PACKED_CODES[letters]
+            other = codes == 255
+            codes[other] = 0
+            starts, ends = _runs(other, letters)
+            run_parts.append((starts + chunk_start, ends + chunk_start, letters[starts]))
+            starts, ends = _runs(lowercase)
+            mask_parts.append((starts + chunk_start, ends + chunk_start, np.zeros(len(starts), dtype=np.int64)))
+
+            codes = np.r_[codes, np.zeros(-len(codes) % 4, dtype=np.uint8)]
+            self.packed[chunk_start // 4:chunk_start // 4 + len(codes) // 4] = (
+                (codes[0::4] << 6) | (codes[1::4] << 4) | (codes[2::4] << 2) | codes[3::4])
+
+        self.run_starts, self.run_ends, self.run_letters = _merge_runs(*map(np.concatenate, zip(*run_parts)))
+        self.mask_starts, self.mask_ends, _ = _merge_runs(*map(np.concatenate, zip(*mask_parts)))
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory taken by the arrays of the sequence.
+        """
+        return sum(array.nbytes for array in (self.packed, self.run_starts, self.run_ends, self.run_letters,
+                                              self.mask_starts, self.mask_ends))
+
+    def __len__(self) -> int:
+        return self.length
+
+    def _codes(self, start: int, end: int) -> np.ndarray:
+        """
+        Unpacks the 2-bit codes of the bases from start to end (other letters are unpacked as 0).
+        """
+        block = self.packed[start // 4:(end + 3) // 4]
+        codes = np.empty(4 * len(block), dtype=np.uint8)
+        for i, shift in enumerate((6, 4, 2, 0)):
+            codes[i::4] = (block >> shift) & 3
+        return codes[start % 4:start % 4 + end - start]
+
+    @staticmethod
+    def _overlaps(starts: np.ndarray, ends: np.ndarray, start: int, end: int) -> tuple:
+        """
+        Clips the runs overlapping the region from start to end to it.
+        :return: tuple (indices of the runs, clipped starts, clipped ends).
+        """
+        first = np.searchsorted(ends, start, side='right')
+        last = np.searchsorted(starts, end, side='left')
+        return (np.arange(first, last), np.maximum(starts[first:last], start),
+                np.minimum(ends[first:last], end))
+
+    def decode(self, start: int = 0, end: int = None) -> bytes:
+        """
+        Decodes a region of the sequence.
+        Args:
+        -start (int, optional): 0-based start of the region, 0 by default.
+        -end (int, optional): End of the region (exclusive), the end of the sequence by default.
+        Returns:
+        -bytes: The sequence of the region.
+        """
+        start, end, _ = slice(start, end).indices(self.length)
+        if start >= end:
+            return b''
+        letters = _PACKED_LETTERS[self._codes(start, end)]
+        indices, run_starts, run_ends = self._overlaps(self.run_starts, self.run_ends, start, end)
+        for letter, run_start, run_end in zip(self.run_letters[indices].tolist(), run_starts.tolist(),
+                                              run_ends.tolist()):
+            letters[run_start - start:run_end - start] = letter
+        _, mask_starts, mask_ends = self._overlaps(self.mask_starts, self.mask_ends, start, end)
+        for mask_start, mask_end in zip(mask_starts.tolist(), mask_ends.tolist()):
+            letters[mask_start - start:mask_end - start] |= 0x20
+        return letters.tobytes()
+
+    def __getitem__(self, item) -> str:
+        """
+        Decodes a base (by index) or a region (by slice) of the sequence.
+        """
+        if isinstance(item, slice):
+            positions = range(*item.indices(self.length))
+            if not positions:
+                return ''
+            # decodes the region between the first and the last position and takes every step-th base of it
+            lower, upper = min(positions[0], positions[-1]), max(positions[0], positions[-1]) + 1
+            return self.decode(lower, upper).decode()[positions[0] - lower::positions.step]
+        if not -self.length <= item < self.length:
+            raise IndexError("PackedSequence index out of range")
+        item %= self.length
+        return self.decode(item, item + 1).decode()
+
+    def __str__(self) -> str:
+        return self.decode().decode()
+
+    def __repr__(self) -> str:
+        return f"PackedSequence(length={self.length}, seq='{self[:20]}...')"
+
+    def base_counts(self, start: int = 0, end: int = None) -> dict:
+        """
+        Counts the bases (case-insensitive) of a region of the sequence.
+        The 2-bit codes of whole bytes are counted with lookup tables, without unpacking.
+        Args:
+        -start (int, optional): 0-based start of the region, 0 by default.
+        -end (int, optional): End of the region (exclusive), the end of the sequence by default.
+        Returns:
+        -dict: Letter -> number, A, C, G and T are always present.
+        """
+        start, end, _ = slice(start, end).indices(self.length)
+        end = max(end, start)  # a region ending before its start is empty
+        counts = np.zeros(4, dtype=np.int64)
+        if start < end:
+            first_byte, last_byte = -(-start // 4), end // 4
+            if first_byte < last_byte:
+                # a histogram of the byte values times the number of every code in every value
+                counts += _CODE_COUNTS @ np.bincount(self.packed[first_byte:last_byte], minlength=256)
+                edges = self._codes(start, 4 * first_byte), self._codes(4 * last_byte, end)
+            else:
+                edges = (self._codes(start, end),)
+            for edge in edges:
+                counts += np.bincount(edge, minlength=4)
+
+        result = dict(zip("ACGT", counts.tolist()))
+        indices, run_starts, run_ends = self._overlaps(self.run_starts, self.run_ends, start, end)
+        other = np.bincount(self.run_letters[indices], weights=run_ends - run_starts, minlength=256)
+        # positions of other letters are packed as A
+        result["A"] -= int(other.sum())
+        for letter in np.flatnonzero(other).tolist():
+            result[chr(letter)] = result.get(chr(letter), 0) + int(other[letter])
+        return result
+
+    def gc_content(self, start: int = 0, end: int = None) -> float:
+        """
+        Calculates GC content of a region of the sequence from its base counts (S counts as GC,
+        W and U as AT, other ambiguous letters are not counted, the same as in filter_fastq).
+        Returns:
+        -float: GC content from 0 to 1, 0 if there are no such letters.
+        """
+        counts = self.base_counts(start, end)
+        gc_count = sum(counts.get(letter, 0) for letter in _GC_LETTERS)
+        known_count = gc_count + sum(counts.get(letter, 0) for letter in _AT_LETTERS)
+        return gc_count / known_count if known_count else 0.0
+
+
+class PackedFasta(Mapping):
+    """
+    Read-only dictionary of sequence names to PackedSequence objects returned by read_fasta_file(packed=True).
+    """
+    def __init__(self, sequences: dict):
+        """
+        Initializes a PackedFasta instance.
+        Args:
+        -sequences (dict): Sequence name -> PackedSequence.
+        """
+        self.sequences = sequences
+
+    def __getitem__(self, name: str) -> PackedSequence:
+        return self.sequences[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.sequences)
+
+    def __len__(self) -> int:
+        return len(self.sequences)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory taken by the arrays of all sequences.
+        """
+        return sum(sequence.nbytes for sequence in self.sequences.values())
+
+    def base_counts(self) -> dict:
+        """
+        Counts the bases of all sequences, see PackedSequence.base_counts.
+        """
+        total = {}
+        for sequence in self.sequences.values():
+            for letter, count in sequence.base_counts().items():
+                total[letter] = total.get(letter, 0) + count
+        return total
+
+    def gc_content(self) -> dict:
+        """
+        Calculates GC content of every sequence, see PackedSequence.gc_content.
+        Returns:
+        -dict: Sequence name -> GC content.
+        """
+        return {name: sequence.gc_content() for name, sequence in self.sequences.items()}
+
+
+def read_fasta_file(input_fasta: str, packed: bool = False):
     """
-    Reads fasta file and saves it to dictionary
+    Reads fasta file and saves it to dictionary, gzip compressed files are supported.
     :param input_fasta: str, fasta file
+    :param packed: bool, if True, sequences are packed into 2 bits per base and returned as PackedFasta,
+    a read-only dictionary of PackedSequence objects which are decoded on slicing. Default value is False.
     :return dict, fasta dictionary
     """
-    with open(os.path.abspath(input_fasta), mode='r') as fasta_file:
-        fasta_data = {}
-        current_name = None
-        seq = []
-        for line in fasta_file:
-            line.strip()
-            if line.startswith('>'):
-                if current_name is not None:
-                    fasta_data[current_name] = ''.join(seq)
-                current_name = line.strip('>').strip()
-                seq = []
-            else:
-                seq.append(line.strip())
-        fasta_data[current_name] = ''.join(seq)
-    return fasta_data
+    with open_input_file(os.path.abspath(input_fasta)) as fasta_file:
+        fasta_data = dict(_fasta_items(fasta_file, packed))
+    return PackedFasta(fasta_data) if packed else fasta_data
+
+
+def _fasta_items(fasta_file, packed: bool) -> Iterator[tuple]:
+    """
+    Parses FASTA records into the items of read_fasta_file.
+    :param fasta_file: file object opened in 'rb' mode.
+    :param packed: bool, if True, sequences are PackedSequence objects, otherwise str.
+    :return: iterator of tuples (name, sequence).
+    """
+    for header, seq in _parse_fasta(fasta_file):
+        yield header.decode().strip('>').strip(), PackedSequence(seq) if packed else seq.decode()
+
+
+def _next_fasta_record(fasta_file, offset: int) -> int:
+    """
+    Finds the first FASTA record which starts at or after the given byte offset (a line starting with '>').
+    :param fasta_file: file object opened in 'rb' mode.
+    :param offset: int, byte offset to start the search from.
+    :return: int, byte offset of the record start, or of the end of file if there are no more records.
+    """
+    fasta_file.seek(offset - 1)
+    position = offset - 1
+    tail = b''
+    while True:
+        block = fasta_file.read(_FASTA_BLOCK_SIZE)
+        if not block:
+            return position + len(tail)
+        found = (tail + block).find(b'\n>')
+        if found >= 0:
+            return position + found + 1
+        position += len(tail) + len(block) - 1
+        tail = block[-1:]
+
+
+def _fasta_parts(input_fasta: str, part_size: int) -> list:
+    """
+    Splits a FASTA file into parts of about part_size bytes on record boundaries,
+    compressed files are read as a whole.
+    :return: list of tuples (path, start, end), end is None for a whole compressed file.
+    """
+    if is_gzip_file(input_fasta):
+        return [(input_fasta, 0, None)]
+    file_size = os.path.getsize(input_fasta)
+    bounds = [0]
+    with open(input_fasta, mode='rb') as fasta_file:
+        while bounds[-1] + part_size < file_size:
+            # searching from the previous boundary keeps the scan linear when records are longer than parts
+            start = _next_fasta_record(fasta_file, bounds[-1] + part_size)
+            if start >= file_size:
+                break
+            bounds.append(start)
+    bounds.append(file_size)
+    return [(input_fasta, start, end) for start, end in zip(bounds[:-1], bounds[1:])]
+
+
+def _read_fasta_part(input_fasta: str, start: int, end, packed: bool) -> list:
+    """
+    Reads the records of a part of a FASTA file made by _fasta_parts.
+    :return: list of tuples (name, sequence), see _fasta_items.
+    """
+    if end is None:
+        with open_input_file(input_fasta) as fasta_file:
+            return list(_fasta_items(fasta_file, packed))
+    with open(input_fasta, mode='rb') as fasta_file:
+        fasta_file.seek(start)
+        return list(_fasta_items(io.BytesIO(fasta_file.read(end - start)), packed))
+
+
+def read_fasta_files(input_fastas, n_jobs: int = None, duplicates: str = "error", packed: bool = False,
+                     part_size: int = _FASTA_PART_SIZE):
+    """
+    Reads several FASTA files into one dictionary with a pool of processes,
+    large uncompressed files are split into parts on record boundaries and read in parallel as well.
+    The result is the same as reading the files one after another with read_fasta_file.
+    :param input_fastas: list of str (paths) or str (a path or a glob pattern such as 'assemblies/*.fasta',
+    matching files are read in sorted order).
+    :param n_jobs: int, number of processes, os.cpu_count() by default. With 1 the files are read in this process.
+    :param duplicates: str, what to do with a name seen before (in the same or in another file):
+    "error" (default) raises ValueError, "first" keeps the first sequence, "last" keeps the last one
+    (as consecutive read_fasta_file calls merged with dict.update), "rename" adds the suffix _2, _3, ...
+    :param packed: bool, if True, sequences are packed in the worker processes and PackedFasta is returned,
+    see read_fasta_file. Default value is False.
+    :param part_size: int, approximate size in bytes of the parts of uncompressed files. Default value is 64 MiB.
+    :return: dict (or PackedFasta), fasta dictionary.
+    """
+    if duplicates not in _DUPLICATE_POLICIES:
+        raise ValueError(f"Unknown duplicates policy '{duplicates}', possible values are: "
+                         f"{', '.join(_DUPLICATE_POLICIES)}")
+    if not isinstance(part_size, int) or part_size < 1:
+        raise ValueError("part_size must be a positive number of bytes")
+    if isinstance(input_fastas, str):
+        paths = sorted(glob.glob(input_fastas))
+        if not paths:
+            raise ValueError(f"No files match '{input_fastas}'")
+    else:
+        paths = list(input_fastas)
+
+    parts = [part for path in paths for part in _fasta_parts(os.path.abspath(path), part_size)]
+    n_jobs = min(n_jobs or os.cpu_count() or 1, len(parts))
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            part_items = list(executor.map(_read_fasta_part, *zip(*parts), [packed] * len(parts)))
+    else:
+        part_items = (_read_fasta_part(*part, packed) for part in parts)
+
+    fasta_data = {}
+    for items in part_items:
+        for name, seq in items:
+            if name in fasta_data:
+                if duplicates == "error":
+                    raise ValueError(f"Duplicate sequence name '{name}'")
+                if duplicates == "first":
+                    continue
+                if duplicates == "rename":
+                    number = 2
+                    while f"{name}_{number}" in fasta_data:
+                        number += 1
+                    name = f"{name}_{number}"
+            fasta_data[name] = seq
+    return PackedFasta(fasta_data) if packed else fasta_data
 
 
 def write_fasta_file(fasta_data: dict, output_fasta: str):
@@ -36,7 +600,7 @@ def write_fasta_file(fasta_data: dict, output_fasta: str):
     with open(output_fasta, mode='w') as file:
         for seq_id, seq in fasta_data.items():
             file.write('>' + seq_id + '\n')
-            file.write(seq + '\n')
+            file.write(str(seq) + '\n')
 
 
 def convert_multiline_fasta_to_oneline(input_fasta: str, output_fasta=None):
@@ -108,21 +672,199 @@ class FastaRecord:
         return f"id='{self.id}', description='{self.description[:20]}...', seq='{self.seq[:20]}...'"
 
 
+class CompactFastaRecord:
+    """
+    Memory-efficient variant of FastaRecord storing the raw header and sequence as bytes in slots,
+    id, seq and description are decoded on every access.
+    """
+    __slots__ = ('header', 'raw_seq')
+
+    def __init__(self, header: bytes, raw_seq: bytes):
+        """
+        Initializes a CompactFastaRecord instance.
+        Args:
+        -header (bytes): The header line without '>' and line break.
+        -raw_seq (bytes): The sequence without line breaks.
+        """
+        self.header = header
+        self.raw_seq = raw_seq
+
+    @classmethod
+    def from_record(cls, record: FastaRecord) -> 'CompactFastaRecord':
+        """
+        Makes a CompactFastaRecord with the same fields as a FastaRecord.
+        """
+        header = f"{record.id} {record.description}" if record.description else record.id
+        return cls(header.encode(), record.seq.encode())
+
+    @property
+    def id(self) -> str:
+        fields = self.header.split(maxsplit=1)
+        return fields[0].strip(b'>').decode() if fields else ''
+
+    @id.setter
+    def id(self, value: str):
+        self.header = f"{value} {self.description}".rstrip().encode()
+
+    @property
+    def description(self) -> str:
+        return ' '.join(self.header.decode().split()[1:])
+
+    @description.setter
+    def description(self, value: str):
+        self.header = f"{self.id} {value}".rstrip().encode()
+
+    @property
+    def seq(self) -> str:
+        return self.raw_seq.decode()
+
+    @seq.setter
+    def seq(self, value: str):
+        self.raw_seq = value.encode()
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, (FastaRecord, CompactFastaRecord)):
+            return (self.id, self.seq, self.description) == (other.id, other.seq, other.description)
+        return NotImplemented
+
+    def __repr__(self) -> str:
+        """
+        Returns short string representation of the record, the same as for FastaRecord.
+        """
+        return (f"id='{self.id}', description='{self.description[:20]}...', "
+                f"seq='{self.raw_seq[:20].decode(errors='replace')}...'")
+
+
+@dataclass
+class FastaIndexEntry:
+    """
+    A line of a FASTA index (.fai, the format of samtools faidx) describing where a sequence is in the file.
+    """
+    name: str
+    length: int
+    offset: int
+    line_bases: int
+    line_width: int
+
+    def byte_offset(self, position: int) -> int:
+        """
+        Returns the offset in the file of the base at a 0-based position of the sequence.
+        """
+        if not self.line_bases:
+            return self.offset
+        return self.offset + position // self.line_bases * self.line_width + position % self.line_bases
+
+
+def build_fasta_index(input_fasta: str, index_path=None) -> dict:
+    """
+    Builds a samtools faidx compatible index of an uncompressed FASTA file and writes it to a .fai file.
+    All sequence lines of a record except the last one must have the same length.
+    :param input_fasta: str, path to the FASTA file.
+    :param index_path: str, path of the index file, <input_fasta>.fai by default.
+    :return: dict, sequence name -> FastaIndexEntry.
+    Raises ValueError for compressed files, duplicate names and records with lines of different lengths.
+    """
+    if is_gzip_file(input_fasta):
+        raise ValueError("Compressed FASTA files cannot be indexed")
+
+    index = {}
+    entry = None
+    last_line = False
+    offset = 0
+    with open(input_fasta, mode='rb') as fasta_file:
+        for line in fasta_file:
+            line_width = len(line)
+            offset += line_width
+            if line.startswith(b'>'):
+                name = line[1:].split(maxsplit=1)[0].decode() if line[1:].strip() else ''
+                if name in index:
+                    raise ValueError(f"Duplicate sequence name '{name}'")
+                entry = index[name] = FastaIndexEntry(name, 0, offset, 0, 0)
+                last_line = False
+                continue
+            line_bases = len(line.rstrip(b'\r\n'))
+            if entry is None:
+                if line_bases:
+                    raise ValueError("FASTA file does not start with a header line")
+                continue
+            if not line_bases:
+                last_line = entry.length > 0
+                continue
+            if last_line:
+                raise ValueError(f"Sequence '{entry.name}' has lines of different lengths")
+            if not entry.line_bases:
+                entry.line_bases, entry.line_width = line_bases, line_width
+            elif line_bases > entry.line_bases or line_width - line_bases != entry.line_width - entry.line_bases:
+                raise ValueError(f"Sequence '{entry.name}' has lines of different lengths")
+            # a shorter line may only be the last line of the record
+            last_line = line_bases < entry.line_bases
+            entry.length += line_bases
+
+    with open(index_path or input_fasta + '.fai', mode='w') as index_file:
+        for entry in index.values():
+            index_file.write(f"{entry.name}\t{entry.length}\t{entry.offset}\t{entry.line_bases}\t{entry.line_width}\n")
+    return index
+
+
+def _index_is_stale(input_fasta: str, index_path: str, index: dict) -> bool:
+    """
+    Checks whether the FASTA file was modified after its index was written:
+    it is newer than the index or its size does not fit the end of the last indexed sequence.
+    """
+    if os.path.getmtime(input_fasta) > os.path.getmtime(index_path):
+        return True
+    if not index:
+        return os.path.getsize(input_fasta) > 0
+    last = max(index.values(), key=lambda entry: entry.offset)
+    last_end = last.byte_offset(last.length - 1) + 1 if last.length else last.offset
+    size = os.path.getsize(input_fasta)
+    if not last_end <= size <= last_end + _INDEX_TAIL_SIZE:
+        return True
+    # the last sequence may only be followed by line breaks and empty lines
+    with open(input_fasta, mode='rb') as fasta_file:
+        fasta_file.seek(last_end)
+        return bool(fasta_file.read().strip())
+
+
+def load_fasta_index(input_fasta: str) -> dict:
+    """
+    Reads the <input_fasta>.fai index, the index is built (again) if it is missing or stale.
+    :param input_fasta: str, path to an uncompressed FASTA file.
+    :return: dict, sequence name -> FastaIndexEntry.
+    """
+    index_path = input_fasta + '.fai'
+    if os.path.exists(index_path):
+        with open(index_path) as index_file:
+            index = {}
+            for line in index_file:
+                name, length, offset, line_bases, line_width = line.rstrip('\n').split('\t')[:5]
+                index[name] = FastaIndexEntry(name, int(length), int(offset), int(line_bases), int(line_width))
+        if not _index_is_stale(input_fasta, index_path, index):
+            return index
+    return build_fasta_index(input_fasta, index_path)
+
+
 class OpenFasta:
     """
-    Context manager for reading FASTA files.
+    Context manager for reading FASTA files, gzip compressed files are supported.
     """
-    def __init__(self, filename: str, mode: str = 'r'):
+    def __init__(self, filename: str, mode: str = 'r', compact: bool = False):
         """
         Initializes an OpenFasta instance.
         Args:
         -filename (str): The name of the FASTA file.
-        -mode (str, optional): The mode in which the file is opened ('r' for reading by default).
+        -mode (str, optional): The mode in which the file is opened ('r' for reading by default),
+        with 'rb' the fields of the records are not decoded and stay bytes.
+        -compact (bool, optional): If True, CompactFastaRecord objects are returned instead of FastaRecord
+        (False by default).
         """
         self.filename = filename
         self.mode = mode
+        self.compact = compact
         self.file_handle = None
-        self.current = None
+        self.records = None
+        self.index = None
+        self._fetch_handle = None
 
     def __enter__(self) -> 'OpenFasta':
         """
@@ -130,7 +872,8 @@ class OpenFasta:
         Returns:
         -OpenFasta: The OpenFasta instance.
         """
-        self.file_handle = open(self.filename, self.mode)
+        self.file_handle = open_input_file(self.filename)
+        self.records = _parse_fasta(self.file_handle)
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
@@ -143,6 +886,9 @@ class OpenFasta:
         """
         if self.file_handle:
             self.file_handle.close()
+        if self._fetch_handle:
+            self._fetch_handle.close()
+            self._fetch_handle = None
 
     def __iter__(self) -> Iterator[FastaRecord]:
         """
@@ -156,44 +902,18 @@ class OpenFasta:
         """
         Retrieves the next FASTA record from the file.
         Returns:
-        -FastaRecord: A FastaRecord object representing a single record.
+        -FastaRecord: A FastaRecord (or CompactFastaRecord) object representing a single record.
         Raises:
         -StopIteration: If there are no more records in the file.
         """
-        if self.current is None:
-            line = self.file_handle.readline()
-        else:
-            line = self.current
-            self.current = None
-
-        if not line:
-            raise StopIteration
-
-        record_id = None
-        sequence = ""
-        description = ""
-
-        while line:
-            line = line.strip()
-            if line.startswith(">"):
-                if record_id is not None:
-                    self.current = line
-                    return FastaRecord(record_id, sequence, description)
-                else:
-                    description = ' '.join(line.split()[1:])
-                    record_id = line.split()[0].strip('>')
-            else:
-                sequence += line
-
-            if self.current is None:
-                line = self.file_handle.readline()
-            else:
-                break
-
-        if record_id:
-            return FastaRecord(record_id, sequence, description)
-
-        raise StopIteration
+        header, sequence = next(self.records)
+        if self.compact:
+            return CompactFastaRecord(header, sequence)
+        fields = header.split()
+        record = (fields[0].strip(b'>') if fields else b'', sequence, b' '.join(fields[1:]))
+        if 'b' not in self.mode:
+            record = (field.decode() for field in record)
+        return FastaRecord(*record)
 
     def read_record(self) -> FastaRecord:
         """
@@ -210,3 +930,33 @@ class OpenFasta:
         -List[FastaRecord]: A list of FastaRecord objects representing all records in the file.
         """
         return list(self)
+
+    def fetch(self, seq_id: str, start: int = 0, end: int = None) -> str:
+        """
+        Reads a region of a sequence by seeking directly to it, without reading the rest of the file.
+        The .fai index of the file is loaded (or built) on the first call, see load_fasta_index.
+        Args:
+        -seq_id (str): The name of the sequence (the first word of its header).
+        -start (int, optional): 0-based start of the region, 0 by default.
+        -end (int, optional): End of the region (exclusive), the end of the sequence by default.
+        Returns:
+        -str: The sequence of the region, shorter than requested if the region exceeds the sequence.
+        Raises:
+        -KeyError: If there is no sequence with this name.
+        """
+        if self.index is None:
+            self.index = load_fasta_index(self.filename)
+        if seq_id not in self.index:
+            raise KeyError(f"Sequence '{seq_id}' is not in {self.filename}")
+        entry = self.index[seq_id]
+        start = min(max(start, 0), entry.length)
+        end = entry.length if end is None else min(max(end, start), entry.length)
+        if start == end:
+            return ""
+
+        if self._fetch_handle is None:
+            self._fetch_handle = open(self.filename, mode='rb')
+        byte_start = entry.byte_offset(start)
+        self._fetch_handle.seek(byte_start)
+        data = self._fetch_handle.read(entry.byte_offset(end - 1) + 1 - byte_start)
+        return data.translate(None, b'\r\n').decode()
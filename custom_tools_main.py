@@ -3,18 +3,2058 @@ import io
 import os
 import re
 import sys
+import json
+import gzip
+import mmap
+import math
+import hashlib
+import logging
+import time
+import queue
 import datetime
+import warnings
+import threading
+import numpy as np
+from collections import deque
+from contextlib import ExitStack
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice, zip_longest
 from Bio import SeqIO
 from Bio.SeqUtils import gc_fraction as gc
-from dataclasses import dataclass
+from dataclasses import dataclass, field, replace
 from bs4 import BeautifulSoup
 from dotenv import load_dotenv
+from typing import Iterator
+from bio_files_processor import open_input_file, open_output_file
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional, per-read metrics are written as CSV without it
+    pa = pq = None
+
+
+# Letters counted by Bio.SeqUtils.gc_fraction with the default ambiguous="remove"
+_GC_LETTERS = b"CGScgs"
+_AT_LETTERS = b"ATWUatwu"
+_PHRED_OFFSET = 33
+# Bio.SeqIO formats of the supported quality encodings (Phred+33 Sanger / Illumina 1.8+, Phred+64 Illumina 1.3-1.7)
+_SEQIO_FORMATS = {33: "fastq", 64: "fastq-illumina"}
+# Number of reads used to detect the quality encoding with phred_offset="auto"
+_PHRED_DETECTION_READS = 10_000
+# Range of FASTQ quality characters and the number of them summed between the early exit checks of the quality
+# condition of the per-read engines (reads up to this length are summed at once)
+_QUALITY_CHARS = (ord("!"), ord("~"))
+_QUALITY_STEP = 64
+# Number of blocks waiting between the stages of filter_fastq(pipeline=True), 2 gives double buffering
+_PIPELINE_QUEUE_SIZE = 2
+# Size of the data collected before the records are routed to output shards and of the per-bin buffers,
+# and the upper limits of the values binned by filter_fastq(bin_by=...)
+_SHARD_BUFFER_SIZE = 2 ** 20
+_BIN_UPPER_LIMITS = {"gc": 1, "length": math.inf}
+# Approximate size of the input chunks filtered by one worker of filter_fastq(n_jobs > 1)
+# and of the windows scanned at once by the "mmap" engine
+_CHUNK_SIZE = 32 * 2 ** 20
+
+# bytes.translate tables turning GC (AT) letters into 1 and everything else into 0
+_GC_TABLE = bytes(int(i in _GC_LETTERS) for i in range(256))
+_AT_TABLE = bytes(int(i in _AT_LETTERS) for i in range(256))
+# the same tables as arrays for buffers without bytes.translate (memory-mapped files), which are looked up
+# by groups of sequences spanning about _LOOKUP_SIZE bytes
+_GC_LOOKUP = np.frombuffer(_GC_TABLE, dtype=np.uint8)
+_AT_LOOKUP = np.frombuffer(_AT_TABLE, dtype=np.uint8)
+_LOOKUP_SIZE = 2 ** 20
+
+
+def _passes_filters(seq_len: int, gc_content: float, quality: float,
+                    gc_bounds=None, length_bounds=(0, 2 ** 32), quality_threshold=0) -> bool:
+    """
+    Checks a single read's metrics against the filtration bounds of filter_fastq.
+    :param seq_len: int, length of the read.
+    :param gc_content: float, GC fraction of the read.
+    :param quality: float, mean phred quality of the read.
+    :return: bool, True if the read passes all the conditions.
+    """
+    # Working with GC-bounds
+    if gc_bounds is not None:
+        if isinstance(gc_bounds, tuple):
+            if not (gc_bounds[0] <= gc_content <= gc_bounds[1]):
+                return False
+        else:
+            if not gc_content <= gc_bounds:
+                return False
+
+    # Working with length-bounds
+    if isinstance(length_bounds, tuple):
+        if not (length_bounds[0] <= seq_len <= length_bounds[1]):
+            return False
+    else:
+        if not seq_len <= length_bounds:
+            return False
+
+    # Working with quality threshold-bounds
+    return quality >= quality_threshold
+
+
+def _in_bounds(value, bounds):
+    """
+    Checks a value against bounds given as a tuple (lower, upper) or as an upper limit.
+    :param value: number or np.ndarray.
+    :return: bool or np.ndarray of bool.
+    """
+    if isinstance(bounds, tuple):
+        return (bounds[0] <= value) & (value <= bounds[1])
+    return value <= bounds
+
+
+def _check_criteria(seq_len: int, gc_content: float, quality: float,
+                    gc_bounds=None, length_bounds=(0, 2 ** 32), quality_threshold=0) -> tuple:
+    """
+    Checks every condition of filter_fastq separately, used to count rejection reasons.
+    :return: tuple of bool (gc_passed, length_passed, quality_passed).
+    """
+    gc_passed = gc_bounds is None or _in_bounds(gc_content, gc_bounds)
+    return gc_passed, _in_bounds(seq_len, length_bounds), quality >= quality_threshold
+
+
+def _criteria_masks(seq_lens: np.ndarray, gc_content: np.ndarray, quality: np.ndarray,
+                    gc_bounds=None, length_bounds=(0, 2 ** 32), quality_threshold=0) -> tuple:
+    """
+    Vectorized version of _check_criteria for a batch of reads.
+    :return: tuple of np.ndarray of bool (gc_passed, length_passed, quality_passed).
+    """
+    if gc_bounds is None:
+        gc_passed = np.ones(len(seq_lens), dtype=bool)
+    else:
+        gc_passed = _in_bounds(gc_content, gc_bounds)
+    return gc_passed, _in_bounds(seq_lens, length_bounds), quality >= quality_threshold
+
+
+def _filter_mask(seq_lens: np.ndarray, gc_content: np.ndarray, quality: np.ndarray,
+                 gc_bounds=None, length_bounds=(0, 2 ** 32), quality_threshold=0) -> np.ndarray:
+    """
+    Vectorized version of _passes_filters for a batch of reads.
+    :param seq_lens: np.ndarray, lengths of the reads.
+    :param gc_content: np.ndarray, GC fractions of the reads.
+    :param quality: np.ndarray, mean phred qualities of the reads.
+    :return: np.ndarray of bool, True for the reads which pass all the conditions.
+    """
+    gc_passed, length_passed, quality_passed = _criteria_masks(seq_lens, gc_content, quality, gc_bounds,
+                                                               length_bounds, quality_threshold)
+    return gc_passed & length_passed & quality_passed
+
+
+@dataclass
+class FastqStats:
+    """
+    QC statistics of a filter_fastq run. Histograms have a fixed number of bins,
+    so memory usage does not depend on the number of reads.
+
+    Attributes:
+    -length_bin_width (int): Width of the length histogram bins, 10 by default.
+    -n_length_bins (int): Number of length bins, the last one collects all longer reads. 100 by default.
+    -n_gc_bins (int): Number of GC content bins between 0 and 1. 20 by default.
+    -n_quality_bins (int): Number of mean quality bins of width 1, the last one collects all higher values.
+    60 by default.
+    -histograms (bool): If False, only the counts are collected. Conditions are then checked cheapest first
+    (length, GC content, quality) and stop at the first failed one, so a rejected read is counted only for
+    the first condition it failed and the histograms stay empty. True by default.
+    -total_reads (int): Number of processed reads.
+    -passed_reads (int): Number of reads which passed all the conditions.
+    -duplicate_reads (int): Number of reads which passed all the conditions but were removed as duplicates.
+    -rejected (dict): Number of reads which failed the "gc", "length" and "quality" conditions,
+    a read failing several conditions is counted for each of them. Without histograms only the first
+    failed condition of a read is counted.
+    -skipped (dict): Work saved by the cheapest first order (only without histograms): number of reads whose
+    "gc" content or "quality" was not calculated as they failed an earlier condition, and number of reads
+    whose quality condition was decided before the end of the quality string ("quality_partial", counted by
+    the seqio and raw engines only, the numpy and mmap engines sum the whole quality strings of a batch at once).
+    -length_histogram, gc_histogram, quality_histogram (np.ndarray): Counts of all processed reads per bin.
+    -pipeline (dict): Seconds spent by the "read", "compute" and "write" stages of filter_fastq(pipeline=True)
+    working ("busy") and blocked while waiting for the previous stage ("waiting_input") or for the next one
+    ("waiting_output"). None for runs without the pipeline.
+    """
+    length_bin_width: int = 10
+    n_length_bins: int = 100
+    n_gc_bins: int = 20
+    n_quality_bins: int = 60
+    histograms: bool = True
+    total_reads: int = 0
+    passed_reads: int = 0
+    duplicate_reads: int = 0
+    rejected: dict = field(default_factory=lambda: {"gc": 0, "length": 0, "quality": 0})
+    skipped: dict = field(default_factory=lambda: {"gc": 0, "quality": 0, "quality_partial": 0})
+    pipeline: dict = None
+    length_histogram: np.ndarray = field(init=False)
+    gc_histogram: np.ndarray = field(init=False)
+    quality_histogram: np.ndarray = field(init=False)
+
+    def __post_init__(self):
+        self.length_histogram = np.zeros(self.n_length_bins, dtype=np.int64)
+        self.gc_histogram = np.zeros(self.n_gc_bins, dtype=np.int64)
+        self.quality_histogram = np.zeros(self.n_quality_bins, dtype=np.int64)
+
+    def add_read(self, seq_len: int, gc_content: float, quality: float, criteria: tuple):
+        """
+        Adds a single read.
+        Args:
+        -criteria (tuple): (gc_passed, length_passed, quality_passed) from _check_criteria.
+        """
+        self.total_reads += 1
+        self.length_histogram[min(seq_len // self.length_bin_width, self.n_length_bins - 1)] += 1
+        self.gc_histogram[min(int(gc_content * self.n_gc_bins), self.n_gc_bins - 1)] += 1
+        self.quality_histogram[min(max(int(quality), 0), self.n_quality_bins - 1)] += 1
+        if all(criteria):
+            self.passed_reads += 1
+        for reason, passed in zip(("gc", "length", "quality"), criteria):
+            if not passed:
+                self.rejected[reason] += 1
+
+    def add_batch(self, seq_lens: np.ndarray, gc_content: np.ndarray, quality: np.ndarray, criteria: tuple):
+        """
+        Adds a batch of reads at once.
+        Args:
+        -criteria (tuple): np.ndarray masks (gc_passed, length_passed, quality_passed) from _criteria_masks.
+        """
+        self.total_reads += len(seq_lens)
+        self.length_histogram += np.bincount(np.minimum(seq_lens // self.length_bin_width, self.n_length_bins - 1),
+                                             minlength=self.n_length_bins)
+        gc_bins = np.minimum((gc_content * self.n_gc_bins).astype(np.int64), self.n_gc_bins - 1)
+        self.gc_histogram += np.bincount(gc_bins, minlength=self.n_gc_bins)
+        quality_bins = np.clip(quality.astype(np.int64), 0, self.n_quality_bins - 1)
+        self.quality_histogram += np.bincount(quality_bins, minlength=self.n_quality_bins)
+        self.passed_reads += int(np.count_nonzero(criteria[0] & criteria[1] & criteria[2]))
+        for reason, passed in zip(("gc", "length", "quality"), criteria):
+            self.rejected[reason] += len(passed) - int(np.count_nonzero(passed))
+
+    def empty_copy(self) -> 'FastqStats':
+        """
+        Returns new FastqStats with the same bins and no reads.
+        """
+        return FastqStats(self.length_bin_width, self.n_length_bins, self.n_gc_bins, self.n_quality_bins,
+                          self.histograms)
+
+    def merge(self, other: 'FastqStats'):
+        """
+        Adds statistics collected by another FastqStats object with the same bins.
+        """
+        self.total_reads += other.total_reads
+        self.passed_reads += other.passed_reads
+        self.duplicate_reads += other.duplicate_reads
+        for reason, count in other.rejected.items():
+            self.rejected[reason] += count
+        for stage, count in other.skipped.items():
+            self.skipped[stage] += count
+        self.length_histogram += other.length_histogram
+        self.gc_histogram += other.gc_histogram
+        self.quality_histogram += other.quality_histogram
+
+    def to_dict(self) -> dict:
+        """
+        Returns the statistics as a dictionary which can be saved as JSON.
+        """
+        result = {
+            "total_reads": self.total_reads,
+            "passed_reads": self.passed_reads,
+            "duplicate_reads": self.duplicate_reads,
+            "rejected": dict(self.rejected),
+        }
+        if self.pipeline is not None:
+            result["pipeline"] = self.pipeline
+        if not self.histograms:
+            result["skipped"] = dict(self.skipped)
+            return result
+        result["length_histogram"] = {"bin_width": self.length_bin_width, "counts": self.length_histogram.tolist()}
+        result["gc_histogram"] = {"bin_width": 1 / self.n_gc_bins, "counts": self.gc_histogram.tolist()}
+        result["quality_histogram"] = {"bin_width": 1, "counts": self.quality_histogram.tolist()}
+        return result
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'FastqStats':
+        """
+        Makes FastqStats from a dictionary made by to_dict.
+        """
+        if "length_histogram" in data:
+            stats = cls(data["length_histogram"]["bin_width"], len(data["length_histogram"]["counts"]),
+                        len(data["gc_histogram"]["counts"]), len(data["quality_histogram"]["counts"]))
+            stats.length_histogram += data["length_histogram"]["counts"]
+            stats.gc_histogram += data["gc_histogram"]["counts"]
+            stats.quality_histogram += data["quality_histogram"]["counts"]
+        else:
+            stats = cls(histograms=False)
+            stats.skipped.update(data["skipped"])
+        stats.total_reads = data["total_reads"]
+        stats.passed_reads = data["passed_reads"]
+        stats.duplicate_reads = data["duplicate_reads"]
+        stats.rejected.update(data["rejected"])
+        return stats
+
+    def write_json(self, output_path: str):
+        """
+        Writes the statistics to a JSON file.
+        """
+        with open(output_path, "w") as json_file:
+            json.dump(self.to_dict(), json_file, indent=2)
+
+
+# Columns of the per-read metrics files of filter_fastq
+_METRICS_COLUMNS = ("index", "length", "gc_content", "quality", "passed")
+_METRICS_FORMATS = {".parquet": "parquet", ".arrow": "arrow", ".feather": "arrow", ".ipc": "arrow", ".csv": "csv"}
+
+
+class _ReadMetrics:
+    """
+    Buffer of per-read metrics (length, GC content, mean quality, whether the read passed the conditions).
+    Reads are numbered by their position in the input, reads left out by the sampler are counted by skip().
+    Buffered reads are passed to a _MetricsWriter every batch_size reads, a buffer without a writer
+    (in the worker processes) keeps the metrics until they are taken by columns().
+    """
+
+    def __init__(self, writer=None, batch_size=100_000):
+        self.writer = writer
+        self.batch_size = batch_size
+        self.n_reads = 0  # number of input reads seen, the index of the next one
+        self._rows = []
+        self._batches = []
+        self._size = 0
+
+    def skip(self):
+        """
+        Counts an input read without metrics.
+        """
+        self.n_reads += 1
+
+    def add_read(self, seq_len: int, gc_content: float, quality: float, passed: bool):
+        self._rows.append((self.n_reads, seq_len, gc_content, quality, passed))
+        self.n_reads += 1
+        self._size += 1
+        if self._size >= self.batch_size:
+            self.flush()
+
+    def add_batch(self, seq_lens: np.ndarray, gc_content: np.ndarray, quality: np.ndarray, passed: np.ndarray,
+                  positions=None, n_reads=None):
+        """
+        Adds the metrics of the next input reads.
+        :param positions: np.ndarray, positions of the given reads among the next n_reads input reads
+        if some of them have no metrics, by default the reads are consecutive.
+        """
+        if positions is None:
+            positions, n_reads = np.arange(len(seq_lens)), len(seq_lens)
+        self._add((self.n_reads + positions, seq_lens, gc_content, quality, passed))
+        self.n_reads += n_reads
+
+    def add_columns(self, columns: tuple, n_reads: int):
+        """
+        Adds the metrics taken by columns() from the buffer of the next n_reads input reads (a chunk of the file).
+        """
+        index, *metrics = columns
+        self.add_batch(*metrics, index, n_reads)
+
+    def _add(self, columns: tuple):
+        self._batches.append(columns)
+        self._size += len(columns[0])
+        if self._size >= self.batch_size:
+            self.flush()
+
+    def columns(self) -> tuple:
+        """
+        Takes the buffered metrics.
+        :return: tuple of np.ndarray (index, seq_lens, gc_content, quality, passed).
+        """
+        batches = self._batches
+        if self._rows:
+            batches = batches + [tuple(np.array(column) for column in zip(*self._rows))]
+        self._rows, self._batches, self._size = [], [], 0
+        if not batches:
+            return (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0),
+                    np.zeros(0, dtype=bool))
+        return tuple(np.concatenate(column) for column in zip(*batches))
+
+    def flush(self):
+        if self.writer is not None and self._size:
+            self.writer.write(self.columns())
+
+
+class _MetricsWriter:
+    """
+    Writes per-read metrics by batches to a Parquet, Arrow IPC or CSV file, the format is chosen by the extension.
+    Without pyarrow, Parquet and Arrow files are replaced by CSV files (with a warning).
+    The "index" column holds the position of the read in the input file, counted from 0.
+    """
+
+    def __init__(self, path: str):
+        root, extension = os.path.splitext(path)
+        self.format = _METRICS_FORMATS.get(extension.lower())
+        if self.format is None:
+            raise ValueError(f"Unknown metrics file extension '{extension}', "
+                             f"possible values are: {', '.join(_METRICS_FORMATS)}")
+        if self.format != "csv" and pa is None:
+            warnings.warn("pyarrow is not installed, per-read metrics are written as CSV")
+            self.format, path = "csv", root + ".csv"
+        self.path = path
+
+        if self.format == "csv":
+            self._file = open(path, "w")
+            self._file.write(",".join(_METRICS_COLUMNS) + "\n")
+            return
+        self._schema = pa.schema([("index", pa.int64()), ("length", pa.int64()), ("gc_content", pa.float64()),
+                                  ("quality", pa.float64()), ("passed", pa.bool_())])
+        if self.format == "parquet":
+            self._file = pq.ParquetWriter(path, self._schema)
+        else:
+            self._file = pa.ipc.new_file(path, self._schema)
+
+    def write(self, columns: tuple):
+        """
+        Writes a batch of metrics.
+        :param columns: tuple of np.ndarray (index, seq_lens, gc_content, quality, passed).
+        """
+        index, seq_lens, gc_content, quality, passed = columns
+        if self.format == "csv":
+            np.savetxt(self._file, np.column_stack((index, seq_lens, gc_content, quality, passed)),
+                       fmt=("%d", "%d", "%.10g", "%.10g", "%d"), delimiter=",")
+            return
+        arrays = [pa.array(index, pa.int64()), pa.array(seq_lens, pa.int64()), pa.array(gc_content, pa.float64()),
+                  pa.array(quality, pa.float64()), pa.array(passed, pa.bool_())]
+        batch = pa.RecordBatch.from_arrays(arrays, schema=self._schema)
+        if self.format == "parquet":
+            self._file.write_table(pa.Table.from_batches([batch]))
+        else:
+            self._file.write_batch(batch)
+
+    def close(self):
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
+def _sequence_hash(seq) -> int:
+    """
+    64-bit hash of a sequence used for deduplication, stable between processes and runs.
+    :param seq: bytes or memoryview.
+    :return: int.
+    """
+    return int.from_bytes(hashlib.blake2b(seq, digest_size=8).digest(), "little")
+
+
+def _first_occurrences(hashes: np.ndarray) -> tuple:
+    """
+    Finds repeated values inside a batch of hashes.
+    :return: tuple (indices of the first occurrence of every value, duplicate mask of the batch).
+    """
+    _, first = np.unique(hashes, return_index=True)
+    duplicate = np.ones(len(hashes), dtype=bool)
+    duplicate[first] = False
+    return first, duplicate
+
+
+class _HashSet:
+    """
+    Set of 64-bit hashes stored in a NumPy open addressing table (linear probing, load factor at most 1/2),
+    which takes 8-16 bytes per hash instead of about 100 bytes of a Python set of sequences.
+    Zero marks an empty slot, so hash 0 is stored as 1.
+    """
+
+    def __init__(self, capacity=2 ** 16):
+        self._table = np.zeros(capacity, dtype=np.uint64)
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key: int) -> bool:
+        """
+        Adds a hash to the set.
+        :return: bool, True if the hash was not in the set.
+        """
+        key = key or 1
+        if 2 * (self._size + 1) > len(self._table):
+            self._grow(self._size + 1)
+        mask = len(self._table) - 1
+        slot = key & mask
+        while True:
+            current = int(self._table[slot])
+            if current == 0:
+                self._table[slot] = key
+                self._size += 1
+                return True
+            if current == key:
+                return False
+            slot = (slot + 1) & mask
+
+    def add_batch(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Adds a batch of hashes to the set.
+        :param hashes: np.ndarray of uint64.
+        :return: np.ndarray, mask of the hashes which were already in the set or repeat earlier in the batch.
+        """
+        hashes = np.where(hashes == 0, np.uint64(1), hashes)
+        first, duplicate = _first_occurrences(hashes)
+        if 2 * (self._size + len(first)) > len(self._table):
+            self._grow(self._size + len(first))
+        inserted = self._insert(self._table, hashes[first])
+        self._size += int(np.count_nonzero(inserted))
+        duplicate[first[~inserted]] = True
+        return duplicate
+
+    @staticmethod
+    def _insert(table: np.ndarray, keys: np.ndarray) -> np.ndarray:
+        """
+        Inserts unique keys into the table, all the keys are probed at once.
+        :return: np.ndarray, mask of the keys which were not in the table.
+        """
+        slots = (keys & np.uint64(len(table) - 1)).astype(np.int64)
+        inserted = np.zeros(len(keys), dtype=bool)
+        pending = np.arange(len(keys))
+        while len(pending):
+            current = table[slots[pending]]
+            done = current == keys[pending]
+            empty = np.flatnonzero(current == 0)
+            # several keys may claim the same empty slot, only the one written last gets it
+            claimed = pending[empty]
+            table[slots[claimed]] = keys[claimed]
+            won = table[slots[claimed]] == keys[claimed]
+            inserted[claimed[won]] = True
+            done[empty[won]] = True
+            pending = pending[~done]
+            slots[pending] = (slots[pending] + 1) & (len(table) - 1)
+        return inserted
+
+    def _grow(self, size: int):
+        capacity = len(self._table)
+        while 2 * size > capacity:
+            capacity *= 2
+        table = np.zeros(capacity, dtype=np.uint64)
+        self._insert(table, self._table[self._table != 0])
+        self._table = table
+
+
+class _BloomFilter:
+    """
+    Bloom filter of 64-bit hashes with a fixed memory size, given in bytes or chosen for the expected number
+    of unique reads and the false-positive rate (about 1.8 bytes per read for 0.1%). A false positive removes
+    a unique read. Bit positions are derived from the two 32-bit halves of the hash (double hashing).
+    """
+
+    def __init__(self, capacity: int, error_rate: float, n_bytes: int = None):
+        if not 0 < error_rate < 1:
+            raise ValueError("error_rate must be between 0 and 1")
+        if n_bytes is not None:
+            if not isinstance(n_bytes, int) or n_bytes < 1:
+                raise ValueError("dedup_memory must be a positive number of bytes")
+            self._n_bits = 8 * n_bytes
+        else:
+            self._n_bits = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self._n_hashes = max(1, round(self._n_bits / capacity * math.log(2)))
+        self._bits = np.zeros((self._n_bits + 7) // 8, dtype=np.uint8)
+
+    @property
+    def nbytes(self) -> int:
+        return self._bits.nbytes
+
+    def add(self, key: int) -> bool:
+        """
+        Adds a hash to the filter.
+        :return: bool, True if the hash was not in the filter (false positives return False).
+        """
+        low, high = key & 0xFFFFFFFF, (key >> 32) | 1
+        new = False
+        for i in range(self._n_hashes):
+            position = (low + i * high) % self._n_bits
+            bit = 1 << (position & 7)
+            if not self._bits[position >> 3] & bit:
+                self._bits[position >> 3] |= bit
+                new = True
+        return new
+
+    def add_batch(self, hashes: np.ndarray) -> np.ndarray:
+        """
+        Adds a batch of hashes to the filter, the result is the same as of adding them one by one with add:
+        a hash is (probably) present if all its bits were set before the batch or by an earlier hash of the batch.
+        :param hashes: np.ndarray of uint64.
+        :return: np.ndarray, mask of the hashes which were (probably) already in the filter or repeat in the batch.
+        """
+        low, high = hashes & np.uint64(0xFFFFFFFF), (hashes >> np.uint64(32)) | np.uint64(1)
+        steps = np.arange(self._n_hashes, dtype=np.uint64)
+        positions = (low[:, None] + steps * high[:, None]) % np.uint64(self._n_bits)
+        byte_indices = (positions >> np.uint64(3)).astype(np.int64)
+        bits = np.left_shift(np.uint8(1), (positions & np.uint64(7)).astype(np.uint8))
+        # index of the first hash of the batch setting every bit (positions are flattened in the order of hashes)
+        _, first_index, inverse = np.unique(positions.ravel(), return_index=True, return_inverse=True)
+        first_setter = (first_index // self._n_hashes)[inverse.ravel()].reshape(positions.shape)
+        already_set = (self._bits[byte_indices] & bits).astype(bool)
+        already_set |= first_setter < np.arange(len(hashes))[:, None]
+        np.bitwise_or.at(self._bits, byte_indices.ravel(), bits.ravel())
+        return np.all(already_set, axis=1)
+
+
+class _BernoulliSampler:
+    """
+    Keeps every read with the given probability, the decisions are drawn from a seeded NumPy generator
+    in the order of reads, so one-by-one and batch calls give the same sample.
+    """
+
+    def __init__(self, fraction: float, seed=None):
+        if not 0 <= fraction <= 1:
+            raise ValueError("sample_fraction must be between 0 and 1")
+        self.fraction = fraction
+        self._seed_sequence = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+        self._rng = np.random.default_rng(self._seed_sequence)
+
+    def keep(self) -> bool:
+        return self._rng.random() < self.fraction
+
+    def keep_batch(self, n: int) -> np.ndarray:
+        """
+        :return: np.ndarray, mask of the kept reads among the next n reads.
+        """
+        return self._rng.random(n) < self.fraction
+
+    def spawn(self) -> '_BernoulliSampler':
+        """
+        Returns an independent sampler for a chunk of the file, the chunks get reproducible seeds in their order.
+        """
+        return _BernoulliSampler(self.fraction, self._seed_sequence.spawn(1)[0])
+
+
+class _ReservoirSampler:
+    """
+    Uniform random sample of a fixed number of records from a stream of unknown length
+    (reservoir sampling, algorithm L: random numbers are drawn only for the records which enter the reservoir).
+    Records are kept as bytes together with their positions in the stream, so the sample is written in input order.
+    """
+
+    def __init__(self, size: int, seed=None):
+        if size < 1:
+            raise ValueError("sample_size must be positive")
+        self.size = size
+        self._rng = np.random.default_rng(seed)
+        self._items = []
+        self._seen = 0
+        self._weight = math.exp(math.log(self._uniform()) / size)
+        self._next = size + self._skip()
+
+    def _uniform(self) -> float:
+        return 1.0 - self._rng.random()
+
+    def _skip(self) -> int:
+        return math.floor(math.log(self._uniform()) / math.log(1 - self._weight))
+
+    def _selections(self, n: int) -> Iterator[tuple]:
+        """
+        Takes the next n records of the stream.
+        :return: generator of (position of the record among the n records, reservoir slot) for the selected records.
+        """
+        start = self._seen
+        self._seen += n
+        for position in range(min(max(self.size - start, 0), n)):
+            yield position, start + position
+        while self._next < self._seen:
+            yield self._next - start, int(self._rng.integers(self.size))
+            self._weight *= math.exp(math.log(self._uniform()) / self.size)
+            self._next += self._skip() + 1
+
+    def _store(self, slot: int, index: int, record: bytes):
+        if slot == len(self._items):
+            self._items.append((index, record))
+        else:
+            self._items[slot] = (index, record)
+
+    def offer(self, record: bytes):
+        """
+        Takes the next record of the stream.
+        """
+        for _, slot in self._selections(1):
+            self._store(slot, self._seen - 1, record)
+
+    def offer_batch(self, n: int, render):
+        """
+        Takes the next n records of the stream, only the selected ones are turned into bytes.
+        :param render: function taking sorted np.ndarray of positions among the n records
+        and returning a list of their bytes.
+        """
+        start = self._seen
+        selections = list(self._selections(n))
+        if selections:
+            positions = np.unique([position for position, _ in selections])
+            records = dict(zip(positions.tolist(), render(positions)))
+            for position, slot in selections:
+                self._store(slot, start + position, records[position])
+
+    def records(self) -> list:
+        """
+        :return: list of bytes, the sampled records in input order.
+        """
+        return [record for _, record in sorted(self._items)]
+
+
+@dataclass
+class _FilterSettings:
+    """
+    Options of a filter_fastq run shared by all the engines.
+    """
+    gc_bounds: object = None
+    length_bounds: object = (0, 2 ** 32)
+    quality_threshold: float = 0
+    batch_size: int = 100_000
+    stats: FastqStats = None
+    trim_window: tuple = None
+    trim_trailing: float = None
+    dedup: object = None
+    dedup_prefix: int = None
+    sampler: _BernoulliSampler = None
+    reservoir: _ReservoirSampler = None
+    phred_offset: int = _PHRED_OFFSET
+    metrics: _ReadMetrics = None
+    score_range: tuple = field(init=False)
+
+    def __post_init__(self):
+        if not isinstance(self.batch_size, int) or self.batch_size < 1:
+            raise ValueError("batch_size must be a positive integer")
+        # lowest and highest phred score of the quality characters
+        self.score_range = tuple(char - self.phred_offset for char in _QUALITY_CHARS)
+
+    @property
+    def trimming(self) -> bool:
+        return self.trim_window is not None or self.trim_trailing is not None
+
+    @property
+    def staged(self) -> bool:
+        """
+        True if the metrics of every read are not needed, so the conditions can be checked cheapest first.
+        """
+        return (self.stats is None or not self.stats.histograms) and self.metrics is None
+
+
+def _add_read_metrics(seq_len: int, gc_content: float, quality: float, criteria: tuple, passed: bool,
+                      settings: _FilterSettings):
+    """
+    Adds the metrics of a read to the statistics and to the per-read metrics file, if they are collected.
+    """
+    if settings.stats is not None:
+        settings.stats.add_read(seq_len, gc_content, quality, criteria)
+    if settings.metrics is not None:
+        settings.metrics.add_read(seq_len, gc_content, quality, passed)
+
+
+def _quality_reaches(qualities, threshold: float, offset: int, value_range: tuple) -> tuple:
+    """
+    Checks the mean quality condition with a running sum, which stops as soon as the sum reaches
+    the total needed for the threshold or cannot reach it any more.
+    :param qualities: bytes or list of int, quality values of the read.
+    :param offset: int, value added to phred scores in qualities.
+    :param value_range: tuple (lowest, highest) possible quality value.
+    :return: tuple of bool (passed, decided before the end of the qualities).
+    """
+    n = len(qualities)
+    if not n:
+        return 0 >= threshold, False
+    needed = (threshold + offset) * n
+    if value_range[0] * n >= needed:
+        return True, True
+    total = checked = 0
+    while n - checked > _QUALITY_STEP:
+        total += sum(qualities[checked:checked + _QUALITY_STEP])
+        checked += _QUALITY_STEP
+        if total + value_range[0] * (n - checked) >= needed:
+            return True, True
+        if total + value_range[1] * (n - checked) < needed:
+            return False, True
+    total += sum(qualities[checked:])
+    return (total - offset * n) / n >= threshold, False
+
+
+def _count_staged(stats: FastqStats, failed, partial: bool, gc_checked: bool):
+    """
+    Counts a read checked cheapest first (length, GC content, mean quality) in the statistics.
+    :param failed: str, the first failed condition, None if the read passed.
+    :param partial: bool, True if the quality condition was decided before the end of the qualities.
+    :param gc_checked: bool, True if the run has GC content bounds.
+    """
+    stats.total_reads += 1
+    if failed is None:
+        stats.passed_reads += 1
+    else:
+        stats.rejected[failed] += 1
+    if failed == "length" and gc_checked:
+        stats.skipped["gc"] += 1
+    if failed in ("length", "gc"):
+        stats.skipped["quality"] += 1
+    stats.skipped["quality_partial"] += partial
+
+
+def _is_duplicate(seq, settings: _FilterSettings) -> bool:
+    """
+    Checks whether a read which passed the conditions was already seen, counts it in the statistics if so.
+    :param seq: bytes, sequence of the read.
+    :return: bool.
+    """
+    if settings.dedup.add(_sequence_hash(seq[:settings.dedup_prefix])):
+        return False
+    if settings.stats is not None:
+        settings.stats.duplicate_reads += 1
+    return True
+
+
+def _duplicate_mask(block, seq_starts: np.ndarray, seq_ends: np.ndarray, settings: _FilterSettings) -> np.ndarray:
+    """
+    Vectorized version of _is_duplicate for the reads of a block which passed the conditions.
+    :param block: bytes or memoryview, the block.
+    :return: np.ndarray, mask of the duplicate reads.
+    """
+    if settings.dedup_prefix is not None:
+        seq_ends = np.minimum(seq_ends, seq_starts + settings.dedup_prefix)
+    view = memoryview(block)
+    hashes = np.fromiter((_sequence_hash(view[start:end])
+                          for start, end in zip(seq_starts.tolist(), seq_ends.tolist())),
+                         dtype=np.uint64, count=len(seq_starts))
+    duplicate = settings.dedup.add_batch(hashes)
+    if settings.stats is not None:
+        settings.stats.duplicate_reads += int(np.count_nonzero(duplicate))
+    return duplicate
+
+
+def _trim_end(qualities, offset: int, trim_window=None, trim_trailing=None) -> int:
+    """
+    Finds where a read has to be cut by quality trimming.
+    First the read is cut at the start of the first sliding window with mean quality below the threshold,
+    then low quality bases are removed from its 3' end.
+    :param qualities: sequence of int, quality values of the read (raw bytes or phred scores).
+    :param offset: int, value added to phred scores in qualities (33 for raw Sanger bytes, 0 for phred scores).
+    :param trim_window: tuple (window size, mean quality threshold) or None.
+    :param trim_trailing: float, quality threshold for the trailing bases or None.
+    :return: int, length of the read after trimming.
+    """
+    end = len(qualities)
+    if trim_window is not None:
+        size, threshold = trim_window
+        if end >= size:
+            limit = (threshold + offset) * size
+            window_sum = sum(qualities[:size])
+            for start in range(end - size + 1):
+                if window_sum < limit:
+                    end = start
+                    break
+                if start + size < end:
+                    window_sum += qualities[start + size] - qualities[start]
+    if trim_trailing is not None:
+        limit = trim_trailing + offset
+        while end and qualities[end - 1] < limit:
+            end -= 1
+    return end
+
+
+def _filter_records(records, settings: _FilterSettings):
+    """
+    Lazily yields the SeqRecords that pass the filtration bounds, trimmed if trimming is requested.
+    :param records: iterable of SeqRecord objects.
+    :param settings: _FilterSettings, conditions of the run, QC statistics are collected to settings.stats if given.
+    :return: generator of SeqRecord objects which passed the conditions.
+    """
+    bounds = gc_bounds, length_bounds, quality_threshold = (settings.gc_bounds, settings.length_bounds,
+                                                            settings.quality_threshold)
+    staged, trimming = settings.staged, settings.trimming
+    for record in records:
+        if settings.sampler is not None and not settings.sampler.keep():
+            if settings.metrics is not None:
+                settings.metrics.skip()
+            continue
+        phred_quality = record.letter_annotations["phred_quality"]
+        if trimming:
+            end = _trim_end(phred_quality, 0, settings.trim_window, settings.trim_trailing)
+            if end < len(record):
+                record = record[:end]
+                phred_quality = record.letter_annotations["phred_quality"]
+
+        if staged:
+            # GC content is calculated only for the reads of right length, quality only for the reads left
+            partial = False
+            if not _in_bounds(len(record.seq), length_bounds):
+                failed = "length"
+            elif gc_bounds is not None and not _in_bounds(gc(record.seq), gc_bounds):
+                failed = "gc"
+            else:
+                passed, partial = _quality_reaches(phred_quality, quality_threshold, 0, settings.score_range)
+                failed = None if passed else "quality"
+            if settings.stats is not None:
+                _count_staged(settings.stats, failed, partial, gc_bounds is not None)
+            passed = failed is None
+        else:
+            seq_len = len(record.seq)
+            gc_content = gc(record.seq)
+            quality = sum(phred_quality) / len(phred_quality) if phred_quality else 0
+            criteria = _check_criteria(seq_len, gc_content, quality, *bounds)
+            passed = all(criteria)
+            _add_read_metrics(seq_len, gc_content, quality, criteria, passed, settings)
+        if passed and (settings.dedup is None or not _is_duplicate(bytes(record.seq), settings)):
+            if settings.reservoir is not None:
+                settings.reservoir.offer(record.format(_SEQIO_FORMATS[settings.phred_offset]).encode())
+            else:
+                yield record
+
+
+def _read_fastq_raw(fastq_file) -> Iterator[tuple]:
+    """
+    Reads four-line FASTQ records from a binary file handle without building SeqRecords.
+    :param fastq_file: file object opened in 'rb' mode.
+    :return: generator of (record, seq, qual) tuples, where record holds the original bytes
+    of all four lines and seq, qual are the sequence and quality lines without line endings.
+    Raises ValueError if the file is not a valid four-line FASTQ.
+    """
+    readline = fastq_file.readline
+    while True:
+        header = readline()
+        if not header:
+            return
+        if not header.strip():  # skip empty lines
+            continue
+        if not header.startswith(b"@"):
+            raise ValueError(f"Invalid FASTQ header: {header[:50]!r}")
+
+        seq = readline()
+        plus = readline()
+        qual = readline()
+        if not qual or not plus.startswith(b"+"):
+            raise ValueError(f"Truncated FASTQ record: {header[:50]!r}")
+        if not qual.endswith(b"\n"):
+            qual += b"\n"
+
+        seq_line = seq.rstrip(b"\r\n")
+        qual_line = qual.rstrip(b"\r\n")
+        if len(seq_line) != len(qual_line):
+            raise ValueError(f"Lengths of sequence and quality differ: {header[:50]!r}")
+
+        yield header + seq + plus + qual, seq_line, qual_line
+
+
+def _raw_metrics(seq: bytes, qual: bytes, phred_offset=_PHRED_OFFSET) -> tuple:
+    """
+    Calculates length, GC content and mean quality of a read from its raw lines.
+    Gives the same values as gc_fraction and phred_quality of Biopython.
+    The quality characters are summed as bytes, no list of scores is created.
+    :param seq: bytes, sequence line without line ending.
+    :param qual: bytes, quality line without line ending.
+    :param phred_offset: int, 33 or 64, offset of the quality encoding.
+    :return: tuple (seq_len, gc_content, quality).
+    """
+    quality = (sum(qual) - phred_offset * len(qual)) / len(qual) if qual else 0
+    return len(seq), _raw_gc(seq), quality
+
+
+def _raw_gc(seq: bytes) -> float:
+    """
+    GC content of a raw sequence line, the same as gc_fraction of Biopython.
+    """
+    gc_count = len(seq) - len(seq.translate(None, _GC_LETTERS))
+    at_count = len(seq) - len(seq.translate(None, _AT_LETTERS))
+    return gc_count / (gc_count + at_count) if gc_count + at_count else 0
+
+
+def _trim_raw_record(record: bytes, seq: bytes, qual: bytes, end: int) -> tuple:
+    """
+    Cuts a raw record to the given length.
+    :return: tuple (record, seq, qual) of the trimmed read.
+    """
+    header, _, plus, _ = record.split(b"\n", 3)
+    seq, qual = seq[:end], qual[:end]
+    return b"\n".join((header, seq, plus, qual)) + b"\n", seq, qual
+
+
+def _filter_raw_records(records, settings: _FilterSettings):
+    """
+    Lazily yields the original bytes of raw records that pass the filtration bounds,
+    trimmed records are rebuilt from their lines.
+    :param records: iterable of (record, seq, qual) tuples from _read_fastq_raw.
+    :param settings: _FilterSettings, conditions of the run, QC statistics are collected to settings.stats if given.
+    :return: generator of bytes.
+    """
+    bounds = gc_bounds, length_bounds, quality_threshold = (settings.gc_bounds, settings.length_bounds,
+                                                            settings.quality_threshold)
+    staged, trimming, phred_offset = settings.staged, settings.trimming, settings.phred_offset
+    for record, seq, qual in records:
+        if settings.sampler is not None and not settings.sampler.keep():
+            if settings.metrics is not None:
+                settings.metrics.skip()
+            continue
+        if trimming:
+            end = _trim_end(qual, settings.phred_offset, settings.trim_window, settings.trim_trailing)
+            if end < len(qual):
+                record, seq, qual = _trim_raw_record(record, seq, qual, end)
+
+        if staged:
+            # GC content is calculated only for the reads of right length, quality only for the reads left
+            partial = False
+            if not _in_bounds(len(seq), length_bounds):
+                failed = "length"
+            elif gc_bounds is not None and not _in_bounds(_raw_gc(seq), gc_bounds):
+                failed = "gc"
+            else:
+                passed, partial = _quality_reaches(qual, quality_threshold, phred_offset, _QUALITY_CHARS)
+                failed = None if passed else "quality"
+            if settings.stats is not None:
+                _count_staged(settings.stats, failed, partial, gc_bounds is not None)
+            passed = failed is None
+        else:
+            seq_len, gc_content, quality = _raw_metrics(seq, qual, settings.phred_offset)
+            criteria = _check_criteria(seq_len, gc_content, quality, *bounds)
+            passed = all(criteria)
+            _add_read_metrics(seq_len, gc_content, quality, criteria, passed, settings)
+        if passed and (settings.dedup is None or not _is_duplicate(seq, settings)):
+            if settings.reservoir is not None:
+                settings.reservoir.offer(record)
+            else:
+                yield record
+
+
+def _read_fastq_blocks(fastq_file, batch_size: int) -> Iterator[bytes]:
+    """
+    Reads FASTQ records in batches, every batch is one contiguous bytes block.
+    :param fastq_file: file object opened in 'rb' mode.
+    :param batch_size: int, number of four-line records in a batch.
+    :return: generator of bytes blocks, each ending with a line break.
+    """
+    while True:
+        lines = list(islice(fastq_file, 4 * batch_size))
+        # skips empty lines at the end of file, but not the empty sequence and quality lines of a zero-length read:
+        # an empty line is dropped only if it is not part of a complete record starting with a header
+        while lines and not lines[-1].strip() and (len(lines) % 4 or not lines[-4].strip()):
+            lines.pop()
+        if not lines:
+            return
+        if not lines[-1].endswith(b"\n"):
+            lines[-1] += b"\n"
+        yield b"".join(lines)
+
+
+def _fastq_block_spans(data: np.ndarray) -> tuple:
+    """
+    Finds boundaries of records, sequences and qualities in a block of complete FASTQ records.
+    :param data: np.ndarray of uint8, the block.
+    :return: tuple of np.ndarray (record_starts, record_ends, seq_starts, seq_ends, qual_starts, qual_ends),
+    ends are exclusive and do not include line breaks.
+    Raises ValueError if the block is not a valid four-line FASTQ.
+    """
+    line_ends = np.flatnonzero(data == ord("\n")) + 1
+    if len(line_ends) % 4 or (len(data) and (not len(line_ends) or line_ends[-1] != len(data))):
+        raise ValueError("Truncated FASTQ record")
+
+    line_starts = np.zeros_like(line_ends)
+    line_starts[1:] = line_ends[:-1]
+    if np.any(data[line_starts[0::4]] != ord("@")) or np.any(data[line_starts[2::4]] != ord("+")):
+        raise ValueError("Invalid FASTQ record")
+
+    seq_starts, seq_ends = line_starts[1::4], line_ends[1::4] - 1
+    qual_starts, qual_ends = line_starts[3::4], line_ends[3::4] - 1
+    # strip '\r' of Windows line breaks
+    seq_ends -= (seq_ends > seq_starts) & (data[seq_ends - 1] == ord("\r"))
+    qual_ends -= (qual_ends > qual_starts) & (data[qual_ends - 1] == ord("\r"))
+
+    return line_starts[0::4], line_ends[3::4], seq_starts, seq_ends, qual_starts, qual_ends
+
+
+def _segment_sums(values: np.ndarray, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+    """
+    Sums values[start:end] for every segment at once with np.add.reduceat.
+    :return: np.ndarray of int64, empty segments give 0.
+    """
+    if not len(starts):
+        return np.zeros(0, dtype=np.int64)
+    bounds = np.empty(2 * len(starts), dtype=np.int64)
+    bounds[0::2] = starts
+    bounds[1::2] = ends
+    # summing uint8 values into uint32 is much faster and cannot overflow for segments shorter than 2**24
+    dtype = np.uint32 if np.max(ends - starts) < 2 ** 24 else np.int64
+    sums = np.add.reduceat(values, bounds, dtype=dtype)[0::2].astype(np.int64)
+    sums[starts == ends] = 0
+    return sums
+
+
+def _score_fastq_block(block, seq_starts: np.ndarray, seq_ends: np.ndarray,
+                       qual_starts: np.ndarray, qual_ends: np.ndarray, phred_offset=_PHRED_OFFSET) -> tuple:
+    """
+    Calculates length, GC content and mean quality of all the reads of a block at once.
+    Gives the same values as _raw_metrics does for every read.
+    :param block: bytes or memoryview, the block.
+    :param phred_offset: int, 33 or 64, offset of the quality encoding.
+    :return: tuple of np.ndarray (seq_lens, gc_content, quality).
+    """
+    seq_lens = seq_ends - seq_starts
+    qual_lens = qual_ends - qual_starts
+    if np.any(seq_lens != qual_lens):
+        raise ValueError("Lengths of sequence and quality differ")
+
+    gc_content = _block_gc(block, seq_starts, seq_ends)
+    quality = _block_quality(np.frombuffer(block, dtype=np.uint8), qual_starts, qual_ends, phred_offset)
+    return seq_lens, gc_content, quality
+
+
+def _block_gc(block, seq_starts: np.ndarray, seq_ends: np.ndarray) -> np.ndarray:
+    """
+    GC content of the given sequences of a block, the same as _raw_gc.
+    :param block: bytes or memoryview, the block.
+    :return: np.ndarray of float.
+    """
+    if isinstance(block, bytes):
+        gc_counts = _segment_sums(np.frombuffer(block.translate(_GC_TABLE), dtype=np.uint8), seq_starts, seq_ends)
+        at_counts = _segment_sums(np.frombuffer(block.translate(_AT_TABLE), dtype=np.uint8), seq_starts, seq_ends)
+    else:
+        gc_counts, at_counts = _lookup_counts(np.frombuffer(block, dtype=np.uint8), seq_starts, seq_ends)
+    known_counts = gc_counts + at_counts
+    return np.divide(gc_counts, known_counts, out=np.zeros(len(seq_starts)), where=known_counts > 0)
+
+
+def _lookup_counts(data: np.ndarray, seq_starts: np.ndarray, seq_ends: np.ndarray) -> tuple:
+    """
+    Counts GC and AT letters of the given sequences of a buffer without bytes.translate (a memory-mapped window).
+    Sequences are looked up by groups spanning about _LOOKUP_SIZE bytes, so the temporary arrays are bounded
+    by the size of a group and not of the whole buffer.
+    :param data: np.ndarray of uint8, the buffer.
+    :return: tuple of np.ndarray (GC counts, AT counts).
+    """
+    gc_counts = np.zeros(len(seq_starts), dtype=np.int64)
+    at_counts = np.zeros(len(seq_starts), dtype=np.int64)
+    first = 0
+    while first < len(seq_starts):
+        last = max(first + 1, int(np.searchsorted(seq_starts, seq_starts[first] + _LOOKUP_SIZE)))
+        # a sequence line is always followed by a line break, so the group is extended by one byte
+        # to keep every segment end inside it, as np.add.reduceat requires
+        offset, end = int(seq_starts[first]), min(int(seq_ends[last - 1]) + 1, len(data))
+        starts, ends = seq_starts[first:last] - offset, seq_ends[first:last] - offset
+        group = data[offset:end]
+        gc_counts[first:last] = _segment_sums(_GC_LOOKUP[group], starts, ends)
+        at_counts[first:last] = _segment_sums(_AT_LOOKUP[group], starts, ends)
+        first = last
+    return gc_counts, at_counts
+
+
+def _block_quality(data: np.ndarray, qual_starts: np.ndarray, qual_ends: np.ndarray,
+                   phred_offset=_PHRED_OFFSET) -> np.ndarray:
+    """
+    Mean quality of the given quality lines of a block.
+    :param data: np.ndarray of uint8, the block.
+    :return: np.ndarray of float.
+    """
+    qual_lens = qual_ends - qual_starts
+    qual_sums = _segment_sums(data, qual_starts, qual_ends) - phred_offset * qual_lens
+    return np.divide(qual_sums, qual_lens, out=np.zeros(len(qual_starts)), where=qual_lens > 0)
+
+
+def _staged_block_mask(block, seq_starts: np.ndarray, seq_ends: np.ndarray, qual_starts: np.ndarray,
+                       qual_ends: np.ndarray, settings: _FilterSettings) -> np.ndarray:
+    """
+    Vectorized version of the staged checks of _filter_raw_records: GC content is calculated only for the reads
+    of right length and quality only for the reads which passed both conditions.
+    :param block: bytes or memoryview, the block.
+    :return: np.ndarray of bool, True for the reads which pass all the conditions.
+    """
+    seq_lens = seq_ends - seq_starts
+    if np.any(seq_lens != qual_ends - qual_starts):
+        raise ValueError("Lengths of sequence and quality differ")
+
+    mask = _in_bounds(seq_lens, settings.length_bounds)
+    candidates = np.flatnonzero(mask)
+    length_passed = len(candidates)
+    if settings.gc_bounds is not None:
+        gc_passed = _in_bounds(_block_gc(block, seq_starts[candidates], seq_ends[candidates]), settings.gc_bounds)
+        mask[candidates[~gc_passed]] = False
+        candidates = candidates[gc_passed]
+    quality = _block_quality(np.frombuffer(block, dtype=np.uint8), qual_starts[candidates], qual_ends[candidates],
+                             settings.phred_offset)
+    mask[candidates[quality < settings.quality_threshold]] = False
+
+    stats = settings.stats
+    if stats is not None:
+        passed = int(np.count_nonzero(mask))
+        stats.total_reads += len(seq_lens)
+        stats.passed_reads += passed
+        stats.rejected["length"] += len(seq_lens) - length_passed
+        stats.rejected["gc"] += length_passed - len(candidates)
+        stats.rejected["quality"] += len(candidates) - passed
+        if settings.gc_bounds is not None:
+            stats.skipped["gc"] += len(seq_lens) - length_passed
+        stats.skipped["quality"] += len(seq_lens) - len(candidates)
+    return mask
+
+
+def _write_spans(output_file, buffer, starts: np.ndarray, ends: np.ndarray):
+    """
+    Writes buffer[start:end] slices to a file, adjacent slices are merged into a single write.
+    :param output_file: file object opened in 'wb' mode.
+    :param buffer: bytes-like object the slices refer to.
+    """
+    if not len(starts):
+        return
+    breaks = np.flatnonzero(starts[1:] != ends[:-1]) + 1
+    run_starts = starts[np.r_[0, breaks]]
+    run_ends = ends[np.r_[breaks - 1, len(ends) - 1]]
+    view = memoryview(buffer)
+    for start, end in zip(run_starts.tolist(), run_ends.tolist()):
+        output_file.write(view[start:end])
+
+
+def _window_sums(data: np.ndarray, size: int) -> np.ndarray:
+    """
+    Sums of every window of the given size, the i-th value is data[i:i + size].sum().
+    :param data: np.ndarray of uint8.
+    :return: np.ndarray of length len(data) - size + 1.
+    """
+    dtype = np.uint16 if size * 255 < 2 ** 16 else np.uint32
+    sums = data[:len(data) - size + 1].astype(dtype)
+    for shift in range(1, size):
+        sums += data[shift:len(data) - size + 1 + shift]
+    return sums
+
+
+def _trim_lengths(data: np.ndarray, qual_starts: np.ndarray, qual_ends: np.ndarray,
+                  trim_window=None, trim_trailing=None, phred_offset=_PHRED_OFFSET) -> np.ndarray:
+    """
+    Vectorized version of _trim_end for all the reads of a block.
+    :param data: np.ndarray of uint8, the block.
+    :return: np.ndarray, lengths of the reads after trimming.
+    """
+    lengths = qual_ends - qual_starts
+    if trim_window is not None:
+        size, threshold = trim_window
+        if len(data) >= size:
+            # positions where a window with too low mean quality starts, anywhere in the block
+            low_starts = np.flatnonzero(_window_sums(data, size) < (threshold + phred_offset) * size)
+            first = np.searchsorted(low_starts, qual_starts)
+            candidates = low_starts[np.minimum(first, len(low_starts) - 1)] if len(low_starts) else qual_starts
+            cut = (first < len(low_starts)) & (candidates <= qual_ends - size)
+            lengths = np.where(cut, candidates - qual_starts, lengths)
+    if trim_trailing is not None:
+        good = np.flatnonzero(data >= trim_trailing + phred_offset)
+        last = np.searchsorted(good, qual_starts + lengths) - 1
+        last_good = good[np.maximum(last, 0)] if len(good) else qual_starts
+        keep = (last >= 0) & (last_good >= qual_starts)
+        lengths = np.where(keep, last_good + 1 - qual_starts, 0)
+    return lengths
+
+
+def _write_trimmed(output_file, data: np.ndarray, record_starts: np.ndarray, record_ends: np.ndarray,
+                   trimmed: tuple):
+    """
+    Writes trimmed records of a block: every record without the cut parts of its sequence and quality lines.
+    :param data: np.ndarray of uint8, the block.
+    :param trimmed: tuple of np.ndarray (seq_ends, trimmed_seq_ends, qual_ends, trimmed_qual_ends) of the records.
+    """
+    # +1 where a kept range starts and -1 where it ends, the cumulative sum marks the bytes to keep
+    keep = np.zeros(len(data) + 1, dtype=np.int8)
+    keep[record_starts] += 1
+    keep[record_ends] -= 1
+    seq_ends, trimmed_seq_ends, qual_ends, trimmed_qual_ends = trimmed
+    keep[trimmed_seq_ends] -= 1
+    keep[seq_ends] += 1
+    keep[trimmed_qual_ends] -= 1
+    keep[qual_ends] += 1
+    output_file.write(data[np.cumsum(keep[:-1], dtype=np.int8).astype(bool)].tobytes())
+
+
+def _write_block(output_file, block, record_starts: np.ndarray, record_ends: np.ndarray, mask: np.ndarray,
+                 trimmed=None):
+    """
+    Writes the records of a block selected by mask.
+    :param block: bytes or memoryview, the block.
+    :param trimmed: tuple from _filter_block if the reads were trimmed, None otherwise.
+    """
+    if trimmed is None:
+        _write_spans(output_file, block, record_starts[mask], record_ends[mask])
+    elif np.any(mask):
+        _write_trimmed(output_file, np.frombuffer(block, dtype=np.uint8), record_starts[mask], record_ends[mask],
+                       tuple(ends[mask] for ends in trimmed))
+
+
+def _render_records(block, record_starts: np.ndarray, record_ends: np.ndarray, indices: np.ndarray,
+                    trimmed=None) -> list:
+    """
+    Makes bytes of the selected records of a block, as they would be written by _write_block.
+    :param indices: np.ndarray, sorted indices of the records.
+    :return: list of bytes.
+    """
+    mask = np.zeros(len(record_starts), dtype=bool)
+    mask[indices] = True
+    buffer = io.BytesIO()
+    _write_block(buffer, block, record_starts, record_ends, mask, trimmed)
+    lengths = record_ends[indices] - record_starts[indices]
+    if trimmed is not None:
+        seq_ends, trimmed_seq_ends, qual_ends, trimmed_qual_ends = trimmed
+        lengths -= (seq_ends - trimmed_seq_ends + qual_ends - trimmed_qual_ends)[indices]
+    offsets = np.concatenate(([0], np.cumsum(lengths))).tolist()
+    data = buffer.getvalue()
+    return [data[start:end] for start, end in zip(offsets[:-1], offsets[1:])]
+
+
+def _score_block(block, phred_offset=_PHRED_OFFSET) -> tuple:
+    """
+    Finds the records of a block of complete FASTQ records and scores them with NumPy.
+    :param block: bytes or memoryview, the block.
+    :param phred_offset: int, 33 or 64, offset of the quality encoding.
+    :return: tuple of np.ndarray (record_starts, record_ends, seq_lens, gc_content, quality).
+    """
+    record_starts, record_ends, *spans = _fastq_block_spans(np.frombuffer(block, dtype=np.uint8))
+    return (record_starts, record_ends) + _score_fastq_block(block, *spans, phred_offset)
+
+
+def _filter_block(block, settings: _FilterSettings) -> tuple:
+    """
+    Trims (if requested), scores and filters a block of complete FASTQ records with NumPy.
+    :param block: bytes or memoryview, the block.
+    :return: tuple (record_starts, record_ends, mask, trimmed) to be passed to _write_block, where
+    trimmed is None or a tuple of np.ndarray (seq_ends, trimmed_seq_ends, qual_ends, trimmed_qual_ends).
+    """
+    data = np.frombuffer(block, dtype=np.uint8)
+    spans = _fastq_block_spans(data)
+    n_reads, sampled = len(spans[0]), None
+    if settings.sampler is not None:
+        # reads rejected by the sampler are neither trimmed nor scored
+        sampled = np.flatnonzero(settings.sampler.keep_batch(n_reads))
+        spans = tuple(positions[sampled] for positions in spans)
+    record_starts, record_ends, seq_starts, seq_ends, qual_starts, qual_ends = spans
+
+    trimmed = None
+    if settings.trimming:
+        lengths = _trim_lengths(data, qual_starts, qual_ends, settings.trim_window, settings.trim_trailing,
+                                settings.phred_offset)
+        trimmed = (seq_ends, seq_starts + lengths, qual_ends, qual_starts + lengths)
+        seq_ends, qual_ends = trimmed[1], trimmed[3]
+
+    if settings.staged:
+        mask = _staged_block_mask(block, seq_starts, seq_ends, qual_starts, qual_ends, settings)
+    else:
+        seq_lens, gc_content, quality = _score_fastq_block(block, seq_starts, seq_ends, qual_starts, qual_ends,
+                                                           settings.phred_offset)
+        criteria = _criteria_masks(seq_lens, gc_content, quality, settings.gc_bounds,
+                                   settings.length_bounds, settings.quality_threshold)
+        mask = criteria[0] & criteria[1] & criteria[2]
+        if settings.stats is not None:
+            settings.stats.add_batch(seq_lens, gc_content, quality, criteria)
+        if settings.metrics is not None:
+            settings.metrics.add_batch(seq_lens, gc_content, quality, mask.copy(), sampled, n_reads)
+    if settings.dedup is not None:
+        passed = np.flatnonzero(mask)
+        mask[passed[_duplicate_mask(block, seq_starts[passed], seq_ends[passed], settings)]] = False
+    if settings.reservoir is not None:
+        passed = np.flatnonzero(mask)
+        settings.reservoir.offer_batch(len(passed), lambda positions: _render_records(
+            block, record_starts, record_ends, passed[positions], trimmed))
+        mask[:] = False
+    return record_starts, record_ends, mask, trimmed
+
+
+def _filter_write_block(output_file, block, settings: _FilterSettings) -> int:
+    """
+    Filters a block of complete FASTQ records with NumPy and writes the passing records.
+    :param block: bytes or memoryview, the block.
+    :return: int, number of written records.
+    """
+    record_starts, record_ends, mask, trimmed = _filter_block(block, settings)
+    _write_block(output_file, block, record_starts, record_ends, mask, trimmed)
+    return int(np.count_nonzero(mask))
+
+
+def _run_seqio_engine(input_fastq, output_fastq, settings: _FilterSettings) -> int:
+    """
+    Reference engine of filter_fastq based on Bio.SeqIO.
+    :param input_fastq: file object opened in 'rb' mode.
+    :param output_fastq: file object opened in 'wb' mode.
+    :return: int, number of written records.
+    """
+    input_text = io.TextIOWrapper(input_fastq)
+    output_text = io.TextIOWrapper(output_fastq)
+    try:
+        seqio_format = _SEQIO_FORMATS[settings.phred_offset]
+        passed_filters = _filter_records(SeqIO.parse(input_text, seqio_format), settings)
+        return SeqIO.write(passed_filters, output_text, seqio_format)
+    finally:
+        # leave the underlying binary files open for the caller
+        output_text.flush()
+        output_text.detach()
+        input_text.detach()
+
+
+def _run_raw_engine(input_fastq, output_fastq, settings: _FilterSettings) -> int:
+    """
+    Fast engine of filter_fastq working on raw bytes, passing records are written unchanged.
+    :param input_fastq: file object opened in 'rb' mode.
+    :param output_fastq: file object opened in 'wb' mode.
+    :return: int, number of written records.
+    """
+    written = 0
+    records = _read_fastq_raw(input_fastq)
+    for record in _filter_raw_records(records, settings):
+        output_fastq.write(record)
+        written += 1
+    return written
+
+
+def _run_numpy_engine(input_fastq, output_fastq, settings: _FilterSettings) -> int:
+    """
+    Vectorized engine of filter_fastq, reads are scored and filtered by batches of settings.batch_size
+    with NumPy, passing records are written unchanged.
+    :param input_fastq: file object opened in 'rb' mode.
+    :param output_fastq: file object opened in 'wb' mode.
+    :return: int, number of written records.
+    """
+    written = 0
+    for block in _read_fastq_blocks(input_fastq, settings.batch_size):
+        written += _filter_write_block(output_fastq, block, settings)
+    return written
+
+
+def _mmap_windows(buffer: mmap.mmap, window_size: int, end: int) -> Iterator[tuple]:
+    """
+    Splits a memory-mapped FASTQ file into windows of complete records without copying it.
+    Record boundaries are found by a vectorized newline scan of every window.
+    :param buffer: mmap.mmap object of the file.
+    :param window_size: int, approximate size of a window in bytes, grows if a record does not fit.
+    :param end: int, offset where the scan stops.
+    :return: generator of (start, end) byte offsets, the part after the last end
+    (an incomplete last record) is left to the caller.
+    """
+    data = np.frombuffer(buffer, dtype=np.uint8, count=end)
+    position = 0
+    while position < len(data):
+        line_ends = np.flatnonzero(data[position:position + window_size] == ord("\n")) + 1
+        n_lines = len(line_ends) // 4 * 4
+        if not n_lines:
+            if position + window_size >= len(data):
+                return
+            window_size *= 2
+            continue
+        end = position + int(line_ends[n_lines - 1])
+        yield position, end
+        position = end
+
+
+def _run_mmap_engine(input_fastq, output_fastq, settings: _FilterSettings) -> int:
+    """
+    Vectorized engine of filter_fastq reading a memory-mapped input. Windows of the mapping are scored
+    like the blocks of the "numpy" engine (GC letters are looked up by groups of sequences, no translated copy
+    of the window is made), and passing records are written straight from the mapped buffer,
+    so the records are never copied into Python objects.
+    Inputs which cannot be mapped (compressed files, in-memory chunks) are filtered by the "numpy" engine.
+    :param input_fastq: file object opened in 'rb' mode.
+    :param output_fastq: file object opened in 'wb' mode.
+    :return: int, number of written records.
+    """
+    try:
+        if isinstance(input_fastq, gzip.GzipFile):
+            raise io.UnsupportedOperation
+        fileno = input_fastq.fileno()
+    except (AttributeError, io.UnsupportedOperation):
+        return _run_numpy_engine(input_fastq, output_fastq, settings)
+    if not os.fstat(fileno).st_size:
+        return 0
+
+    written = 0
+    # not a context manager: if filtering fails, views of the mapping are still referenced by the traceback
+    # and the mapping could not be closed, so it is left to the garbage collector in this case
+    buffer = mmap.mmap(fileno, 0, access=mmap.ACCESS_READ)
+    view = memoryview(buffer)
+    # empty lines at the end of file are left out of the windows, the last line of text with them
+    # is handled with the rest of the file below, the same way as by the "numpy" engine
+    content_end = len(buffer)
+    while content_end and buffer[content_end - 1] in b" \t\r\n":
+        content_end -= 1
+    end = 0
+    for start, end in _mmap_windows(buffer, _CHUNK_SIZE, content_end):
+        window = view[start:end]
+        written += _filter_write_block(output_fastq, window, settings)
+        window.release()
+
+    # the rest of the file is small, it is copied and handled as a usual block
+    for block in _read_fastq_blocks(io.BytesIO(view[end:]), settings.batch_size):
+        written += _filter_write_block(output_fastq, block, settings)
+
+    view.release()
+    buffer.close()
+    return written
+
+
+_FASTQ_ENGINES = {
+    "seqio": _run_seqio_engine,
+    "raw": _run_raw_engine,
+    "numpy": _run_numpy_engine,
+    "mmap": _run_mmap_engine,
+}
+
+
+def _next_record_start(fastq_file, offset: int) -> int:
+    """
+    Finds the first FASTQ record which starts after the given byte offset.
+    A line is taken as a header if it starts with '@', the second line after it starts with '+'
+    and the sequence and quality lines have equal lengths, so quality lines starting with '@' are skipped.
+    :param fastq_file: file object opened in 'rb' mode.
+    :param offset: int, byte offset to start the search from.
+    :return: int, byte offset of the record start, or of the end of file if there are no more records.
+    """
+    fastq_file.seek(offset)
+    if offset:
+        fastq_file.readline()  # skip the rest of a possibly cut line
+    position = fastq_file.tell()
+    lines = deque(fastq_file.readline() for _ in range(4))
+    while lines[0]:
+        if (lines[0].startswith(b"@") and lines[2].startswith(b"+")
+                and len(lines[1].rstrip(b"\r\n")) == len(lines[3].rstrip(b"\r\n"))):
+            return position
+        position += len(lines.popleft())
+        lines.append(fastq_file.readline())
+    return position
+
+
+def _fastq_chunks(input_path: str, n_chunks: int) -> list:
+    """
+    Splits a FASTQ file into byte ranges aligned on record boundaries.
+    :param input_path: str, path to fastq_file.
+    :param n_chunks: int, desired number of chunks.
+    :return: list of (start, end) tuples, ranges follow each other in file order.
+    """
+    file_size = os.path.getsize(input_path)
+    bounds = [0]
+    with open(input_path, "rb") as fastq_file:
+        for i in range(1, n_chunks):
+            start = _next_record_start(fastq_file, file_size * i // n_chunks)
+            if bounds[-1] < start < file_size:
+                bounds.append(start)
+    bounds.append(file_size)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def _filter_fastq_chunk(input_path: str, start: int, end: int, engine: str, settings: _FilterSettings) -> tuple:
+    """
+    Filters one byte range of a FASTQ file, runs in a worker process of filter_fastq(n_jobs > 1).
+    :return: tuple (bytes of the passing records, number of passing records, FastqStats of the chunk or None,
+    _ReadMetrics of the chunk or None).
+    """
+    with open(input_path, "rb") as fastq_file:
+        fastq_file.seek(start)
+        chunk = fastq_file.read(end - start)
+    return _filter_fastq_bytes(chunk, engine, settings)
+
+
+def _filter_fastq_bytes(chunk: bytes, engine: str, settings: _FilterSettings) -> tuple:
+    """
+    Filters a block of complete FASTQ records, runs in a worker process of filter_fastq(n_jobs > 1).
+    :return: tuple (bytes of the passing records, number of passing records, FastqStats of the block or None,
+    _ReadMetrics of the block or None).
+    """
+    output_chunk = io.BytesIO()
+    written = _FASTQ_ENGINES[engine](io.BytesIO(chunk), output_chunk, settings)
+    return output_chunk.getvalue(), written, settings.stats, settings.metrics
+
+
+def _write_chunk_records(output_fastq, chunk: bytes, settings: _FilterSettings) -> int:
+    """
+    Writes the records of a filtered chunk which were not seen before,
+    or passes them to the reservoir if a fixed number of reads is sampled.
+    :return: int, number of written records.
+    """
+    record_starts, record_ends, seq_starts, seq_ends, _, _ = _fastq_block_spans(np.frombuffer(chunk, dtype=np.uint8))
+    kept = np.ones(len(record_starts), dtype=bool)
+    if settings.dedup is not None:
+        kept = ~_duplicate_mask(chunk, seq_starts, seq_ends, settings)
+    if settings.reservoir is not None:
+        kept = np.flatnonzero(kept)
+        settings.reservoir.offer_batch(len(kept), lambda positions: [
+            chunk[start:end] for start, end in zip(record_starts[kept[positions]].tolist(),
+                                                   record_ends[kept[positions]].tolist())])
+        return 0
+    _write_spans(output_fastq, chunk, record_starts[kept], record_ends[kept])
+    return int(np.count_nonzero(kept))
+
+
+def _run_parallel(input_fastq, output_fastq, engine: str, settings: _FilterSettings, n_jobs: int) -> int:
+    """
+    Filters a FASTQ file with a pool of processes, chunks are written in their original order.
+    Plain files are split into byte ranges read by the workers themselves, compressed files
+    are decompressed here and sent to the workers by blocks of settings.batch_size records.
+    At most 2 * n_jobs chunks are in progress at any time, so memory usage stays bounded.
+    :param input_fastq: file object opened by open_input_file.
+    :param output_fastq: file object opened in 'wb' mode.
+    :return: int, number of written records.
+    """
+    # every worker collects statistics and per-read metrics of its own chunk, they are merged here,
+    # duplicates and the reservoir sample span all the chunks, so they are handled here as well
+    worker_settings = replace(settings, dedup=None, reservoir=None)
+    if settings.stats is not None:
+        worker_settings.stats = settings.stats.empty_copy()
+    if settings.metrics is not None:
+        worker_settings.metrics = _ReadMetrics(batch_size=2 ** 62)
+
+    def chunk_settings():
+        if settings.sampler is None:
+            return worker_settings
+        return replace(worker_settings, sampler=settings.sampler.spawn())
+
+    if isinstance(input_fastq, gzip.GzipFile):
+        tasks = ((_filter_fastq_bytes, block, engine, chunk_settings())
+                 for block in _read_fastq_blocks(input_fastq, settings.batch_size))
+    else:
+        input_path = input_fastq.name
+        n_chunks = max(n_jobs, os.path.getsize(input_path) // _CHUNK_SIZE)
+        tasks = ((_filter_fastq_chunk, input_path, start, end, engine, chunk_settings())
+                 for start, end in _fastq_chunks(input_path, n_chunks))
+
+    written = 0
+    with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+        futures = deque(executor.submit(*task) for task in islice(tasks, 2 * n_jobs))
+        while futures:
+            output_chunk, chunk_written, chunk_stats, chunk_metrics = futures.popleft().result()
+            if chunk_stats is not None:
+                settings.stats.merge(chunk_stats)
+            if chunk_metrics is not None:
+                settings.metrics.add_columns(chunk_metrics.columns(), chunk_metrics.n_reads)
+            if (settings.dedup is not None or settings.reservoir is not None) and chunk_written:
+                chunk_written = _write_chunk_records(output_fastq, output_chunk, settings)
+            else:
+                output_fastq.write(output_chunk)
+            written += chunk_written
+            futures.extend(executor.submit(*task) for task in islice(tasks, 1))
+    return written
+
+
+def _input_signature(input_path: str) -> dict:
+    """
+    Size and modification time of the input file, a checkpoint is valid only for the same input.
+    """
+    input_stat = os.stat(input_path)
+    return {"path": input_path, "size": input_stat.st_size, "mtime": input_stat.st_mtime}
+
+
+def _save_checkpoint(checkpoint_path: str, checkpoint: dict):
+    """
+    Writes the checkpoint sidecar file atomically, so an interrupted write leaves the previous checkpoint.
+    """
+    with open(checkpoint_path + ".tmp", "w") as checkpoint_file:
+        json.dump(checkpoint, checkpoint_file)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+
+def _load_checkpoint(checkpoint_path: str, input_path: str):
+    """
+    Reads the checkpoint sidecar file of a previous run.
+    :return: dict or None if there is no checkpoint.
+    Raises ValueError if the checkpoint was made for another input file.
+    """
+    if not os.path.exists(checkpoint_path):
+        return None
+    with open(checkpoint_path) as checkpoint_file:
+        checkpoint = json.load(checkpoint_file)
+    if checkpoint["input"] != _input_signature(input_path):
+        raise ValueError(f"Checkpoint {checkpoint_path} was made for another input file")
+    return checkpoint
+
+
+def _run_checkpointed(input_fastq, output_fastq, engine: str, settings: _FilterSettings,
+                      checkpoint: dict, checkpoint_path: str, checkpoint_interval: int) -> int:
+    """
+    Filters a FASTQ file by blocks of settings.batch_size records and saves a checkpoint every
+    checkpoint_interval bytes of input: offsets of the next input record and of the end of the output
+    (after flushing it, so that compressed output ends on a block boundary), and the counters of the run.
+    :param checkpoint: dict, the checkpoint to start from (offsets 0 for a new run).
+    :return: int, number of written records (including the records written before the checkpoint).
+    """
+    input_fastq.seek(checkpoint["input_offset"])
+    written, last_offset = checkpoint["written"], checkpoint["input_offset"]
+    for block in _read_fastq_blocks(input_fastq, settings.batch_size):
+        written += _FASTQ_ENGINES[engine](io.BytesIO(block), output_fastq, settings)
+        # blocks are normalized (no trailing empty lines, a final line break), so the offset is taken from the file
+        input_offset = input_fastq.tell()
+        if input_offset - last_offset >= checkpoint_interval:
+            output_fastq.flush()
+            checkpoint.update(input_offset=input_offset, output_offset=os.path.getsize(output_fastq.name),
+                              written=written)
+            if settings.stats is not None:
+                checkpoint["stats"] = settings.stats.to_dict()
+            _save_checkpoint(checkpoint_path, checkpoint)
+            last_offset = input_offset
+    return written
+
+
+def _detect_phred_offset(input_path: str, n_reads=_PHRED_DETECTION_READS) -> int:
+    """
+    Guesses the quality encoding of a FASTQ file from the range of quality characters of its first reads.
+    :param input_path: str, path to the FASTQ file (plain or gzip compressed).
+    :param n_reads: int, number of reads to look at.
+    :return: int, 33 or 64. Sanger encoding (33) is assumed if the range fits both encodings.
+    """
+    with open_input_file(input_path) as fastq_file:
+        qualities = b"".join(qual for _, _, qual in islice(_read_fastq_raw(fastq_file), n_reads))
+    if not qualities:
+        return _PHRED_OFFSET
+    # Phred+64 encodings have no characters below ';' (Q-5 of Solexa),
+    # Phred+33 qualities of Illumina instruments do not exceed 'J' (Q41)
+    if min(qualities) < ord(";"):
+        return 33
+    if max(qualities) > ord("J"):
+        return 64
+    return _PHRED_OFFSET
+
+
+def _resolve_phred_offset(input_path: str, phred_offset) -> int:
+    """
+    Checks the phred_offset argument, detects the encoding if it is "auto".
+    :return: int, 33 or 64.
+    """
+    if phred_offset == "auto":
+        return _detect_phred_offset(input_path)
+    if phred_offset not in _SEQIO_FORMATS:
+        raise ValueError(f"Unknown phred_offset '{phred_offset}', possible values are: 33, 64, auto")
+    return phred_offset
+
+
+def _pipeline_put(block_queue: queue.Queue, item, stop: threading.Event) -> bool:
+    """
+    Puts an item into a bounded queue of the pipeline, gives up if the pipeline is stopped.
+    :return: bool, True if the item was put.
+    """
+    while not stop.is_set():
+        try:
+            block_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            continue
+    return False
+
+
+def _pipeline_get(block_queue: queue.Queue, stop: threading.Event):
+    """
+    Gets an item from a queue of the pipeline, returns None if the pipeline is stopped.
+    """
+    while not stop.is_set():
+        try:
+            return block_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+    return None
+
+
+def _pipeline_reader(input_fastq, batch_size: int, blocks: queue.Queue, timings: dict, stop: threading.Event):
+    """
+    Reader thread of the pipeline: puts blocks of records into the queue, then None at the end of file.
+    An exception is put into the queue to be raised by the main thread.
+    """
+    try:
+        started = time.perf_counter()
+        for block in _read_fastq_blocks(input_fastq, batch_size):
+            ready = time.perf_counter()
+            timings["busy"] += ready - started
+            if not _pipeline_put(blocks, block, stop):
+                return
+            started = time.perf_counter()
+            timings["waiting_output"] += started - ready
+        timings["busy"] += time.perf_counter() - started
+        _pipeline_put(blocks, None, stop)
+    except BaseException as error:
+        _pipeline_put(blocks, error, stop)
+
+
+def _pipeline_writer(output_fastq, outputs: queue.Queue, timings: dict, stop: threading.Event, errors: list):
+    """
+    Writer thread of the pipeline: writes the filtered blocks until None is received.
+    An exception stops the pipeline and is kept in errors to be raised by the main thread.
+    """
+    try:
+        while True:
+            waiting = time.perf_counter()
+            output = _pipeline_get(outputs, stop)
+            started = time.perf_counter()
+            timings["waiting_input"] += started - waiting
+            if output is None:
+                return
+            output_fastq.write(output)
+            timings["busy"] += time.perf_counter() - started
+    except BaseException as error:
+        errors.append(error)
+        stop.set()
+
+
+def _run_pipelined(input_fastq, output_fastq, engine: str, settings: _FilterSettings) -> tuple:
+    """
+    Filters a FASTQ file with reading, filtering and writing overlapped: a reader thread and a writer thread
+    exchange blocks of settings.batch_size records with the main thread through bounded queues.
+    :return: tuple (number of written records, dict of the busy and blocked seconds of every stage).
+    """
+    timings = {stage: {"busy": 0.0, "waiting_input": 0.0, "waiting_output": 0.0}
+               for stage in ("read", "compute", "write")}
+    blocks, outputs = queue.Queue(_PIPELINE_QUEUE_SIZE), queue.Queue(_PIPELINE_QUEUE_SIZE)
+    stop = threading.Event()
+    errors = []
+    reader = threading.Thread(target=_pipeline_reader, daemon=True,
+                              args=(input_fastq, settings.batch_size, blocks, timings["read"], stop))
+    writer = threading.Thread(target=_pipeline_writer, daemon=True,
+                              args=(output_fastq, outputs, timings["write"], stop, errors))
+    reader.start()
+    writer.start()
+
+    written = 0
+    compute = timings["compute"]
+    try:
+        while True:
+            waiting = time.perf_counter()
+            block = _pipeline_get(blocks, stop)
+            started = time.perf_counter()
+            compute["waiting_input"] += started - waiting
+            if block is None:
+                break
+            if isinstance(block, BaseException):
+                raise block
+            if engine in ("numpy", "mmap"):
+                # blocks of complete records are filtered directly, without splitting them into lines again
+                output_block = io.BytesIO()
+                written += _filter_write_block(output_block, block, settings)
+                output = output_block.getvalue()
+            else:
+                output, block_written, _, _ = _filter_fastq_bytes(block, engine, settings)
+                written += block_written
+            finished = time.perf_counter()
+            compute["busy"] += finished - started
+            if not _pipeline_put(outputs, output, stop):
+                break
+            compute["waiting_output"] += time.perf_counter() - finished
+        _pipeline_put(outputs, None, stop)
+        writer.join()
+    finally:
+        stop.set()
+        reader.join()
+        writer.join()
+    if errors:
+        raise errors[0]
+    return written, timings
+
+
+def _results_path(input_path: str, output_filename=None, suffix="") -> str:
+    """
+    Makes a path of an output file in the fastq_filtrator_results folder, creating the folder if needed.
+    :param input_path: str, path to the input file, its name is taken if output_filename is None.
+    :param output_filename: str, name of the output file.
+    :param suffix: str, added to the file name before its extension (and before .gz).
+    :return: str, path of the output file.
+    """
+    if not os.path.exists('fastq_filtrator_results'):
+        os.mkdir('fastq_filtrator_results')
+
+    if output_filename is None:
+        output_filename = os.path.basename(input_path)
+
+    return os.path.join('fastq_filtrator_results', _add_suffix(output_filename, suffix))
+
+
+def _add_suffix(path: str, suffix: str) -> str:
+    """
+    Adds a suffix to a file name before its extension (and before .gz).
+    """
+    if not suffix:
+        return path
+    root, extension = os.path.splitext(path)
+    if extension in (".gz", ".bgz", ".bgzf"):
+        root, inner_extension = os.path.splitext(root)
+        extension = inner_extension + extension
+    return root + suffix + extension
+
+
+class _ShardedOutput(io.RawIOBase):
+    """
+    Writable file object splitting a stream of four-line FASTQ records between several output files:
+    consecutive shards of shard_reads records or shard_size bytes, or bins of GC content or length.
+    Records are routed by batches of _SHARD_BUFFER_SIZE bytes, records of the bins are buffered per bin
+    and at most max_open_files files are open at once. A JSON manifest of the files is written on closing.
+    """
+    def __init__(self, output_path: str, compress_level=6, shard_reads=None, shard_size=None,
+                 bin_by=None, bins=None, max_open_files=16):
+        super().__init__()
+        if sum(option is not None for option in (shard_reads, shard_size, bin_by)) != 1:
+            raise ValueError("Only one of shard_reads, shard_size and bin_by can be given")
+        if bin_by is not None:
+            if bin_by not in _BIN_UPPER_LIMITS:
+                raise ValueError(f"Unknown bin_by '{bin_by}', possible values are: gc, length")
+            if not bins or list(bins) != sorted(bins):
+                raise ValueError("bins must be a non-empty sorted sequence of bin edges")
+            if not 0 < bins[0] <= bins[-1] < _BIN_UPPER_LIMITS[bin_by]:
+                raise ValueError(f"bins of {bin_by} must be between 0 and {_BIN_UPPER_LIMITS[bin_by]:g}")
+        for name, value in (("shard_reads", shard_reads), ("shard_size", shard_size)):
+            if value is not None and (not isinstance(value, int) or value < 1):
+                raise ValueError(f"{name} must be a positive integer")
+        if not isinstance(max_open_files, int) or max_open_files < 1:
+            raise ValueError("max_open_files must be a positive integer")
+        self.name = output_path
+        self.manifest_path = output_path + ".manifest.json"
+        self.compress_level = compress_level
+        self.shard_reads = shard_reads
+        self.shard_size = shard_size
+        self.bin_by = bin_by
+        self.max_open_files = max_open_files
+        self.shards = []
+        self._pending = bytearray()
+        self._files = {}
+        self._created = set()
+        if bin_by is not None:
+            self.edges = np.asarray(bins, dtype=float)
+            bounds = [0, *bins, _BIN_UPPER_LIMITS[bin_by]]
+            for lower, upper in zip(bounds[:-1], bounds[1:]):
+                # the open upper bound of length is written as null, Infinity is not valid JSON
+                self._add_shard(f"_{bin_by}{lower:g}-{upper:g}", bounds=[lower, None if upper == math.inf else upper])
+            self._buffers = [io.BytesIO() for _ in self.shards]
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        """
+        Buffers data, complete records are routed to their files once enough data is collected.
+        Returns:
+        -int: Number of bytes written.
+        """
+        self._pending += data
+        if len(self._pending) >= _SHARD_BUFFER_SIZE:
+            self._route()
+        return len(data)
+
+    def flush(self):
+        if not self.closed:
+            self._route()
+
+    def close(self):
+        """
+        Writes out the remaining records, closes the files and writes the manifest.
+        Raises ValueError if the data ends with an incomplete record.
+        """
+        if self.closed:
+            return
+        try:
+            self._route()
+            if self._pending:
+                raise ValueError("Truncated FASTQ record")
+            if self.bin_by is not None:
+                for index in range(len(self.shards)):
+                    self._write_buffer(index)
+        finally:
+            for output_file in self._files.values():
+                output_file.close()
+            self._files.clear()
+            super().close()
+        self._write_manifest()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            # the run failed, only the complete records are written out
+            del self._pending[:]
+        self.close()
+
+    def _add_shard(self, suffix: str, **fields):
+        self.shards.append({"path": _add_suffix(self.name, suffix), "reads": 0, "bytes": 0, **fields})
+
+    def _open(self, index: int):
+        """
+        Returns the open file of a shard, the least recently used file is closed if too many files are open.
+        Files are truncated when they are opened for the first time and continued afterwards.
+        """
+        output_file = self._files.pop(index, None)
+        if output_file is None:
+            if len(self._files) >= self.max_open_files:
+                self._files.pop(next(iter(self._files))).close()
+            path = self.shards[index]["path"]
+            output_file = open_output_file(path, self.compress_level, mode='ab' if path in self._created else 'wb')
+            self._created.add(path)
+        self._files[index] = output_file
+        return output_file
+
+    def _write_buffer(self, index: int):
+        buffer = self._buffers[index]
+        if buffer.tell():
+            self._open(index).write(buffer.getbuffer())
+            buffer.seek(0)
+            buffer.truncate()
+
+    def _append(self, index: int, block, record_starts: np.ndarray, record_ends: np.ndarray):
+        """
+        Adds records of a block to a shard.
+        """
+        shard = self.shards[index]
+        shard["reads"] += len(record_starts)
+        shard["bytes"] += int(np.sum(record_ends - record_starts))
+        if self.bin_by is None:
+            _write_spans(self._open(index), block, record_starts, record_ends)
+            return
+        _write_spans(self._buffers[index], block, record_starts, record_ends)
+        if self._buffers[index].tell() >= _SHARD_BUFFER_SIZE:
+            self._write_buffer(index)
+
+    def _route(self):
+        """
+        Sends the complete pending records to their shards or bins.
+        """
+        data = np.frombuffer(self._pending, dtype=np.uint8)
+        line_ends = np.flatnonzero(data == ord("\n")) + 1
+        if len(line_ends) < 4:
+            return
+        block = bytes(self._pending[:line_ends[len(line_ends) // 4 * 4 - 1]])
+        del data
+        del self._pending[:len(block)]
+        record_starts, record_ends, seq_starts, seq_ends, _, _ = _fastq_block_spans(np.frombuffer(block, np.uint8))
+
+        if self.bin_by is not None:
+            if self.bin_by == "gc":
+                values = _block_gc(block, seq_starts, seq_ends)
+            else:
+                values = seq_ends - seq_starts
+            keys = np.searchsorted(self.edges, values, side="right")
+            for index in np.unique(keys).tolist():
+                selected = keys == index
+                self._append(index, block, record_starts[selected], record_ends[selected])
+            return
+
+        start = 0
+        while start < len(record_starts):
+            if not self.shards or (self.shard_reads is not None and self.shards[-1]["reads"] >= self.shard_reads) \
+                    or (self.shard_size is not None and self.shards[-1]["bytes"] >= self.shard_size):
+                if self.shards:
+                    self._files.pop(len(self.shards) - 1).close()
+                self._add_shard(f"_part{len(self.shards) + 1:04d}")
+            shard = self.shards[-1]
+            if self.shard_reads is not None:
+                end = start + self.shard_reads - shard["reads"]
+            else:
+                # the records up to the one crossing shard_size, so every shard gets at least one record
+                limit = record_starts[start] + self.shard_size - shard["bytes"]
+                end = int(np.searchsorted(record_ends, limit, side="left")) + 1
+            end = min(end, len(record_starts))
+            self._append(len(self.shards) - 1, block, record_starts[start:end], record_ends[start:end])
+            start = end
+
+    def _write_manifest(self):
+        """
+        Writes the paths (relative to the manifest), number of reads and size of uncompressed records
+        of the non-empty shards to the manifest file.
+        """
+        shards = [{**shard, "path": os.path.basename(shard["path"])} for shard in self.shards if shard["reads"]]
+        if self.bin_by is not None:
+            mode = self.bin_by
+        else:
+            mode = "reads" if self.shard_reads is not None else "size"
+        with open(self.manifest_path, "w") as manifest_file:
+            json.dump({"mode": mode, "reads": sum(shard["reads"] for shard in shards), "shards": shards},
+                      manifest_file, indent=2)
 
 
 def filter_fastq(input_path: str, output_filename=None,
-                 gc_bounds=None, length_bounds=(0, 2 ** 32), quality_threshold=0):
+                 gc_bounds=None, length_bounds=(0, 2 ** 32), quality_threshold=0, engine="seqio",
+                 batch_size=100_000, n_jobs=1, compress_level=6, stats=False, stats_filename=None,
+                 trim_window=None, trim_trailing=None, min_length=None,
+                 dedup=None, dedup_prefix=None, dedup_capacity=10_000_000, dedup_error_rate=0.001,
+                 dedup_memory=None, sample_size=None, sample_fraction=None, seed=None, phred_offset=_PHRED_OFFSET,
+                 metrics_filename=None, checkpoint_interval=None, resume=False, pipeline=False,
+                 shard_reads=None, shard_size=None, bin_by=None, bins=None, max_open_files=16):
     """
     Filters fastq file by GC content, length, and quality.
+    Records are written to the output as soon as they pass the filters,
+    so memory usage does not depend on the size of the input file.
     :param input_path: str, path to fastq_file.
     :param output_filename: str, name of output fastq file with filtered data.
     Optional, takes input file name if not mentioned otherwise.
@@ -23,55 +2063,508 @@ def filter_fastq(input_path: str, output_filename=None,
     :param quality_threshold: float, lower limit for filtration. Default value is 0.
     :param length_bounds: float if one value is given (upper limit of filtration),
     tuple – otherwise (bounds of filtration). Default value is (0, 2**32).
-    :return: fastq file in fastq_filtrator_results folder.
-    Raises ValueError("Too strict conditions") if no record passed the conditions.
+    :param engine: str, "seqio" (default) parses records with Bio.SeqIO,
+    "raw" works on raw bytes and writes passing records unchanged, which is several times faster,
+    "numpy" does the same but scores and filters whole batches of reads at once with NumPy,
+    "mmap" is the "numpy" engine reading a memory-mapped input and writing straight from the mapping.
+    :param batch_size: int, number of reads in a batch of the "numpy" engine. Default value is 100000.
+    :param n_jobs: int, number of processes. If more than 1, the file is split into chunks on record boundaries
+    which are filtered in parallel and written in the original order. Default value is 1.
+    :param compress_level: int, compression level of the output if output_filename ends with .gz,
+    such files are written in BGZF format by several threads. Default value is 6.
+    Gzip or BGZF compressed input is detected automatically.
+    :param stats: bool, if True, QC statistics (histograms of length, GC content and quality,
+    rejection counts per condition) are collected while filtering and returned as FastqStats. Default value is False.
+    Without histograms the conditions are checked cheapest first (length, GC content, quality) and the seqio
+    and raw engines stop the mean quality check as soon as it is decided; stats="counts" collects only the counts
+    of such a run, including the number of reads for which each stage was skipped.
+    :param stats_filename: str, name of JSON file in fastq_filtrator_results folder to write the statistics to.
+    Implies stats=True.
+    :param trim_window: tuple (window size, quality), reads are cut at the start of the first sliding window
+    whose mean quality is below the given value, before any filtration. Default value is None (no trimming).
+    :param trim_trailing: float, low quality bases below this value are removed from the 3' end of reads
+    (after the sliding window trimming). Default value is None (no trimming).
+    :param min_length: int, minimum length of a read after trimming, raises the lower limit of length_bounds.
+    GC content, length and quality conditions are checked on the trimmed reads. Default value is None,
+    which is 1 if trimming is requested, so reads trimmed to length 0 are dropped.
+    :param dedup: str, removes reads whose sequence was already written (only the first read is kept).
+    "exact" keeps 64-bit hashes of the sequences in a compact hash set (about 16 bytes per unique read),
+    "bloom" uses a Bloom filter of fixed size, which may remove a small fraction of unique reads.
+    Default value is None (no deduplication). The number of removed reads is reported in the statistics.
+    :param dedup_prefix: int, if given, only the first dedup_prefix bases are compared,
+    so reads differing only at their 3' ends are removed as well. Default value is None.
+    :param dedup_capacity: int, expected number of unique reads for dedup="bloom". Default value is 10000000.
+    :param dedup_error_rate: float, false-positive rate of dedup="bloom" at dedup_capacity reads.
+    Default value is 0.001.
+    :param dedup_memory: int, size of the Bloom filter of dedup="bloom" in bytes, if given it is used instead
+    of the size derived from dedup_capacity and dedup_error_rate (the false-positive rate then grows with the
+    number of unique reads). Default value is None.
+    :param sample_size: int, writes a uniform random sample of this many reads among the reads which passed
+    the conditions (reservoir sampling, the sample is kept in memory and written in input order).
+    Default value is None (no sampling).
+    :param sample_fraction: float, keeps every read with this probability. The decision is made before
+    the read is trimmed and scored, so only the sampled reads are processed and counted in the statistics.
+    Default value is None (no sampling).
+    :param seed: int, seed of the sampling. The same seed gives the same sample for all engines,
+    with n_jobs > 1 sample_fraction gives a different (but also reproducible) sample. Default value is None.
+    :param phred_offset: int or str, offset of the quality encoding: 33 (Sanger, Illumina 1.8+, default),
+    64 (Illumina 1.3-1.7) or "auto" to detect it from the first reads of the file.
+    :param metrics_filename: str, name of a file in fastq_filtrator_results folder to write per-read metrics to
+    while filtering: index of the read in the input file (from 0), length, GC content, mean quality and whether
+    it passed the conditions (duplicates and reads left out of a sample_size sample are still marked as passed,
+    reads left out by sample_fraction have no row).
+    The format is chosen by the extension: .parquet, .arrow (Arrow IPC) or .csv. Parquet and Arrow need pyarrow,
+    without it a CSV file is written instead. Default value is None.
+    :param checkpoint_interval: int, if given, a checkpoint is saved to <output name>.checkpoint file every
+    checkpoint_interval bytes of input (offsets in the input and output files and the counters of the run).
+    The file is removed when the run is finished. Default value is None (no checkpoints).
+    :param resume: bool, if True and a checkpoint of a previous run exists, the partial output is truncated to the
+    checkpoint and filtering continues from the input offset saved there. Checkpoints are saved as well
+    (every 2**30 bytes if checkpoint_interval is not given). Checkpoints cannot be combined with n_jobs > 1,
+    dedup, sampling and metrics_filename, whose state is not saved. The statistics of the previous run are continued
+    if stats are requested, which needs a checkpoint made with the same stats option. Default value is False.
+    :param pipeline: bool, if True, reading, filtering and writing overlap: a reader thread and a writer thread
+    exchange blocks of batch_size records with the filtering thread through bounded queues (double buffering).
+    The seconds every stage spent working and blocked are logged (INFO level of the custom_tools_main logger)
+    and, if stats are requested, reported in FastqStats.pipeline as well. Default value is False.
+    :param shard_reads: int, if given, the passing reads are written to consecutive shards of this many reads,
+    <output name>_part0001, <output name>_part0002 and so on. Default value is None.
+    :param shard_size: int, the same as shard_reads, but a new shard is started once a shard reaches
+    this many bytes of uncompressed records. Default value is None.
+    :param bin_by: str, "gc" or "length", the passing reads are written to a file per bin of GC content
+    or length, named <output name>_gc<lower>-<upper>. Default value is None.
+    :param bins: sequence of float, sorted edges between the bins of bin_by (a bin includes its lower edge),
+    e.g. (0.4, 0.6) gives the bins gc0-0.4, gc0.4-0.6 and gc0.6-1.
+    :param max_open_files: int, maximal number of bin files open at once, the records of every bin are buffered
+    and files are reopened for appending when needed. Default value is 16.
+    Sharded and binned outputs get a <output name>.manifest.json file listing the non-empty files
+    with their numbers of reads and sizes. They cannot be combined with checkpoints.
+    :return: fastq file in fastq_filtrator_results folder, FastqStats if statistics were requested.
+    The records are written to <output name>.partial file, which replaces the output file when the run is finished.
+    Raises ValueError("Too strict conditions") if no record passed the conditions, an existing output file
+    is kept unchanged in this case (the statistics file is still written).
     """
 
-    input_path = os.path.abspath(input_path)
+    if engine not in _FASTQ_ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', possible values are: {', '.join(_FASTQ_ENGINES)}")
 
-    if not os.path.exists('fastq_filtrator_results'):
-        os.mkdir('fastq_filtrator_results')
+    input_path = os.path.abspath(input_path)
+    output_path = _results_path(input_path, output_filename)
 
-    if output_filename is None:
-        output_filename = os.path.basename(input_path)
+    if min_length is None and (trim_window is not None or trim_trailing is not None):
+        # reads trimmed to nothing are dropped rather than written as empty records
+        min_length = 1
+    if min_length is not None:
+        if isinstance(length_bounds, tuple):
+            length_bounds = (max(length_bounds[0], min_length), length_bounds[1])
+        else:
+            length_bounds = (min_length, length_bounds)
+
+    settings = _FilterSettings(gc_bounds, length_bounds, quality_threshold, batch_size,
+                               trim_window=trim_window, trim_trailing=trim_trailing,
+                               phred_offset=_resolve_phred_offset(input_path, phred_offset))
+    if stats or stats_filename is not None:
+        settings.stats = FastqStats(histograms=stats != "counts")
+    if dedup == "exact":
+        settings.dedup = _HashSet()
+    elif dedup == "bloom":
+        settings.dedup = _BloomFilter(dedup_capacity, dedup_error_rate, dedup_memory)
+    elif dedup is not None:
+        raise ValueError(f"Unknown dedup method '{dedup}', possible values are: exact, bloom")
+    settings.dedup_prefix = dedup_prefix
+    if pipeline:
+        if n_jobs > 1:
+            raise ValueError("pipeline cannot be combined with n_jobs > 1")
+    if sample_size is not None and sample_fraction is not None:
+        raise ValueError("Only one of sample_size and sample_fraction can be given")
+    if sample_size is not None:
+        settings.reservoir = _ReservoirSampler(sample_size, seed)
+    if sample_fraction is not None:
+        settings.sampler = _BernoulliSampler(sample_fraction, seed)
+
+    checkpoint_path = output_path + ".checkpoint"
+    checkpoint = None
+    if checkpoint_interval is not None or resume:
+        if n_jobs > 1 or dedup or sample_size or sample_fraction is not None or metrics_filename is not None:
+            raise ValueError("Checkpoints cannot be combined with n_jobs > 1, dedup, sampling or metrics_filename")
+        if pipeline:
+            raise ValueError("Checkpoints cannot be combined with pipeline")
+        if shard_reads is not None or shard_size is not None or bin_by is not None:
+            raise ValueError("Checkpoints cannot be combined with sharded outputs")
+        checkpoint_interval = checkpoint_interval or 2 ** 30
+        if resume:
+            checkpoint = _load_checkpoint(checkpoint_path, input_path)
+        if checkpoint is None:
+            checkpoint = {"input": _input_signature(input_path), "input_offset": 0, "output_offset": 0,
+                          "written": 0, "stats": None}
+        elif settings.stats is not None:
+            # the counters of the run are restored only if statistics are requested again
+            if checkpoint["stats"] is None:
+                raise ValueError(f"Checkpoint {checkpoint_path} was made without statistics")
+            restored = FastqStats.from_dict(checkpoint["stats"])
+            if restored.histograms != settings.stats.histograms:
+                raise ValueError(f"Checkpoint {checkpoint_path} was made with other statistics settings")
+            settings.stats = restored
+
+    # records are written to a partial file which replaces the output only if some records passed,
+    # so an existing output file is kept if the run fails or the conditions are too strict
+    partial_path = _add_suffix(output_path, ".partial")
+    output_mode = 'wb'
+    if checkpoint is not None and checkpoint["output_offset"]:
+        with open(partial_path, 'r+b') as output_file:
+            output_file.truncate(checkpoint["output_offset"])
+        output_mode = 'ab'
+
+    def remove_partial(exc_type, exc_val, exc_tb):
+        # a failed run leaves no partial file, unless it is kept for resuming from a checkpoint
+        if exc_type is not None and checkpoint is None and os.path.exists(partial_path):
+            os.remove(partial_path)
+
+    with ExitStack() as stack:
+        stack.push(remove_partial)
+        input_fastq = stack.enter_context(open_input_file(input_path))
+        if shard_reads is not None or shard_size is not None or bin_by is not None:
+            output_fastq = stack.enter_context(_ShardedOutput(output_path, compress_level, shard_reads, shard_size,
+                                                              bin_by, bins, max_open_files))
+        else:
+            output_fastq = stack.enter_context(open_output_file(partial_path, compress_level, mode=output_mode))
+        if metrics_filename is not None:
+            metrics_writer = stack.enter_context(_MetricsWriter(_results_path(input_path, metrics_filename)))
+            settings.metrics = _ReadMetrics(metrics_writer, batch_size)
+
+        if checkpoint is not None:
+            written = _run_checkpointed(input_fastq, output_fastq, engine, settings,
+                                        checkpoint, checkpoint_path, checkpoint_interval)
+        elif pipeline:
+            written, timings = _run_pipelined(input_fastq, output_fastq, engine, settings)
+            for stage, stage_timings in timings.items():
+                logger.info("Pipeline stage %s: busy %.3f s, waiting for input %.3f s, waiting for output %.3f s",
+                            stage, stage_timings["busy"], stage_timings["waiting_input"],
+                            stage_timings["waiting_output"])
+            if settings.stats is not None:
+                settings.stats.pipeline = timings
+        elif n_jobs > 1:
+            written = _run_parallel(input_fastq, output_fastq, engine, settings, n_jobs)
+        else:
+            written = _FASTQ_ENGINES[engine](input_fastq, output_fastq, settings)
+        if settings.reservoir is not None:
+            sample = settings.reservoir.records()
+            output_fastq.write(b"".join(sample))
+            written = len(sample)
+        if settings.metrics is not None:
+            settings.metrics.flush()
+
+    if checkpoint is not None and os.path.exists(checkpoint_path):
+        os.remove(checkpoint_path)
+
+    if stats_filename is not None:
+        settings.stats.write_json(_results_path(input_path, stats_filename))
+
+    if not written:
+        if isinstance(output_fastq, _ShardedOutput):
+            os.remove(output_fastq.manifest_path)
+        else:
+            os.remove(partial_path)
+        raise ValueError("Too strict conditions")
+    if not isinstance(output_fastq, _ShardedOutput):
+        os.replace(partial_path, output_path)
 
-    output_path = os.path.join('fastq_filtrator_results', output_filename)
+    return settings.stats
 
-    passed_filters = []
 
-    for record in SeqIO.parse(input_path, "fastq"):
-        seq_len = len(record.seq)
-        gc_content = gc(record.seq)
-        quality = sum(record.letter_annotations["phred_quality"]) / len(record.letter_annotations["phred_quality"])
+def _read_id(header: bytes) -> bytes:
+    """
+    Read ID of a FASTQ header line: the name without '@', anything after the first whitespace
+    and the /1 or /2 mate suffix, so the IDs of both mates are equal.
+    """
+    name = header[1:].rstrip(b"\r\n").replace(b"\t", b" ").split(b" ", 1)[0]
+    return name[:-2] if name[-2:] in (b"/1", b"/2") else name
 
-        # Working with GC-bounds
-        if gc_bounds is not None:
-            if isinstance(gc_bounds, tuple):
-                if not (gc_bounds[0] <= gc_content <= gc_bounds[1]):
-                    continue
-            else:
-                if not gc_content <= gc_bounds:
-                    continue
 
-        # Working with length-bounds
-        if isinstance(length_bounds, tuple):
-            if not (length_bounds[0] <= seq_len <= length_bounds[1]):
-                continue
+def _block_read_ids(data: np.ndarray, record_starts: np.ndarray, seq_starts: np.ndarray) -> tuple:
+    """
+    Vectorized version of _read_id for all the records of a block, only the header lines are looked at.
+    :param data: np.ndarray of uint8, the block.
+    :return: tuple (np.ndarray of the ID lengths, np.ndarray of uint8 with a row per record holding its ID
+    padded with zeros to the longest ID).
+    """
+    id_starts = record_starts + 1
+    header_lens = seq_starts - 1 - id_starts
+    # one more column than the longest header, so every row ends with a zero
+    columns = np.arange(int(header_lens.max()) + 1 if len(header_lens) else 1)
+    headers = data[np.minimum(id_starts[:, None] + columns, len(data) - 1)]
+    headers[columns >= header_lens[:, None]] = 0
+    # the ID ends at the first whitespace or at the end of the line
+    id_lens = np.argmax((headers == ord(" ")) | (headers == ord("\t")) | (headers == ord("\r")) | (headers == 0),
+                        axis=1)
+    rows = np.arange(len(id_lens))
+    last = headers[rows, np.maximum(id_lens - 1, 0)]
+    mate_suffix = ((id_lens >= 2) & (headers[rows, np.maximum(id_lens - 2, 0)] == ord("/"))
+                   & ((last == ord("1")) | (last == ord("2"))))
+    id_lens -= 2 * mate_suffix
+    width = int(id_lens.max()) if len(id_lens) else 0
+    ids = headers[:, :width]
+    ids[columns[:width] >= id_lens[:, None]] = 0
+    return id_lens, ids
+
+
+def _check_mate_ids(blocks: tuple):
+    """
+    Checks that the records of the blocks of both mates have the same read IDs, see _read_id.
+    :param blocks: tuple of two bytes blocks of complete FASTQ records.
+    Raises ValueError if the blocks have different numbers of records or the IDs of some mates differ.
+    """
+    ids = []
+    for block in blocks:
+        data = np.frombuffer(block, dtype=np.uint8)
+        record_starts, _, seq_starts, _, _, _ = _fastq_block_spans(data)
+        ids.append(_block_read_ids(data, record_starts, seq_starts))
+    if len(ids[0][0]) != len(ids[1][0]):
+        raise ValueError("Paired files have different numbers of records")
+    if np.array_equal(ids[0][0], ids[1][0]) and np.array_equal(ids[0][1], ids[1][1]):
+        return
+    width = max(id_rows.shape[1] for _, id_rows in ids)
+    padded = [np.pad(id_rows, ((0, 0), (0, width - id_rows.shape[1]))) for _, id_rows in ids]
+    mismatch = np.flatnonzero((ids[0][0] != ids[1][0]) | np.any(padded[0] != padded[1], axis=1))[0]
+    name_1, name_2 = (id_rows[mismatch, :id_lens[mismatch]].tobytes().decode() for id_lens, id_rows in ids)
+    raise ValueError(f"Read IDs of the mates differ: {name_1!r} and {name_2!r}")
+
+
+def _run_raw_paired(input_fastqs: tuple, output_fastqs: tuple, orphan_fastqs, settings: _FilterSettings) -> int:
+    """
+    Paired-end version of the raw engine, mates are read and filtered in lockstep.
+    :param input_fastqs: tuple of two file objects opened in 'rb' mode.
+    :param output_fastqs: tuple of two file objects opened in 'wb' mode for the passing pairs.
+    :param orphan_fastqs: tuple of two file objects for the reads whose mate failed, or None.
+    :return: tuple (number of written pairs, list of the numbers of written orphans of both mates).
+    """
+    written, orphans = 0, [0, 0]
+    mates = zip_longest(_read_fastq_raw(input_fastqs[0]), _read_fastq_raw(input_fastqs[1]))
+    for mate_1, mate_2 in mates:
+        if mate_1 is None or mate_2 is None:
+            raise ValueError("Paired files have different numbers of records")
+        id_1, id_2 = _read_id(mate_1[0].split(b"\n", 1)[0]), _read_id(mate_2[0].split(b"\n", 1)[0])
+        if id_1 != id_2:
+            raise ValueError(f"Read IDs of the mates differ: {id_1.decode()!r} and {id_2.decode()!r}")
+        passed = [_passes_filters(*_raw_metrics(seq, qual, settings.phred_offset), settings.gc_bounds,
+                                  settings.length_bounds, settings.quality_threshold)
+                  for _, seq, qual in (mate_1, mate_2)]
+        if all(passed):
+            output_fastqs[0].write(mate_1[0])
+            output_fastqs[1].write(mate_2[0])
+            written += 1
+        elif orphan_fastqs is not None:
+            for i, (mate, mate_passed, orphan_fastq) in enumerate(zip((mate_1, mate_2), passed, orphan_fastqs)):
+                if mate_passed:
+                    orphan_fastq.write(mate[0])
+                    orphans[i] += 1
+    return written, orphans
+
+
+def _run_numpy_paired(input_fastqs: tuple, output_fastqs: tuple, orphan_fastqs, settings: _FilterSettings) -> int:
+    """
+    Paired-end version of the numpy engine, batches of both mates are scored and filtered in lockstep.
+    :param input_fastqs: tuple of two file objects opened in 'rb' mode.
+    :param output_fastqs: tuple of two file objects opened in 'wb' mode for the passing pairs.
+    :param orphan_fastqs: tuple of two file objects for the reads whose mate failed, or None.
+    :return: tuple (number of written pairs, list of the numbers of written orphans of both mates).
+    """
+    written, orphans = 0, [0, 0]
+    batches = zip_longest(*(_read_fastq_blocks(input_fastq, settings.batch_size) for input_fastq in input_fastqs))
+    for blocks in batches:
+        if None in blocks:
+            raise ValueError("Paired files have different numbers of records")
+        _check_mate_ids(blocks)
+        filtered = [_filter_block(block, settings) for block in blocks]
+        pair_mask = filtered[0][2] & filtered[1][2]
+
+        for block, (record_starts, record_ends, mask, trimmed), output_fastq in zip(blocks, filtered, output_fastqs):
+            _write_block(output_fastq, block, record_starts, record_ends, pair_mask, trimmed)
+        if orphan_fastqs is not None:
+            for i, (block, (record_starts, record_ends, mask, trimmed)) in enumerate(zip(blocks, filtered)):
+                orphan_mask = mask & ~pair_mask
+                _write_block(orphan_fastqs[i], block, record_starts, record_ends, orphan_mask, trimmed)
+                orphans[i] += int(np.count_nonzero(orphan_mask))
+        written += int(np.count_nonzero(pair_mask))
+    return written, orphans
+
+
+_PAIRED_ENGINES = {
+    "raw": _run_raw_paired,
+    "numpy": _run_numpy_paired,
+}
+
+
+def filter_fastq_paired(input_path_1: str, input_path_2: str, output_filename_1=None, output_filename_2=None,
+                        gc_bounds=None, length_bounds=(0, 2 ** 32), quality_threshold=0, keep_orphans=False,
+                        engine="numpy", batch_size=100_000, compress_level=6, phred_offset=_PHRED_OFFSET):
+    """
+    Filters paired-end fastq files by GC content, length, and quality in one streaming pass.
+    Both mates have to pass the conditions, otherwise the pair is dropped as a whole.
+    :param input_path_1: str, path to fastq file with the first mates (R1).
+    :param input_path_2: str, path to fastq file with the second mates (R2), in the same order.
+    :param output_filename_1: str, name of output file for R1. Optional, takes input file name if not mentioned.
+    :param output_filename_2: str, name of output file for R2. Optional, takes input file name if not mentioned.
+    :param gc_bounds: bounds of GC content, see filter_fastq.
+    :param length_bounds: bounds of length, see filter_fastq.
+    :param quality_threshold: float, lower limit for mean quality. Default value is 0.
+    :param keep_orphans: bool, if True, reads which passed while their mate did not are written
+    to <output name>_singletons files. Default value is False.
+    :param engine: str, "raw" or "numpy" (default), see filter_fastq.
+    :param batch_size: int, number of reads in a batch of the "numpy" engine. Default value is 100000.
+    :param compress_level: int, compression level of .gz outputs. Default value is 6.
+    :param phred_offset: int or str, 33 (default), 64 or "auto", see filter_fastq.
+    :return: fastq files in fastq_filtrator_results folder. Records are written to .partial files which replace
+    the outputs at the end, so the outputs of a previous run are kept if the run fails.
+    Raises ValueError("Too strict conditions") if no pair passed the conditions, the pair outputs are not written
+    in this case (orphans which passed are still written).
+    Raises ValueError if the files have different numbers of records or the read IDs of two mates differ
+    (IDs are compared without the /1 and /2 suffixes and anything after the first space).
+    """
+    if engine not in _PAIRED_ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', possible values are: {', '.join(_PAIRED_ENGINES)}")
+
+    input_paths = (os.path.abspath(input_path_1), os.path.abspath(input_path_2))
+    output_paths = (_results_path(input_paths[0], output_filename_1),
+                    _results_path(input_paths[1], output_filename_2))
+    if output_paths[0] == output_paths[1]:
+        raise ValueError("Output files of both mates have the same name")
+    orphan_paths = tuple(_results_path(input_path, output_filename, suffix="_singletons")
+                         for input_path, output_filename in zip(input_paths, (output_filename_1, output_filename_2)))
+
+    settings = _FilterSettings(gc_bounds, length_bounds, quality_threshold, batch_size,
+                               phred_offset=_resolve_phred_offset(input_paths[0], phred_offset))
+    # the same partial files as in filter_fastq, they replace the outputs only when the run is finished
+    final_paths = output_paths + (orphan_paths if keep_orphans else ())
+    partial_paths = [_add_suffix(path, ".partial") for path in final_paths]
+
+    def remove_partials(exc_type, exc_val, exc_tb):
+        if exc_type is not None:
+            for path in partial_paths:
+                if os.path.exists(path):
+                    os.remove(path)
+
+    with ExitStack() as stack:
+        stack.push(remove_partials)
+        input_fastqs = tuple(stack.enter_context(open_input_file(path)) for path in input_paths)
+        output_fastqs = tuple(stack.enter_context(open_output_file(path, compress_level))
+                              for path in partial_paths[:2])
+        orphan_fastqs = None
+        if keep_orphans:
+            orphan_fastqs = tuple(stack.enter_context(open_output_file(path, compress_level))
+                                  for path in partial_paths[2:])
+        written, orphans = _PAIRED_ENGINES[engine](input_fastqs, output_fastqs, orphan_fastqs, settings)
+
+    # without passing pairs only the orphan files which got some reads replace their outputs
+    replaced = [bool(written)] * 2 + [bool(written or count) for count in orphans[:len(final_paths) - 2]]
+    for partial_path, final_path, replace_output in zip(partial_paths, final_paths, replaced):
+        if replace_output:
+            os.replace(partial_path, final_path)
         else:
-            if not seq_len <= length_bounds:
-                continue
+            os.remove(partial_path)
+    if not written:
+        raise ValueError("Too strict conditions")
 
-        # Working with quality threshold-bounds
-        if quality < quality_threshold:
-            continue
 
-        passed_filters.append(record)
+@dataclass
+class FilterProfile:
+    """
+    A named set of filter_fastq conditions, several profiles are evaluated at once by filter_fastq_profiles.
+
+    Attributes:
+    -name (str): Name of the profile, added to the name of its output file.
+    -gc_bounds: Bounds of GC content, see filter_fastq.
+    -length_bounds: Bounds of length, see filter_fastq.
+    -quality_threshold (float): Lower limit for mean quality.
+    """
+    name: str
+    gc_bounds: object = None
+    length_bounds: object = (0, 2 ** 32)
+    quality_threshold: float = 0
 
-    if not passed_filters:
-        raise ValueError("Too strict conditions")
 
-    with open(output_path, "w") as output_fastq:
-        SeqIO.write(passed_filters, output_fastq, "fastq")
+def _run_raw_profiles(input_fastq, output_fastqs: list, profiles: list, batch_size: int, phred_offset: int) -> list:
+    """
+    Raw engine of filter_fastq_profiles, metrics of every read are calculated once and checked against all profiles.
+    :param input_fastq: file object opened in 'rb' mode.
+    :param output_fastqs: list of file objects opened in 'wb' mode, one per profile.
+    :return: list of int, number of written records per profile.
+    """
+    written = [0] * len(profiles)
+    for record, seq, qual in _read_fastq_raw(input_fastq):
+        seq_len, gc_content, quality = _raw_metrics(seq, qual, phred_offset)
+        for i, profile in enumerate(profiles):
+            if _passes_filters(seq_len, gc_content, quality, profile.gc_bounds,
+                               profile.length_bounds, profile.quality_threshold):
+                output_fastqs[i].write(record)
+                written[i] += 1
+    return written
+
+
+def _run_numpy_profiles(input_fastq, output_fastqs: list, profiles: list, batch_size: int, phred_offset: int) -> list:
+    """
+    NumPy engine of filter_fastq_profiles, every batch is scored once and masked for each profile.
+    :param input_fastq: file object opened in 'rb' mode.
+    :param output_fastqs: list of file objects opened in 'wb' mode, one per profile.
+    :return: list of int, number of written records per profile.
+    """
+    written = [0] * len(profiles)
+    for block in _read_fastq_blocks(input_fastq, batch_size):
+        record_starts, record_ends, seq_lens, gc_content, quality = _score_block(block, phred_offset)
+        for i, profile in enumerate(profiles):
+            mask = _filter_mask(seq_lens, gc_content, quality, profile.gc_bounds,
+                                profile.length_bounds, profile.quality_threshold)
+            _write_spans(output_fastqs[i], block, record_starts[mask], record_ends[mask])
+            written[i] += int(np.count_nonzero(mask))
+    return written
+
+
+_PROFILE_ENGINES = {
+    "raw": _run_raw_profiles,
+    "numpy": _run_numpy_profiles,
+}
+
+
+def filter_fastq_profiles(input_path: str, profiles: list, engine="numpy", batch_size=100_000,
+                          compress_level=6, phred_offset=_PHRED_OFFSET) -> dict:
+    """
+    Filters fastq file with several sets of conditions in a single pass over the file.
+    Metrics of every read are calculated once, the records passing each profile are written
+    to <input name>_<profile name> file in fastq_filtrator_results folder.
+    :param input_path: str, path to fastq_file.
+    :param profiles: list of FilterProfile objects with unique names, which cannot contain path separators or '..'.
+    :param engine: str, "raw" or "numpy" (default), see filter_fastq.
+    :param batch_size: int, number of reads in a batch of the "numpy" engine. Default value is 100000.
+    :param compress_level: int, compression level if the input name ends with .gz. Default value is 6.
+    :param phred_offset: int or str, 33 (default), 64 or "auto", see filter_fastq.
+    :return: dict, profile name -> number of records which passed the profile.
+    Output files of the profiles which no record passed are removed.
+    """
+    if engine not in _PROFILE_ENGINES:
+        raise ValueError(f"Unknown engine '{engine}', possible values are: {', '.join(_PROFILE_ENGINES)}")
+    if not isinstance(batch_size, int) or batch_size < 1:
+        raise ValueError("batch_size must be a positive integer")
+    names = [profile.name for profile in profiles]
+    if len(set(names)) != len(names):
+        raise ValueError("Profile names must be unique")
+    for name in names:
+        # names become parts of file names, they must not lead out of the results folder
+        if not name or ".." in name or any(sep in name for sep in ("/", "\\", os.sep, os.altsep) if sep):
+            raise ValueError(f"Invalid profile name '{name}', names cannot be empty or contain path separators or '..'")
+
+    input_path = os.path.abspath(input_path)
+    output_paths = [_results_path(input_path, suffix=f"_{name}") for name in names]
+    phred_offset = _resolve_phred_offset(input_path, phred_offset)
+
+    with ExitStack() as stack:
+        input_fastq = stack.enter_context(open_input_file(input_path))
+        output_fastqs = [stack.enter_context(open_output_file(path, compress_level)) for path in output_paths]
+        written = _PROFILE_ENGINES[engine](input_fastq, output_fastqs, profiles, batch_size, phred_offset)
+
+    for path, profile_written in zip(output_paths, written):
+        if not profile_written:
+            os.remove(path)
+    return dict(zip(names, written))
 
 
 @dataclass
@@ -1,9 +1,21 @@
 import unittest
 import os
+import gzip
+import json
+import math
+import shutil
+from unittest import mock
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # pyarrow is optional
+    pa = pq = None
 from sklearn.datasets import make_classification
 from custom_random_forest import RandomForestClassifierCustom
-from bio_files_processor import OpenFasta, FastaRecord, read_fasta_file
-from custom_tools_main import run_genscan, GenscanOutput, filter_fastq
+from bio_files_processor import OpenFasta, FastaRecord, CompactFastaRecord, read_fasta_file, read_fasta_files
+from custom_tools_main import run_genscan, GenscanOutput, filter_fastq, filter_fastq_paired
+from custom_tools_main import filter_fastq_profiles, FilterProfile
+import custom_tools_main
 
 class TestRandomForestClassifierCustom(unittest.TestCase):
     """Test class for the RandomForestClassifierCustom class."""
@@ -32,6 +44,75 @@ class TestFastaFunctionality(unittest.TestCase):
         record = FastaRecord(id="test_id", seq="ATCGATCGATCGAGCGCGAAAGCGCG", description="Example sequence")
         self.assertEqual(repr(record), "id='test_id', description='Example sequence...', seq='ATCGATCGATCGAGCGCGAA...'")
 
+    def test_packed_fasta(self):
+        """Test that packed sequences are decoded without changes and counted on the packed data."""
+        filename = "temp_test.fasta"
+        sequence = "ACGTNNNNacgtRYACGTTTGCA"
+        with open(filename, "w") as file:
+            file.write(f">seq1 description1\n{sequence[:10]}\n{sequence[10:]}\n>seq2\nGGCC\n")
+
+        fasta_data = read_fasta_file(filename, packed=True)
+        os.remove(filename)
+
+        self.assertEqual(list(fasta_data), ["seq1 description1", "seq2"])
+        packed = fasta_data["seq1 description1"]
+        self.assertEqual(str(packed), sequence)
+        self.assertEqual(packed[3:11], sequence[3:11])
+        self.assertEqual(packed[::-3], sequence[::-3])
+        self.assertEqual(packed[-1], "A")
+        self.assertEqual(packed.base_counts(),
+                         {"A": 4, "C": 4, "G": 4, "T": 5, "N": 4, "R": 1, "Y": 1})
+        self.assertEqual(packed.base_counts(2, 6), {"A": 0, "C": 0, "G": 1, "T": 1, "N": 2})
+        self.assertEqual(packed.base_counts(17, 6), {"A": 0, "C": 0, "G": 0, "T": 0})
+        self.assertEqual(packed.gc_content(-2, 5), 0.0)
+        self.assertEqual(fasta_data.gc_content(), {"seq1 description1": 8 / 17, "seq2": 1.0})
+
+    def test_read_fasta_files(self):
+        """Test that files read in parallel by parts give the same dictionary as reading them one by one."""
+        for i in range(2):
+            with open(f"temp_test_{i}.fasta", "w") as file:
+                for j in range(20):
+                    file.write(f">seq{i}_{j} file {i}\n{'ACGT' * j}\n{'GGC' * i}\n")
+        with open("temp_test_2.fasta", "w") as file:
+            file.write(">seq0_1 file 0\nTTTT\n")
+
+        expected = {}
+        for i in range(3):
+            expected.update(read_fasta_file(f"temp_test_{i}.fasta"))
+        fasta_data = read_fasta_files("temp_test_*.fasta", n_jobs=2, duplicates="last", part_size=100)
+        self.assertEqual(list(fasta_data.items()), list(expected.items()))
+
+        with self.assertRaises(ValueError):
+            read_fasta_files("temp_test_*.fasta", n_jobs=2, part_size=100)
+        renamed = read_fasta_files(["temp_test_0.fasta", "temp_test_0.fasta"], n_jobs=1, duplicates="rename")
+        self.assertEqual(renamed["seq0_3 file 0_2"], "ACGTACGTACGT")
+        with self.assertRaisesRegex(ValueError, "part_size"):
+            read_fasta_files("temp_test_*.fasta", n_jobs=1, part_size=0)
+
+        for i in range(3):
+            os.remove(f"temp_test_{i}.fasta")
+
+    def test_compact_fasta_record(self):
+        """Test that CompactFastaRecord has the same fields and representation as FastaRecord."""
+        record = FastaRecord(id="test_id", seq="ATCGATCGATCGAGCGCGAAAGCGCG", description="Example sequence")
+        compact = CompactFastaRecord(b"test_id  Example sequence", b"ATCGATCGATCGAGCGCGAAAGCGCG")
+        self.assertEqual(compact, record)
+        self.assertEqual(repr(compact), repr(record))
+        self.assertFalse(hasattr(compact, "__dict__"))
+
+        compact.description = "Changed"
+        self.assertEqual((compact.id, compact.description), ("test_id", "Changed"))
+
+        filename = "temp_test.fasta"
+        with open(filename, "w") as file:
+            file.write(">seq1 description1\nATGCTAGCTA\nGCTAG\n>seq2\nTGCATGCTGA\n")
+        with OpenFasta(filename, compact=True) as fasta_file:
+            records = fasta_file.read_records()
+        with OpenFasta(filename) as fasta_file:
+            self.assertEqual(records, fasta_file.read_records())
+        self.assertIsInstance(records[0], CompactFastaRecord)
+        os.remove(filename)
+
     def test_open_fasta_reading(self):
         """Test reading records from a FASTA file."""
 
@@ -55,6 +136,46 @@ class TestFastaFunctionality(unittest.TestCase):
         self.assertEqual(records[1].description, "description2")
         self.assertEqual(records[1].seq, "TGCATGCTGATCGTAGCTAG")
 
+    def test_chunked_fasta_reading(self):
+        """Test that records split between the chunks of the reader are joined the same way by both readers."""
+        filename = "temp_test.fasta"
+        with open(filename, "w", newline="") as file:
+            file.write(">seq1 first  record\r\nATGCTAGCTA\r\nGCTAG\r\n>seq2\nTGCATG\nCTGA")
+
+        with mock.patch('bio_files_processor._FASTA_BLOCK_SIZE', 7):
+            with OpenFasta(filename) as fasta_file:
+                records = fasta_file.read_records()
+            fasta_data = read_fasta_file(filename)
+            with OpenFasta(filename, 'rb') as fasta_file:
+                raw_record = fasta_file.read_record()
+        os.remove(filename)
+
+        self.assertEqual([(record.id, record.description, record.seq) for record in records],
+                         [("seq1", "first record", "ATGCTAGCTAGCTAG"), ("seq2", "", "TGCATGCTGA")])
+        self.assertEqual(fasta_data, {"seq1 first  record": "ATGCTAGCTAGCTAG", "seq2": "TGCATGCTGA"})
+        self.assertEqual(raw_record, FastaRecord(b"seq1", b"ATGCTAGCTAGCTAG", b"first record"))
+
+    def test_open_fasta_fetch(self):
+        """Test fetching regions through the .fai index and rebuilding the stale index."""
+        filename = "temp_test.fasta"
+        with open(filename, "w") as file:
+            file.write(">seq1 description1\nATGCTAGCTA\nGCTAGCTACA\nTT\n>seq2\nTGCATGCTGA\n")
+
+        with OpenFasta(filename) as fasta_file:
+            self.assertEqual(fasta_file.fetch("seq1", 8, 13), "TAGCT")
+            self.assertEqual(fasta_file.fetch("seq1", 18), "CATT")
+            self.assertEqual(fasta_file.fetch("seq2"), "TGCATGCTGA")
+        with open(filename + ".fai") as index_file:
+            self.assertEqual(index_file.read(), "seq1\t22\t19\t10\t11\nseq2\t10\t50\t10\t11\n")
+
+        with open(filename, "a") as file:
+            file.write(">seq3\nGGGCCC\n")
+        with OpenFasta(filename) as fasta_file:
+            self.assertEqual(fasta_file.fetch("seq3", 2, 4), "GC")
+
+        os.remove(filename)
+        os.remove(filename + ".fai")
+
 
 class TestRunGenscan(unittest.TestCase):
     def test_missing_sequence_and_file(self):
@@ -119,11 +240,49 @@ GATCGATCGATCGTAGCTAGCTGAGCTGCTAGCTAG
 
         os.remove("output_fasta.fasta")
 
+    def test_read_gzipped_fasta_file(self):
+        """
+        Tests if the function reads gzip compressed fasta file properly.
+        """
+        with gzip.open("output_fasta.fasta.gz", 'wt') as file:
+            file.write(">Seq1\nAGCTGCTAG\nCTAGCTACGATCG\n>Seq2\nGATCG\n")
+
+        result_dict = read_fasta_file("output_fasta.fasta.gz")
+
+        self.assertEqual(result_dict, {'Seq1': 'AGCTGCTAGCTAGCTACGATCG', 'Seq2': 'GATCG'})
+
+        os.remove("output_fasta.fasta.gz")
+
 
 class TestFilterFASTQ(unittest.TestCase):
     """
     Tests if the function does proper length filtration.
     """
+    input_files = ('test_input.fastq', 'test_input.fastq.gz', 'test_R1.fastq', 'test_R2.fastq',
+                   'sanger.fastq', 'illumina.fastq')
+
+    def tearDown(self):
+        for path in self.input_files:
+            if os.path.exists(path):
+                os.remove(path)
+        shutil.rmtree('fastq_filtrator_results', ignore_errors=True)
+
+    @staticmethod
+    def write_input(content: str, path='test_input.fastq'):
+        with open(path, 'w') as f:
+            f.write(content)
+
+    @staticmethod
+    def read_output(file_name: str, mode='r'):
+        with open(os.path.join('fastq_filtrator_results', file_name), mode) as f:
+            return f.read()
+
+    @staticmethod
+    def varied_reads(n: int) -> str:
+        """Reads of 4-28 bases with qualities cycling through 0-39."""
+        return "".join(f"@Seq{i}\n{'ACGT' * (i % 7 + 1)}\n+\n{chr(33 + i % 40) * 4 * (i % 7 + 1)}\n"
+                       for i in range(n))
+
     def test_length_filter(self):
         with open('test_input.fastq', 'w') as f:
             f.write("@Seq1\nACGT\n+\n!!!!\n")
@@ -145,5 +304,620 @@ class TestFilterFASTQ(unittest.TestCase):
         os.remove('fastq_filtrator_results/test_input.fastq')
         os.rmdir('fastq_filtrator_results')
 
+    def test_too_strict_conditions(self):
+        """
+        Tests that no output file is left behind when no record passes the filters
+        and an output file of a previous run is kept.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGT\n+\n!!!!\n")
+
+        with self.assertRaises(ValueError) as context:
+            filter_fastq('test_input.fastq', quality_threshold=30)
+        self.assertIn("Too strict conditions", str(context.exception))
+        self.assertFalse(os.path.exists('fastq_filtrator_results/test_input.fastq'))
+
+        filter_fastq('test_input.fastq')
+        with self.assertRaises(ValueError):
+            filter_fastq('test_input.fastq', quality_threshold=30, engine='raw')
+        with open('fastq_filtrator_results/test_input.fastq') as f:
+            self.assertEqual(f.read(), "@Seq1\nACGT\n+\n!!!!\n")
+        self.assertEqual(os.listdir('fastq_filtrator_results'), ['test_input.fastq'])
+
+        os.remove('test_input.fastq')
+        os.remove('fastq_filtrator_results/test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_engines_match_seqio(self):
+        """
+        Tests that the raw, numpy and mmap engines keep exactly the same records as the SeqIO engine.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGT\n+\nIIII\n")
+            f.write("@Seq2\nGGGCCCAT\n+\n!!!!IIII\n")
+            f.write("@Seq3\nATATATNN\n+\nIIIIIIII\n")
+            f.write("@Seq4\nGCGCSWacgt\n+\n++++++++++\n")
+
+        outputs = {}
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            filter_fastq('test_input.fastq', output_filename=f'{engine}.fastq',
+                         gc_bounds=(0.1, 0.8), quality_threshold=15, engine=engine, batch_size=3)
+            with open(f'fastq_filtrator_results/{engine}.fastq') as f:
+                outputs[engine] = f.read()
+            os.remove(f'fastq_filtrator_results/{engine}.fastq')
+
+        self.assertEqual(outputs['raw'], outputs['seqio'])
+        self.assertEqual(outputs['numpy'], outputs['seqio'])
+        self.assertEqual(outputs['mmap'], outputs['seqio'])
+        self.assertEqual(outputs['raw'].count('@Seq'), 2)
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_mmap_windows(self):
+        """
+        Tests that the mmap engine keeps the same reads as the numpy engine when records do not fit into a window
+        and the file ends without a line break or with empty lines.
+        """
+        reads = self.varied_reads(60) + f"@Long\n{'GCAT' * 50}\n+\n{'I' * 200}\n" + self.varied_reads(7)
+        for ending in ("", "\n", "\n\n\n\n\n", "\r\n \n"):
+            self.write_input(reads[:-1] + ending)
+            outputs = {}
+            with mock.patch('custom_tools_main._CHUNK_SIZE', 64), mock.patch('custom_tools_main._LOOKUP_SIZE', 100):
+                for engine in ('numpy', 'mmap'):
+                    filter_fastq('test_input.fastq', output_filename=f'{engine}.fastq', gc_bounds=(0.3, 0.9),
+                                 quality_threshold=10, engine=engine, batch_size=8)
+                    outputs[engine] = self.read_output(f'{engine}.fastq')
+            self.assertEqual(outputs['mmap'], outputs['numpy'])
+            self.assertIn('@Long\n', outputs['mmap'])
+
+    def test_quality_trimming(self):
+        """
+        Tests that reads are trimmed before filtration and all the engines trim them the same way.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGTACGTAC\n+\nIIIIII#III\n")
+            f.write("@Seq2\nGGGCCCATAT\n+\nIIIIIIII##\n")
+            f.write("@Seq3\nATATATGC\n+\n##IIIIII\n")
+            f.write("@Seq4\nGCGCATAT\n+\nIIIIIIII\n")
+
+        outputs = {}
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            filter_fastq('test_input.fastq', output_filename=f'{engine}.fastq', engine=engine,
+                         trim_window=(2, 25), trim_trailing=20, min_length=4)
+            with open(f'fastq_filtrator_results/{engine}.fastq') as f:
+                outputs[engine] = f.read()
+            os.remove(f'fastq_filtrator_results/{engine}.fastq')
+
+        self.assertEqual(outputs['raw'], outputs['seqio'])
+        self.assertEqual(outputs['numpy'], outputs['seqio'])
+        self.assertEqual(outputs['mmap'], outputs['seqio'])
+        self.assertEqual(outputs['raw'], "@Seq1\nACGTA\n+\nIIIII\n@Seq2\nGGGCCCA\n+\nIIIIIII\n"
+                                         "@Seq4\nGCGCATAT\n+\nIIIIIIII\n")
+
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            filter_fastq('test_input.fastq', engine=engine, trim_window=(2, 25))
+            with open('fastq_filtrator_results/test_input.fastq') as f:
+                self.assertEqual(f.read().count('@Seq'), 3)
+            os.remove('fastq_filtrator_results/test_input.fastq')
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_parallel_filter(self):
+        """
+        Tests that filtering with several processes keeps the records and their order.
+        """
+        with open('test_input.fastq', 'w') as f:
+            for i in range(200):
+                f.write(f"@Seq{i}\n{'GC' * (i % 7)}ATAT\n+\n@{'I' * (2 * (i % 7) + 3)}\n")
+
+        outputs = {}
+        for n_jobs in (1, 3):
+            filter_fastq('test_input.fastq', output_filename=f'{n_jobs}.fastq',
+                         gc_bounds=(0.3, 1), engine='raw', n_jobs=n_jobs)
+            with open(f'fastq_filtrator_results/{n_jobs}.fastq') as f:
+                outputs[n_jobs] = f.read()
+            os.remove(f'fastq_filtrator_results/{n_jobs}.fastq')
+
+        self.assertEqual(outputs[3], outputs[1])
+        self.assertEqual(outputs[1].count('@Seq'), 171)
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_gzipped_input_and_output(self):
+        """
+        Tests that compressed input is detected and .gz output is compressed.
+        """
+        with gzip.open('test_input.fastq.gz', 'wt') as f:
+            f.write("@Seq1\nACGT\n+\n!!!!\n")
+            f.write("@Seq2\nACGTACGTACGT\n+\n!!!!!!!!!!!!\n")
+
+        filter_fastq('test_input.fastq.gz', length_bounds=(5, 20), engine='numpy')
+
+        with gzip.open('fastq_filtrator_results/test_input.fastq.gz', 'rt') as f:
+            self.assertEqual(f.read(), "@Seq2\nACGTACGTACGT\n+\n!!!!!!!!!!!!\n")
+
+        os.remove('test_input.fastq.gz')
+        os.remove('fastq_filtrator_results/test_input.fastq.gz')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_paired_filter(self):
+        """
+        Tests that pairs are kept or dropped together, orphans are written separately, mismatched mates are found
+        and the outputs of a previous run are kept when a run fails.
+        """
+        with open('test_R1.fastq', 'w') as f:
+            f.write("@Seq1/1\nACGT\n+\nIIII\n@Seq2/1\nACGT\n+\nIIII\n@Seq3 1:N:0\nACGT\n+\n!!!!\n")
+        with open('test_R2.fastq', 'w') as f:
+            f.write("@Seq1/2\nTTGC\n+\nIIII\n@Seq2/2\nTTGC\n+\n!!!!\n@Seq3 2:N:0\nTTGC\n+\nIIII\n")
+
+        for engine in ('raw', 'numpy'):
+            filter_fastq_paired('test_R1.fastq', 'test_R2.fastq', quality_threshold=20,
+                                keep_orphans=True, engine=engine, batch_size=2)
+            outputs = {}
+            for name in ('test_R1', 'test_R2', 'test_R1_singletons', 'test_R2_singletons'):
+                with open(f'fastq_filtrator_results/{name}.fastq') as f:
+                    outputs[name] = f.read()
+                os.remove(f'fastq_filtrator_results/{name}.fastq')
+
+            self.assertEqual(outputs['test_R1'], "@Seq1/1\nACGT\n+\nIIII\n")
+            self.assertEqual(outputs['test_R2'], "@Seq1/2\nTTGC\n+\nIIII\n")
+            self.assertEqual(outputs['test_R1_singletons'], "@Seq2/1\nACGT\n+\nIIII\n")
+            self.assertEqual(outputs['test_R2_singletons'], "@Seq3 2:N:0\nTTGC\n+\nIIII\n")
+
+        with open('test_R2.fastq', 'w') as f:
+            f.write("@Seq2/2\nTTGC\n+\nIIII\n@Seq1/2\nTTGC\n+\nIIII\n@Seq3/2\nTTGC\n+\nIIII\n")
+        for engine in ('raw', 'numpy'):
+            with self.assertRaisesRegex(ValueError, "Read IDs of the mates differ: 'Seq1' and 'Seq2'"):
+                filter_fastq_paired('test_R1.fastq', 'test_R2.fastq', engine=engine, batch_size=2)
+
+        # a failed run keeps the outputs of the previous run and writes the orphans which passed
+        with open('test_R2.fastq', 'w') as f:
+            f.write("@Seq1/2\nTTGC\n+\nIIII\n@Seq2/2\nTTGC\n+\n!!!!\n@Seq3 2:N:0\nTTGC\n+\nIIII\n")
+        filter_fastq_paired('test_R1.fastq', 'test_R2.fastq', quality_threshold=20, keep_orphans=True)
+        results = sorted(['test_R1.fastq', 'test_R2.fastq', 'test_R1_singletons.fastq', 'test_R2_singletons.fastq'])
+        os.remove('fastq_filtrator_results/test_R2_singletons.fastq')
+        with open('test_R2.fastq', 'w') as f:
+            f.write("@Seq1/2\nTTGC\n+\n!!!!\n@Seq2/2\nTTGC\n+\n!!!!\n@Seq3/2\nTTGC\n+\nIIII\n")
+        with self.assertRaisesRegex(ValueError, "Too strict conditions"):
+            filter_fastq_paired('test_R1.fastq', 'test_R2.fastq', quality_threshold=20, keep_orphans=True)
+        self.assertEqual(sorted(os.listdir('fastq_filtrator_results')), results)
+        with open('fastq_filtrator_results/test_R1.fastq') as f:
+            self.assertEqual(f.read(), "@Seq1/1\nACGT\n+\nIIII\n")
+        with open('fastq_filtrator_results/test_R2_singletons.fastq') as f:
+            self.assertEqual(f.read(), "@Seq3/2\nTTGC\n+\nIIII\n")
+        for name in results:
+            os.remove(f'fastq_filtrator_results/{name}')
+
+        os.remove('test_R1.fastq')
+        os.remove('test_R2.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_filter_profiles(self):
+        """
+        Tests that every profile gets the same records as a separate filter_fastq run.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGT\n+\n!!!!\n")
+            f.write("@Seq2\nGGCCGGAT\n+\nIIIIIIII\n")
+            f.write("@Seq3\nACGTACGTACGT\n+\n555555555555\n")
+
+        profiles = [FilterProfile('short', length_bounds=8),
+                    FilterProfile('gc', gc_bounds=(0.6, 1)),
+                    FilterProfile('none', quality_threshold=50)]
+        for engine in ('raw', 'numpy'):
+            counts = filter_fastq_profiles('test_input.fastq', profiles, engine=engine)
+            self.assertEqual(counts, {'short': 2, 'gc': 1, 'none': 0})
+            self.assertFalse(os.path.exists('fastq_filtrator_results/test_input_none.fastq'))
+
+            for profile in profiles[:2]:
+                filter_fastq('test_input.fastq', output_filename='single.fastq', gc_bounds=profile.gc_bounds,
+                             length_bounds=profile.length_bounds, quality_threshold=profile.quality_threshold)
+                with open('fastq_filtrator_results/single.fastq') as f, \
+                        open(f'fastq_filtrator_results/test_input_{profile.name}.fastq') as g:
+                    self.assertEqual(g.read(), f.read())
+                os.remove('fastq_filtrator_results/single.fastq')
+                os.remove(f'fastq_filtrator_results/test_input_{profile.name}.fastq')
+
+        for name in ('../x', 'a/b', '..'):
+            with self.assertRaises(ValueError):
+                filter_fastq_profiles('test_input.fastq', [FilterProfile(name)])
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_filter_stats(self):
+        """
+        Tests that QC statistics are the same for all engines and count every rejection reason.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGT\n+\n!!!!\n")
+            f.write("@Seq2\nGGCCGGAT\n+\nIIIIIIII\n")
+            f.write("@Seq3\nATATATATATAT\n+\n555555555555\n")
+
+        results = []
+        for engine in ('seqio', 'raw', 'numpy'):
+            stats = filter_fastq('test_input.fastq', gc_bounds=(0.3, 1), length_bounds=(0, 10), quality_threshold=10,
+                                 engine=engine, stats_filename='stats.json')
+            with open('fastq_filtrator_results/stats.json') as f:
+                self.assertEqual(json.load(f), stats.to_dict())
+            results.append(stats.to_dict())
+            os.remove('fastq_filtrator_results/stats.json')
+            os.remove('fastq_filtrator_results/test_input.fastq')
+
+        self.assertEqual(results[1], results[0])
+        self.assertEqual(results[2], results[0])
+        self.assertEqual(results[0]['total_reads'], 3)
+        self.assertEqual(results[0]['passed_reads'], 1)
+        self.assertEqual(results[0]['rejected'], {'gc': 1, 'length': 1, 'quality': 1})
+        self.assertEqual(results[0]['quality_histogram']['counts'][40], 1)
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_deduplication(self):
+        """
+        Tests that only the first copy of a sequence is kept and removed duplicates are counted.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGTACGT\n+\nIIIIIIII\n")
+            f.write("@Seq2\nGGGCCCAT\n+\nIIIIIIII\n")
+            f.write("@Seq3\nACGTACGT\n+\n55555555\n")
+            f.write("@Seq4\nACGTACGA\n+\nIIIIIIII\n")
+
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            for dedup in ('exact', 'bloom'):
+                stats = filter_fastq('test_input.fastq', engine=engine, dedup=dedup, stats=True)
+                with open('fastq_filtrator_results/test_input.fastq') as f:
+                    self.assertEqual([line for line in f if line.startswith('@')], ['@Seq1\n', '@Seq2\n', '@Seq4\n'])
+                self.assertEqual(stats.duplicate_reads, 1)
+                os.remove('fastq_filtrator_results/test_input.fastq')
+
+        stats = filter_fastq('test_input.fastq', engine='numpy', dedup='exact', dedup_prefix=7, stats=True)
+        self.assertEqual(stats.duplicate_reads, 2)
+
+        os.remove('fastq_filtrator_results/test_input.fastq')
+
+        # a 4-byte Bloom filter gives many false positives, one-by-one and batch engines must remove the same reads
+        sequences = ["".join("ACGT"[(i >> shift) & 3] for shift in range(0, 16, 2)) for i in range(150)]
+        with open('test_input.fastq', 'w') as f:
+            f.write("".join(f"@Seq{i}\n{sequences[i % 150]}\n+\nIIIIIIII\n" for i in range(200)))
+        outputs, removed = [], []
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            stats = filter_fastq('test_input.fastq', engine=engine, dedup='bloom', dedup_memory=4, stats='counts')
+            with open('fastq_filtrator_results/test_input.fastq') as f:
+                outputs.append(f.read())
+            removed.append(stats.duplicate_reads)
+            os.remove('fastq_filtrator_results/test_input.fastq')
+        self.assertEqual(outputs, [outputs[0]] * 4)
+        self.assertEqual(removed, [removed[0]] * 4)
+        self.assertGreater(removed[0], 50)
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_sampling(self):
+        """
+        Tests that sampling gives the same reads for all engines and keeps the input order.
+        """
+        with open('test_input.fastq', 'w') as f:
+            for i in range(200):
+                f.write(f"@Seq{i}\n{'ACGT' * (i % 5 + 1)}\n+\n{'I' * 4 * (i % 5 + 1)}\n")
+
+        for kwargs in ({'sample_size': 20}, {'sample_fraction': 0.25}):
+            outputs = []
+            for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+                filter_fastq('test_input.fastq', engine=engine, length_bounds=(0, 12), seed=1, batch_size=30, **kwargs)
+                with open('fastq_filtrator_results/test_input.fastq') as f:
+                    outputs.append([int(line[4:]) for line in f if line.startswith('@')])
+                os.remove('fastq_filtrator_results/test_input.fastq')
+
+            for output in outputs[1:]:
+                self.assertEqual(output, outputs[0])
+            self.assertEqual(outputs[0], sorted(outputs[0]))
+            self.assertTrue(all(i % 5 < 3 for i in outputs[0]))
+        self.assertTrue(outputs[0])
+
+        filter_fastq('test_input.fastq', engine='numpy', sample_size=20, seed=1)
+        with open('fastq_filtrator_results/test_input.fastq') as f:
+            self.assertEqual(sum(line.startswith('@') for line in f), 20)
+
+        os.remove('fastq_filtrator_results/test_input.fastq')
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_phred_offset(self):
+        """
+        Tests that Phred+64 files give the same results as their Phred+33 version, with the offset given or detected.
+        """
+        records = [("Seq1", "ACGTACGT", [40, 40, 35, 30, 2, 2, 2, 2]),
+                   ("Seq2", "GGGCCCAT", [38, 38, 38, 38, 38, 38, 38, 38]),
+                   ("Seq3", "ATATATGC", [10, 12, 14, 16, 18, 20, 22, 24])]
+        for name, offset in (('sanger.fastq', 33), ('illumina.fastq', 64)):
+            with open(name, 'w') as f:
+                for record_id, seq, qualities in records:
+                    f.write(f"@{record_id}\n{seq}\n+\n{''.join(chr(q + offset) for q in qualities)}\n")
+
+        expected = filter_fastq('sanger.fastq', output_filename='expected.fastq', quality_threshold=20,
+                                trim_trailing=10, stats=True).to_dict()
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            for phred_offset in (64, 'auto'):
+                stats = filter_fastq('illumina.fastq', quality_threshold=20, trim_trailing=10, engine=engine,
+                                     phred_offset=phred_offset, stats=True)
+                self.assertEqual(stats.to_dict(), expected)
+                with open('fastq_filtrator_results/illumina.fastq') as f:
+                    self.assertEqual([line for line in f if line.startswith('@')], ['@Seq1\n', '@Seq2\n'])
+                os.remove('fastq_filtrator_results/illumina.fastq')
+
+        os.remove('fastq_filtrator_results/expected.fastq')
+        os.remove('sanger.fastq')
+        os.remove('illumina.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_staged_filter_counts(self):
+        """
+        Tests that checking the conditions cheapest first keeps the same reads and counts the skipped stages.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGT\n+\nIIII\n")
+            f.write("@Seq2\nATATATAT\n+\nIIIIIIII\n")
+            f.write("@Seq3\nGGCCGGAT\n+\n!!!!!!!!\n")
+            f.write("@Seq4\nGGCCGGAT\n+\nIIIIIIII\n")
+            f.write(f"@Seq5\n{'GC' * 1500}\n+\n{'I' * 3000}\n")
+
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            stats = filter_fastq('test_input.fastq', gc_bounds=(0.3, 1), length_bounds=(5, 5000), quality_threshold=10,
+                                 engine=engine, stats='counts')
+            with open('fastq_filtrator_results/test_input.fastq') as f:
+                self.assertEqual([line for line in f if line.startswith('@')], ['@Seq4\n', '@Seq5\n'])
+            result = stats.to_dict()
+            self.assertNotIn('gc_histogram', result)
+            self.assertEqual(result['rejected'], {'gc': 1, 'length': 1, 'quality': 1})
+            self.assertEqual(result['skipped']['gc'], 1)
+            self.assertEqual(result['skipped']['quality'], 2)
+            if engine in ('seqio', 'raw'):
+                self.assertEqual(result['skipped']['quality_partial'], 1)
+            os.remove('fastq_filtrator_results/test_input.fastq')
+
+        # reads longer than one step are decided early, those up to one step long are summed at once
+        self.assertEqual(custom_tools_main._quality_reaches(b'I' * 100, 20, 33, (33, 126)), (True, True))
+        self.assertEqual(custom_tools_main._quality_reaches(b'#' * 100, 60, 33, (33, 126)), (False, True))
+        self.assertEqual(custom_tools_main._quality_reaches(b'I' * 64, 30, 33, (33, 126)), (True, False))
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_metrics_export(self):
+        """
+        Tests that per-read metrics of all the reads are written while filtering.
+        """
+        with open('test_input.fastq', 'w') as f:
+            f.write("@Seq1\nACGT\n+\n!!!!\n")
+            f.write("@Seq2\nGGCCGGAT\n+\nIIIIIIII\n")
+
+        for engine in ('seqio', 'raw', 'numpy'):
+            filter_fastq('test_input.fastq', quality_threshold=10, engine=engine, metrics_filename='metrics.csv')
+            with open('fastq_filtrator_results/metrics.csv') as f:
+                lines = f.read().splitlines()
+            self.assertEqual(lines, ['index,length,gc_content,quality,passed', '0,4,0.5,0,0', '1,8,0.75,40,1'])
+            os.remove('fastq_filtrator_results/metrics.csv')
+            os.remove('fastq_filtrator_results/test_input.fastq')
+
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_metrics_index_with_sampling(self):
+        """
+        Tests that the "index" column of the metrics is the position of the read in the input when reads are sampled.
+        """
+        self.write_input(self.varied_reads(300))
+
+        for engine, n_jobs in (('seqio', 1), ('raw', 1), ('numpy', 1), ('raw', 2), ('numpy', 2)):
+            filter_fastq('test_input.fastq', engine=engine, n_jobs=n_jobs, batch_size=50, sample_fraction=0.5,
+                         seed=1, metrics_filename='metrics.csv')
+            rows = [line.split(',') for line in self.read_output('metrics.csv').splitlines()[1:]]
+            indices = [int(row[0]) for row in rows]
+            self.assertLess(len(rows), 250)
+            self.assertEqual(indices, sorted(set(indices)))
+            for index, length, _, quality, _ in rows:
+                self.assertEqual(int(length), 4 * (int(index) % 7 + 1))
+                self.assertEqual(float(quality), int(index) % 40)
+
+    @unittest.skipUnless(pa, 'pyarrow is not installed')
+    def test_metrics_arrow_formats(self):
+        """
+        Tests that the Parquet and Arrow IPC metrics files are read back with the same columns.
+        """
+        self.write_input("@Seq1\nACGT\n+\n!!!!\n"
+                         "@Seq2\nGGCCGGAT\n+\nIIIIIIII\n")
+        expected = {'index': [0, 1], 'length': [4, 8], 'gc_content': [0.5, 0.75], 'quality': [0.0, 40.0],
+                    'passed': [False, True]}
+
+        filter_fastq('test_input.fastq', quality_threshold=10, metrics_filename='metrics.parquet')
+        self.assertEqual(pq.read_table('fastq_filtrator_results/metrics.parquet').to_pydict(), expected)
+        filter_fastq('test_input.fastq', quality_threshold=10, engine='numpy', metrics_filename='metrics.arrow')
+        self.assertEqual(pa.ipc.open_file('fastq_filtrator_results/metrics.arrow').read_all().to_pydict(), expected)
+
+    def test_checkpoint_resume(self):
+        """
+        Tests that a run interrupted after a checkpoint is resumed to the same output as an uninterrupted run.
+        """
+        with open('test_input.fastq', 'w') as f:
+            for i in range(300):
+                f.write(f"@Seq{i}\n{'ACGT' * (i % 7 + 1)}\n+\n{chr(33 + i % 40) * 4 * (i % 7 + 1)}\n")
+
+        expected = filter_fastq('test_input.fastq', output_filename='expected.fastq.gz', quality_threshold=15,
+                                engine='raw', batch_size=20, stats=True).to_dict()
+
+        save_checkpoint = custom_tools_main._save_checkpoint
+
+        def interrupt_after_checkpoint(*args):
+            save_checkpoint(*args)
+            raise KeyboardInterrupt
+
+        with mock.patch('custom_tools_main._save_checkpoint', interrupt_after_checkpoint):
+            with self.assertRaises(KeyboardInterrupt):
+                filter_fastq('test_input.fastq', output_filename='resumed.fastq.gz', quality_threshold=15,
+                             engine='raw', batch_size=20, stats=True, checkpoint_interval=1000)
+        self.assertTrue(os.path.exists('fastq_filtrator_results/resumed.fastq.gz.checkpoint'))
+
+        stats = filter_fastq('test_input.fastq', output_filename='resumed.fastq.gz', quality_threshold=15,
+                             engine='raw', batch_size=20, stats=True, checkpoint_interval=1000, resume=True)
+        self.assertEqual(stats.to_dict(), expected)
+        self.assertFalse(os.path.exists('fastq_filtrator_results/resumed.fastq.gz.checkpoint'))
+        with gzip.open('fastq_filtrator_results/resumed.fastq.gz') as resumed, \
+                gzip.open('fastq_filtrator_results/expected.fastq.gz') as uninterrupted:
+            self.assertEqual(resumed.read(), uninterrupted.read())
+
+        os.remove('fastq_filtrator_results/expected.fastq.gz')
+        os.remove('fastq_filtrator_results/resumed.fastq.gz')
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_checkpoint_resume_file_end(self):
+        """
+        Tests resuming after the last checkpoint of files with trailing empty lines or without a final line break,
+        and that the statistics are restored only if they are requested.
+        """
+        save_checkpoint = custom_tools_main._save_checkpoint
+
+        def interrupt_at_end(checkpoint_path, checkpoint):
+            save_checkpoint(checkpoint_path, checkpoint)
+            if checkpoint['input_offset'] >= os.path.getsize('test_input.fastq') - 5:
+                raise KeyboardInterrupt
+
+        reads = self.varied_reads(100)
+        # the last checkpoint is saved right after the last record
+        for content, end_offset in ((reads.rstrip('\n'), len(reads) - 1), (reads + '\n\n', len(reads))):
+            self.write_input(content)
+            expected = filter_fastq('test_input.fastq', output_filename='expected.fastq', quality_threshold=15,
+                                    engine='raw', batch_size=20, stats=True).to_dict()
+            with mock.patch('custom_tools_main._save_checkpoint', interrupt_at_end):
+                with self.assertRaises(KeyboardInterrupt):
+                    filter_fastq('test_input.fastq', output_filename='resumed.fastq', quality_threshold=15,
+                                 engine='raw', batch_size=20, stats=True, checkpoint_interval=1)
+            with open('fastq_filtrator_results/resumed.fastq.checkpoint') as checkpoint_file:
+                self.assertEqual(json.load(checkpoint_file)['input_offset'], end_offset)
+
+            with self.assertRaisesRegex(ValueError, 'other statistics settings'):
+                filter_fastq('test_input.fastq', output_filename='resumed.fastq', quality_threshold=15,
+                             engine='raw', batch_size=20, stats='counts', resume=True)
+            stats = filter_fastq('test_input.fastq', output_filename='resumed.fastq', quality_threshold=15,
+                                 engine='raw', batch_size=20, stats=True, resume=True)
+            self.assertEqual(stats.to_dict(), expected)
+            self.assertEqual(self.read_output('resumed.fastq'), self.read_output('expected.fastq'))
+
+        with mock.patch('custom_tools_main._save_checkpoint', interrupt_at_end):
+            with self.assertRaises(KeyboardInterrupt):
+                filter_fastq('test_input.fastq', output_filename='resumed.fastq', quality_threshold=15,
+                             engine='raw', batch_size=20, checkpoint_interval=1)
+        with self.assertRaisesRegex(ValueError, 'made without statistics'):
+            filter_fastq('test_input.fastq', output_filename='resumed.fastq', quality_threshold=15,
+                         engine='raw', batch_size=20, stats=True, resume=True)
+        self.assertIsNone(filter_fastq('test_input.fastq', output_filename='resumed.fastq', quality_threshold=15,
+                                       engine='raw', batch_size=20, resume=True))
+        self.assertEqual(self.read_output('resumed.fastq'), self.read_output('expected.fastq'))
+
+    def test_empty_reads(self):
+        """
+        Tests that zero-length reads at the end of a batch, in the middle and at the end of the file are read
+        by all engines and modes, that empty lines after the last record are skipped and that batch sizes
+        below 1 are rejected.
+        """
+        reads = ("@Seq1\nACGT\n+\nIIII\n@Seq2\n\n+\n\n"
+                 "@Seq3\nAC\n+\nII\n@Seq4\n\n+\n\n@Seq5\nGGC\n+\nIII\n@Seq6\n\n+\n\n")
+        self.write_input(reads + "\n\n")
+
+        for engine in ('seqio', 'raw', 'numpy', 'mmap'):
+            for options in ({}, {'n_jobs': 2}, {'pipeline': True}):
+                filter_fastq('test_input.fastq', engine=engine, batch_size=2, **options)
+                self.assertEqual(self.read_output('test_input.fastq'), reads)
+
+        for batch_size in (0, -1, 2.5):
+            with self.assertRaisesRegex(ValueError, 'batch_size must be a positive integer'):
+                filter_fastq('test_input.fastq', batch_size=batch_size)
+            with self.assertRaisesRegex(ValueError, 'batch_size must be a positive integer'):
+                filter_fastq_paired('test_input.fastq', 'test_input.fastq', output_filename_2='mate.fastq',
+                                    batch_size=batch_size)
+            with self.assertRaisesRegex(ValueError, 'batch_size must be a positive integer'):
+                filter_fastq_profiles('test_input.fastq', [FilterProfile('all')], batch_size=batch_size)
+
+    def test_pipeline(self):
+        """
+        Tests that the threaded pipeline writes the same reads as a serial run and reports stage timings.
+        """
+        with open('test_input.fastq', 'w') as f:
+            for i in range(300):
+                f.write(f"@Seq{i}\n{'ACGT' * (i % 7 + 1)}\n+\n{chr(33 + i % 40) * 4 * (i % 7 + 1)}\n")
+
+        for engine in ('raw', 'numpy'):
+            filter_fastq('test_input.fastq', output_filename='serial.fastq', quality_threshold=15,
+                         engine=engine, batch_size=20)
+            with self.assertLogs('custom_tools_main', 'INFO') as logs:
+                self.assertIsNone(filter_fastq('test_input.fastq', output_filename='pipeline.fastq',
+                                               quality_threshold=15, engine=engine, batch_size=20, pipeline=True))
+            self.assertEqual([record.args[0] for record in logs.records], ['read', 'compute', 'write'])
+            with open('fastq_filtrator_results/pipeline.fastq') as pipelined, \
+                    open('fastq_filtrator_results/serial.fastq') as serial:
+                self.assertEqual(pipelined.read(), serial.read())
+            stats = filter_fastq('test_input.fastq', output_filename='pipeline.fastq', quality_threshold=15,
+                                 engine=engine, batch_size=20, pipeline=True, stats='counts')
+            self.assertEqual(set(stats.pipeline), {'read', 'compute', 'write'})
+            for timings in stats.pipeline.values():
+                self.assertEqual(set(timings), {'busy', 'waiting_input', 'waiting_output'})
+
+            os.remove('fastq_filtrator_results/pipeline.fastq')
+            os.remove('fastq_filtrator_results/serial.fastq')
+        os.remove('test_input.fastq')
+        os.rmdir('fastq_filtrator_results')
+
+    def test_sharded_output(self):
+        """
+        Tests that shards by count and bins by length together hold the reads of a single output file.
+        """
+        self.write_input(self.varied_reads(300))
+
+        filter_fastq('test_input.fastq', output_filename='single.fastq', quality_threshold=15, engine='raw')
+        expected = self.read_output('single.fastq', 'rb')
+
+        filter_fastq('test_input.fastq', output_filename='shards.fastq', quality_threshold=15, engine='raw',
+                     shard_reads=50)
+        manifest = json.loads(self.read_output('shards.fastq.manifest.json'))
+        self.assertTrue(all(shard['reads'] == 50 for shard in manifest['shards'][:-1]))
+        self.assertEqual(manifest['reads'], expected.count(b'\n') // 4)
+        self.assertEqual(b''.join(self.read_output(shard['path'], 'rb') for shard in manifest['shards']), expected)
+
+        filter_fastq('test_input.fastq', output_filename='bins.fastq', quality_threshold=15, engine='numpy',
+                     bin_by='length', bins=(10, 20), max_open_files=1)
+        manifest = json.loads(self.read_output('bins.fastq.manifest.json'))
+        self.assertEqual([shard['bounds'] for shard in manifest['shards']], [[0, 10], [10, 20], [20, None]])
+        self.assertEqual(manifest['reads'], expected.count(b'\n') // 4)
+        for shard in manifest['shards']:
+            lengths = [len(line) for line in self.read_output(shard['path'], 'rb').splitlines()[1::4]]
+            self.assertEqual(len(lengths), shard['reads'])
+            self.assertTrue(all(shard['bounds'][0] <= length < (shard['bounds'][1] or math.inf)
+                                for length in lengths))
+
+    def test_sharded_output_options(self):
+        """
+        Tests that zero and negative shard sizes and bins outside the range of the binned value are rejected.
+        """
+        self.write_input(self.varied_reads(30))
+
+        for options in ({'shard_reads': 0}, {'shard_reads': -5}, {'shard_size': 0}, {'shard_size': -1},
+                        {'shard_reads': 2.5}, {'shard_reads': 10, 'max_open_files': 0},
+                        {'bin_by': 'length', 'bins': (10,), 'max_open_files': -1}):
+            with self.assertRaisesRegex(ValueError, 'must be a positive integer'):
+                filter_fastq('test_input.fastq', output_filename='shards.fastq', **options)
+        for bins in ((0.5, 1.5), (0, 0.5), (-0.1,)):
+            with self.assertRaisesRegex(ValueError, 'bins of gc must be between 0 and 1'):
+                filter_fastq('test_input.fastq', output_filename='bins.fastq', bin_by='gc', bins=bins)
+        with self.assertRaisesRegex(ValueError, 'bins of length must be between 0 and inf'):
+            filter_fastq('test_input.fastq', output_filename='bins.fastq', bin_by='length', bins=(-10, 20))
+        self.assertEqual(os.listdir('fastq_filtrator_results'), [])
+
+
 if __name__ == '__main__':
     unittest.main()